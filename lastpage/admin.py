@@ -0,0 +1,137 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import hmac
+import json
+
+from twisted.web import http, resource
+
+
+class Admin(resource.Resource):
+    """
+    Top-level resource for the internal-only admin site, which is served on
+    its own port, on localhost, and is not visible through nginx.
+    """
+
+
+class Status(resource.Resource):
+    """
+    Report the state of the service's backends and caches as JSON, e.g. so
+    that monitoring can alert when a circuit breaker opens.
+
+    @param sources: A C{dict} mapping C{str} names to functions of no
+        arguments that return a JSON-encodable description of something.
+    """
+    allowedMethods = ('GET',)
+    isLeaf = True
+
+    def __init__(self, sources):
+        resource.Resource.__init__(self)
+        self._sources = sources
+
+    def render_GET(self, request):
+        """
+        Handle a GET request.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @return: The C{str} JSON status.
+        """
+        status = dict((name, source())
+                      for name, source in self._sources.iteritems())
+        request.setHeader('content-type', 'application/json')
+        request.setHeader('cache-control', 'no-cache')
+        return json.dumps(status, sort_keys=True, indent=2)
+
+
+class Metrics(resource.Resource):
+    """
+    Serve the service's metrics in the Prometheus text format.
+
+    @param registry: The L{lastpage.metrics.Registry} holding the metrics.
+    """
+    allowedMethods = ('GET',)
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self._registry = registry
+
+    def render_GET(self, request):
+        """
+        Handle a GET request.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @return: The C{str} metrics.
+        """
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        request.setHeader('cache-control', 'no-cache')
+        return self._registry.exposition()
+
+
+class Invalidate(resource.Resource):
+    """
+    Invalidate (or refresh) cached lookup results, e.g. when a user's tags
+    have been changed in Fluidinfo. A POST request must have an
+    C{Authorization: Bearer <secret>} header and a JSON body such as
+
+        {"users": ["terry"], "tags": ["sally/lastpage-work"],
+         "refresh": false}
+
+    The response is a JSON object whose C{tags} value lists the tags
+    affected.
+
+    @param resolver: The L{lastpage.resolver.Resolver} whose results are to
+        be invalidated.
+    @param secret: The C{str} secret that requests must present.
+    """
+    allowedMethods = ('POST',)
+    isLeaf = True
+
+    def __init__(self, resolver, secret):
+        resource.Resource.__init__(self)
+        self._resolver = resolver
+        self._secret = secret
+
+    def render_POST(self, request):
+        """
+        Handle a POST request.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @return: The C{str} JSON response.
+        """
+        request.setHeader('content-type', 'application/json')
+        authorization = request.getHeader('authorization') or ''
+        if not hmac.compare_digest(authorization,
+                                   'Bearer ' + self._secret):
+            request.setResponseCode(http.UNAUTHORIZED)
+            return json.dumps({'error': 'Bad or missing secret.'})
+        try:
+            body = json.loads(request.content.read())
+            users = body.get('users', [])
+            tags = body.get('tags', [])
+            refresh = bool(body.get('refresh', False))
+            if not (isinstance(users, list) and isinstance(tags, list)):
+                raise ValueError()
+            for name in users + tags:
+                if not isinstance(name, unicode):
+                    raise ValueError()
+            for tag in tags:
+                if u'/' not in tag:
+                    raise ValueError()
+        except (ValueError, AttributeError):
+            request.setResponseCode(http.BAD_REQUEST)
+            return json.dumps({'error': 'Expected a JSON object with lists '
+                                        'of users and tags.'})
+        affected = self._resolver.invalidate(users, tags, refresh)
+        return json.dumps({'tags': affected, 'refresh': refresh})
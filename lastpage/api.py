@@ -0,0 +1,192 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import json
+
+from twisted.internet import defer
+from twisted.web import http, resource, server
+
+from lastpage.eventlog import logger
+from lastpage.metrics import registry
+from lastpage.resolver import (
+    REDIRECT, MULTIPLE_PAGES, NOT_A_URL, tagPath)
+
+_keys = registry.counter(
+    'lastpage_api_keys_total', 'Keys looked up through the JSON API.')
+
+# The status reported for a key that could not be resolved.
+ERROR = 'error'
+
+
+def parseKey(key):
+    """
+    Find the user and tag a lookup key is for, in the way
+    L{lastpage.resource.LastPage.getChild} does for a URL path.
+
+    @param key: The C{unicode} key, e.g. C{u'terry'} or C{u'terry/work'}.
+    @raise ValueError: If the key has no username.
+    @return: A (who, tag) C{tuple} of C{unicode}.
+    """
+    parts = key.strip(u'/').split(u'/')
+    if not parts[0]:
+        raise ValueError('No username in %r.' % key)
+    return parts[0], tagPath(parts[0], u'-'.join(parts[1:]))
+
+
+def describeResult(result):
+    """
+    Turn a resolved result into the JSON the API returns for it.
+
+    @param result: The (kind, value) result tuple.
+    @return: A C{dict} with a C{status} key, and a C{url}, C{urls} or
+        C{about} key, depending on the status.
+    """
+    kind, value = result
+    description = {'status': kind}
+    if kind == REDIRECT:
+        description['url'] = value
+    elif kind == MULTIPLE_PAGES:
+        description['urls'] = value
+    elif kind == NOT_A_URL:
+        description['about'] = value
+    return description
+
+
+class Api(resource.Resource):
+    """
+    Resolve one or many lookup keys, each of the form C{user[/variant]},
+    and report the results as JSON, so that clients need not follow
+    redirects or scrape pages. Keys are given as C{key} arguments to a GET
+    request (e.g. C{/_api_?key=terry&key=sally/work}), or as a JSON object
+    with a C{keys} list in the body of a POST request. The response is a
+    JSON object mapping each key to a description of its result, as made
+    by L{describeResult}.
+
+    @param resolver: The L{lastpage.resolver.Resolver} to resolve keys
+        with.
+    @param maxKeys: The C{int} largest number of keys in one request.
+    @param limit: A callable taking a request and a number of keys, which
+        spends that many lookups from the client's budget and returns
+        C{None} if it may go ahead, else a resource to refuse the request
+        with. If C{None}, lookups are unlimited.
+    """
+    allowedMethods = ('GET', 'POST')
+    isLeaf = True
+
+    def __init__(self, resolver, maxKeys, limit=None):
+        resource.Resource.__init__(self)
+        self._resolver = resolver
+        self._maxKeys = maxKeys
+        self._limit = limit
+
+    def render_GET(self, request):
+        """
+        Handle a GET request.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @return: C{server.NOT_DONE_YET}, or a C{str} error response.
+        """
+        try:
+            keys = [key.decode('utf-8')
+                    for key in request.args.get('key', [])]
+        except UnicodeDecodeError:
+            return self._badRequest(request, 'Bad UTF-8 in keys.')
+        return self._resolveKeys(keys, request)
+
+    def render_POST(self, request):
+        """
+        Handle a POST request.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @return: C{server.NOT_DONE_YET}, or a C{str} error response.
+        """
+        try:
+            keys = json.loads(request.content.read())['keys']
+            if not isinstance(keys, list):
+                raise ValueError()
+            for key in keys:
+                if not isinstance(key, unicode):
+                    raise ValueError()
+        except (ValueError, KeyError, TypeError):
+            return self._badRequest(
+                request, 'Expected a JSON object with a list of keys.')
+        return self._resolveKeys(keys, request)
+
+    def _badRequest(self, request, message):
+        """
+        Reject a request.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @param message: The C{str} reason.
+        @return: The C{str} JSON response.
+        """
+        request.setResponseCode(http.BAD_REQUEST)
+        request.setHeader('content-type', 'application/json')
+        return json.dumps({'error': message})
+
+    def _resolveKeys(self, keys, request):
+        """
+        Resolve keys and respond with their results.
+
+        @param keys: A C{list} of C{unicode} keys.
+        @param request: A twisted.web HTTP C{Request}.
+        @return: C{server.NOT_DONE_YET}, or a C{str} error response.
+        """
+        if not keys:
+            return self._badRequest(request, 'No keys given.')
+        if len(keys) > self._maxKeys:
+            return self._badRequest(
+                request, 'At most %d keys are allowed.' % self._maxKeys)
+        # Duplicate keys are resolved once.
+        keys = sorted(set(keys))
+        if self._limit is not None:
+            refusal = self._limit(request, len(keys))
+            if refusal is not None:
+                return refusal.render(request)
+        _keys.inc(len(keys))
+        lookups = []
+        for key in keys:
+            try:
+                who, tag = parseKey(key)
+            except ValueError:
+                lookups.append(defer.fail(ValueError(key)))
+            else:
+                lookups.append(self._resolver.resolve(who, tag))
+        d = defer.DeferredList(lookups, consumeErrors=True)
+        d.addCallback(self._respond, keys, request)
+        d.addErrback(logger.failure, 'api-failed')
+        return server.NOT_DONE_YET
+
+    def _respond(self, lookups, keys, request):
+        """
+        Send the results of resolving keys.
+
+        @param lookups: A C{list} of (success, result) pairs, as from a
+            C{DeferredList}, one for each key.
+        @param keys: The C{list} of C{unicode} keys.
+        @param request: A twisted.web HTTP C{Request}.
+        """
+        results = {}
+        for key, (success, result) in zip(keys, lookups):
+            if success:
+                results[key] = describeResult(result)
+            else:
+                if not result.check(ValueError):
+                    logger.failure(result, 'api-lookup-failed', key=key)
+                results[key] = {'status': ERROR}
+        request.setHeader('content-type', 'application/json')
+        # Let bookmarklets on any page use the API.
+        request.setHeader('access-control-allow-origin', '*')
+        request.write(json.dumps({'results': results}))
+        request.finish()
@@ -0,0 +1,169 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+from cStringIO import StringIO
+from gzip import GzipFile
+from hashlib import md5
+import mimetypes
+import os
+
+from twisted.web import http, resource
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Paths we serve from the top level rather than from under /static/.
+_TOP_LEVEL = ('robots.txt', 'favicon.ico')
+
+# Content types worth compressing.
+_COMPRESSIBLE = ('text/', 'application/javascript', 'application/json',
+                 'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon')
+
+
+def _gzip(data):
+    """
+    Compress data with gzip.
+
+    @param data: The C{str} to compress.
+    @return: The compressed C{str}.
+    """
+    buf = StringIO()
+    gzipFile = GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+    gzipFile.write(data)
+    gzipFile.close()
+    return buf.getvalue()
+
+
+def _acceptedEncodings(request):
+    """
+    Find out which content codings a client will accept.
+
+    @param request: A twisted.web HTTP C{Request}.
+    @return: A C{set} of the C{str} content codings the client accepts.
+    """
+    header = request.getHeader('accept-encoding')
+    if not header:
+        return set()
+    accepted = set()
+    for coding in header.split(','):
+        parts = coding.strip().split(';')
+        name = parts[0].strip().lower()
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    if float(param[2:]) == 0:
+                        break
+                except ValueError:
+                    break
+        else:
+            accepted.add(name)
+    return accepted
+
+
+class StaticFile(resource.Resource):
+    """
+    A static file held in memory, along with compressed variants of it,
+    served with long-lived cache headers and answering conditional GETs.
+
+    @param path: The C{str} path of the file to serve.
+    @param maxAge: The C{int} number of seconds clients may cache the file.
+    """
+    allowedMethods = ('GET', 'HEAD')
+    isLeaf = True
+
+    def __init__(self, path, maxAge):
+        resource.Resource.__init__(self)
+        with open(path, 'rb') as f:
+            data = f.read()
+        self._contentType = (mimetypes.guess_type(path)[0] or
+                             'application/octet-stream')
+        self._cacheControl = 'public, max-age=%d' % maxAge
+        self._lastModified = int(os.path.getmtime(path))
+        digest = md5(data).hexdigest()
+        # Each variant is an (encoding, etag, body) tuple, in order of
+        # preference.
+        self._variants = []
+        if self._contentType.startswith(_COMPRESSIBLE):
+            compressors = [('gzip', _gzip)]
+            if brotli is not None:
+                compressors.insert(0, ('br', brotli.compress))
+            for encoding, compress in compressors:
+                compressed = compress(data)
+                # Only bother if it saves something worthwhile.
+                if len(compressed) < len(data) * 0.9:
+                    self._variants.append(
+                        (encoding, '"%s-%s"' % (digest, encoding),
+                         compressed))
+        self._identity = (None, '"%s"' % digest, data)
+
+    def render_GET(self, request):
+        """
+        Handle a GET request.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @return: The C{str} file contents, or an empty C{str} if the client
+            already has them.
+        """
+        encoding, etag, body = self._identity
+        if self._variants:
+            request.setHeader('vary', 'Accept-Encoding')
+            accepted = _acceptedEncodings(request)
+            for variant in self._variants:
+                if variant[0] in accepted:
+                    encoding, etag, body = variant
+                    break
+        request.setHeader('content-type', self._contentType)
+        request.setHeader('cache-control', self._cacheControl)
+        # If-Modified-Since is only used when there is no If-None-Match
+        # (RFC 7232, section 3.3), so a client with another encoding's
+        # copy is not told it is still good.
+        if request.getHeader('if-none-match') is None:
+            request.setETag(etag)
+            cached = request.setLastModified(self._lastModified)
+        else:
+            request.setHeader('last-modified',
+                              http.datetimeToString(self._lastModified))
+            cached = request.setETag(etag)
+        if cached == http.CACHED:
+            return ''
+        if encoding is not None:
+            request.setHeader('content-encoding', encoding)
+        request.setHeader('content-length', str(len(body)))
+        return body
+
+
+def loadStaticFiles(directory, maxAge):
+    """
+    Load all the files in a directory into memory, ready to be served.
+
+    @param directory: The C{str} path of the directory holding the files.
+    @param maxAge: The C{int} number of seconds clients may cache a file.
+    @return: A C{dict} mapping C{str} request paths to L{StaticFile}
+        resources. A file is served from under /static/, and also from the
+        top level if it is something like robots.txt that clients look for
+        there.
+    """
+    files = {}
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        staticFile = StaticFile(path, maxAge)
+        files['/static/' + name] = staticFile
+        if name in _TOP_LEVEL:
+            files['/' + name] = staticFile
+    return files
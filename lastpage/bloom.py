@@ -0,0 +1,64 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+from hashlib import md5
+import math
+import struct
+
+
+class BloomFilter(object):
+    """
+    A fixed-size set that can tell for sure that an item was never added,
+    but may wrongly claim that an item was added.
+
+    @param capacity: The C{int} number of items the filter is sized for.
+    @param errorRate: The C{float} chance of a wrong claim of membership
+        once C{capacity} items have been added.
+    """
+
+    def __init__(self, capacity, errorRate=0.01):
+        capacity = max(capacity, 1)
+        nBits = int(-capacity * math.log(errorRate) / (math.log(2) ** 2))
+        self._nBits = max(nBits, 8)
+        self._nHashes = max(int(round(
+            self._nBits / float(capacity) * math.log(2))), 1)
+        self._bits = bytearray((self._nBits + 7) // 8)
+
+    def _positions(self, item):
+        """
+        Find the bit positions for an item, using double hashing.
+
+        @param item: The C{unicode} or C{str} item.
+        @return: A generator of C{int} bit positions.
+        """
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', md5(item).digest())
+        for i in xrange(self._nHashes):
+            yield (h1 + i * h2) % self._nBits
+
+    def add(self, item):
+        """
+        Add an item to the filter.
+
+        @param item: The C{unicode} or C{str} item.
+        """
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        for position in self._positions(item):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
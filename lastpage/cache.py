@@ -0,0 +1,180 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+from collections import OrderedDict
+
+
+class ResultCache(object):
+    """
+    A bounded cache of resolved tag results, with least recently used
+    eviction and a time to live on each entry.
+
+    @param maxSize: The C{int} maximum number of entries to hold.
+    @param ttl: The C{int} number of seconds an entry stays fresh.
+    @param staleTTL: The C{int} number of seconds after it expires that an
+        entry may still be served while it is being refreshed.
+    @param clock: An C{IReactorTime} provider, used to find out the
+        current time. If C{None}, the global reactor is used.
+    """
+
+    def __init__(self, maxSize, ttl, staleTTL=0, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._maxSize = maxSize
+        self._ttl = ttl
+        self._staleTTL = staleTTL
+        self._clock = clock
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.staleHits = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        """
+        Get the keys of all entries, fresh or not.
+
+        @return: A C{list} of C{unicode} tag paths.
+        """
+        return self._entries.keys()
+
+    def entries(self):
+        """
+        Get all entries, fresh or not, least recently used first.
+
+        @return: A C{list} of (key, expiry time, value) C{tuple}s.
+        """
+        return [(key, expires, value)
+                for key, (expires, value) in self._entries.iteritems()]
+
+    def restore(self, key, value, expires):
+        """
+        Put back an entry saved earlier, keeping its expiry time. Entries
+        too old to be served even while stale are not restored, nor are
+        entries for keys that already have one, which must be newer.
+
+        @param key: The C{unicode} tag path the value is for.
+        @param value: The cached value.
+        @param expires: The C{float} time the entry stops being fresh.
+        @return: C{True} if the entry was restored.
+        """
+        if (key in self._entries or self._maxSize <= 0 or
+                expires + self._staleTTL <= self._clock.seconds()):
+            return False
+        while len(self._entries) >= self._maxSize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        self._entries[key] = (expires, value)
+        return True
+
+    def get(self, key):
+        """
+        Look up a fresh cached value.
+
+        @param key: The C{unicode} tag path to look up.
+        @return: The cached value, or C{None} if C{key} is not in the cache
+            or its entry has expired.
+        """
+        try:
+            expires, value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Re-insert the entry so it becomes the most recently used. Expired
+        # entries are kept too, so they can still be served while stale.
+        self._entries[key] = (expires, value)
+        if expires <= self._clock.seconds():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def getStale(self, key):
+        """
+        Look up a cached value that may have expired, so long as it expired
+        no more than C{staleTTL} seconds ago.
+
+        @param key: The C{unicode} tag path to look up.
+        @return: The cached value, or C{None} if C{key} is not in the cache
+            or its entry is too old to be served.
+        """
+        try:
+            expires, value = self._entries[key]
+        except KeyError:
+            return None
+        if expires + self._staleTTL <= self._clock.seconds():
+            return None
+        self.staleHits += 1
+        return value
+
+    def getLast(self, key):
+        """
+        Look up a cached value, however old it is. This is for use when
+        there is no way to get a fresh value.
+
+        @param key: The C{unicode} tag path to look up.
+        @return: The cached value, or C{None} if C{key} is not in the cache.
+        """
+        try:
+            return self._entries[key][1]
+        except KeyError:
+            return None
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value, evicting the least recently used entry if the cache
+        is full.
+
+        @param key: The C{unicode} tag path the value is for.
+        @param value: The value to cache.
+        @param ttl: The C{int} number of seconds the entry stays fresh, or
+            C{None} to use the cache's usual time to live.
+        """
+        self._entries.pop(key, None)
+        while self._entries and len(self._entries) >= self._maxSize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        if self._maxSize > 0:
+            if ttl is None:
+                ttl = self._ttl
+            self._entries[key] = (self._clock.seconds() + ttl, value)
+
+    def delete(self, key):
+        """
+        Remove an entry from the cache, if it is present.
+
+        @param key: The C{unicode} tag path to forget.
+        """
+        self._entries.pop(key, None)
+
+    def stats(self):
+        """
+        Get the cache's counters.
+
+        @return: A C{dict} with C{size}, C{hits}, C{misses}, C{staleHits}
+            and C{evictions} keys.
+        """
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'staleHits': self.staleHits,
+            'evictions': self.evictions,
+        }
@@ -13,95 +13,307 @@
 # permissions and limitations under the License.
 
 import json
+import sqlite3
 import uuid
 
-from oauth.oauth import (
-    OAuthToken, OAuthRequest, OAuthConsumer, OAuthSignatureMethod_HMAC_SHA1)
+from oauth.oauth import OAuthToken, OAuthRequest, OAuthConsumer
 
-from twisted.python import log
-from twisted.web import resource, client, server
+from twisted.internet import defer
+from twisted.web import http, resource, server
+from twisted.web.error import Error
+
+from lastpage.eventlog import logger, requestId
+from lastpage.metrics import registry
+from lastpage.resilience import UNAVAILABLE, isBackendFailure
+from lastpage.session import SessionRecord
+from lastpage.store import sessionStoreErrors
+from lastpage.twitter import oauthSteps, signRequest
+
+_ACCESS_TOKEN_STEP = oauthSteps.labels('access_token')
+_VERIFY_CREDENTIALS_STEP = oauthSteps.labels('verify_credentials')
+_logins = registry.counter(
+    'lastpage_logins_total', 'Completed and failed logins, by outcome.',
+    ('outcome',))
+
+
+class CallbackError(Exception):
+    """
+    A callback request from Twitter's OAuth endpoint cannot be used.
+    """
 
 
 class Callback(resource.Resource):
     """
-    Handles a callback requests from Twitter's OAuth endpoint.
+    Handles a callback requests from Twitter's OAuth endpoint, completing
+    a login. This is a pipeline of steps:
+
+      1. Check the callback's arguments and claim its request token.
+      2. Exchange the request token for an access token.
+      3. Get the user's profile, from the cache of verified profiles if
+         they have logged in before, else with verify-credentials.
+      4. Start a session for the user and redirect them.
 
-    @param cookieDict: A C{dict} mapping cookie values to Twitter usernames.
-    @param oauthTokenDict: A C{dict} mapping OAuth keys to tokens.
-    @param conf: A L{config.Config} instance holding configuration
-        settings.
+    Each call to Twitter goes through the Twitter L{Backend} (with its
+    deadline, retries and circuit breaker), and the login as a whole has a
+    deadline. Every outcome gets a response: failures get an error status
+    and a short explanation rather than leaving the browser waiting.
+
+    @param sessions: The L{lastpage.store.ISessionStore} holding logged-in
+        user sessions.
+    @param tokens: The L{lastpage.store.ITokenStore} holding pending OAuth
+        request tokens.
+    @param config: The L{lastpage.reload.LiveConfig} holding the current
+        configuration settings.
+    @param httpClient: The L{lastpage.httpclient.HTTPClient} to make
+        requests to Twitter with.
+    @param twitter: The L{lastpage.resilience.Backend} for Twitter.
+    @param templates: The L{lastpage.render.Templates} to render the
+        internal error page with.
+    @param profiles: A L{lastpage.cache.ResultCache} of the
+        L{SessionRecord}s of verified users, keyed by access token.
+    @param clock: An C{IReactorTime} provider, used to enforce the login
+        deadline. If C{None}, the global reactor is used.
     """
     isLeaf = True
 
-    def __init__(self, cookieDict, oauthTokenDict, conf):
-        self._conf = conf
-        self._cookieDict = cookieDict
-        self._oauthTokenDict = oauthTokenDict
+    def __init__(self, sessions, tokens, config, httpClient, twitter,
+                 templates, profiles, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._config = config
+        self._httpClient = httpClient
+        self._sessions = sessions
+        self._tokens = tokens
+        self._twitter = twitter
+        self._templates = templates
+        self._profiles = profiles
+        self._clock = clock
 
     def render_GET(self, request):
         """
         Handles a callback GET request.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @return: C{server.NOT_DONE_YET}, or a C{str} error response.
         """
-        log.err('Callback received: %s' % request)
+        logger.debug('callback', uri=request.uri)
+        try:
+            token, verifier = self._checkCallback(request)
+        except CallbackError, e:
+            logger.warning('callback-rejected', reason=str(e),
+                           uri=request.uri)
+            _logins.labels('rejected').inc()
+            return self._errorResponse(request, http.BAD_REQUEST,
+                                       'Bad login callback: %s' % e)
 
-        oauthToken = request.args['oauth_token']
-        if oauthToken:
-            oauthToken = oauthToken[0]
-        else:
-            log.err('Received callback with no oauth_token: %s' % request)
-            raise Exception('Received callback with no oauth_token.')
+        # Use the same settings for every step of the login.
+        conf = self._config.current
+        consumer = OAuthConsumer(conf.consumer_key, conf.consumer_secret)
+        d = self._twitter.call(self._getAccessToken, conf, consumer, token,
+                               verifier)
+        _ACCESS_TOKEN_STEP.timeDeferred(d)
+        d.addCallback(self._getProfile, conf, consumer)
+        d.addCallback(self._startSession, conf, request)
 
-        oauthVerifier = request.args['oauth_verifier']
-        if oauthVerifier:
-            oauthVerifier = oauthVerifier[0]
-        else:
-            log.err('Received callback with no oauth_verifier: %s' % request)
-            raise Exception('Received callback with no oauth_verifier.')
+        gone = []
+
+        def _clientGone(_):
+            gone.append(True)
+            d.cancel()
 
+        deadline = self._clock.callLater(conf.login_deadline, d.cancel)
+
+        def _stopDeadline(result):
+            if deadline.active():
+                deadline.cancel()
+            return result
+
+        request.notifyFinish().addErrback(_clientGone)
+        d.addBoth(_stopDeadline)
+        d.addErrback(self._failed, request, gone)
+        d.addErrback(logger.failure, 'callback-failed')
+        return server.NOT_DONE_YET
+
+    def _checkCallback(self, request):
+        """
+        Check the arguments of a callback request, and claim the request
+        token it is for, so that it cannot be used again.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @raise CallbackError: If the request cannot be used.
+        @return: A (C{OAuthToken} request token, C{str} verifier)
+            C{tuple}.
+        """
+        oauthToken = request.args.get('oauth_token', [''])[0]
+        if not oauthToken:
+            raise CallbackError('no oauth_token')
+        oauthVerifier = request.args.get('oauth_verifier', [''])[0]
+        if not oauthVerifier:
+            raise CallbackError('no oauth_verifier')
         try:
-            token = self._oauthTokenDict.pop(oauthToken)
+            token = self._tokens.consume(oauthToken)
         except KeyError:
-            log.err('Received callback with unknown oauth_token: %s' %
-                    oauthToken)
-            raise Exception('Received callback with unknown oauth_token.')
+            raise CallbackError('unknown oauth_token')
+        return token, oauthVerifier
 
-        conf = self._conf
-        consumer = OAuthConsumer(conf.consumer_key, conf.consumer_secret)
+    def _getAccessToken(self, conf, consumer, token, verifier):
+        """
+        Exchange a request token for an access token. Each attempt is
+        signed afresh, so that a retry has its own nonce and timestamp.
+
+        @param conf: The L{lastpage.config.Config} to use.
+        @param consumer: Our C{OAuthConsumer}.
+        @param token: The C{OAuthToken} request token.
+        @param verifier: The C{str} OAuth verifier from the callback.
+        @return: A C{Deferred} that fires with the C{OAuthToken} access
+            token.
+        """
         oaRequest = OAuthRequest.from_consumer_and_token(
-            consumer, token=token, verifier=oauthVerifier,
+            consumer, token=token, verifier=verifier,
             http_url=conf.access_token_url)
-        oaRequest.sign_request(
-            OAuthSignatureMethod_HMAC_SHA1(), consumer, token)
-        log.msg('Requesting access token.')
-        d = client.getPage(oaRequest.to_url(), headers=oaRequest.to_header())
-        d.addCallback(self._storeAccessToken, request)
-        d.addErrback(log.err)
-        return server.NOT_DONE_YET
+        logger.debug('access-token-request')
+        d = signRequest(oaRequest, consumer, token, conf.oauth_sign_in_thread)
+        d.addCallback(lambda oaRequest: self._httpClient.getPage(
+            oaRequest.to_url(), headers=oaRequest.to_header()))
+        d.addCallback(OAuthToken.from_string)
+        return d
 
-    def _storeAccessToken(self, result, request):
-        accessToken = OAuthToken.from_string(result)
-        log.msg('Got access token: %s' % accessToken)
-        conf = self._conf
-        consumer = OAuthConsumer(conf.consumer_key, conf.consumer_secret)
+    def _getProfile(self, accessToken, conf, consumer):
+        """
+        Get the profile of the user who has logged in, from the cache if
+        it has been verified before with the same access token (Twitter
+        gives a user the same one each time they log in), else with
+        verify-credentials. Only the parts of it we use are kept.
+
+        @param accessToken: The user's C{OAuthToken} access token.
+        @param conf: The L{lastpage.config.Config} to use.
+        @param consumer: Our C{OAuthConsumer}.
+        @return: A C{Deferred} that fires with the user's
+            L{SessionRecord}.
+        """
+        key = (accessToken.key, accessToken.secret)
+        record = self._profiles.get(key)
+        if record is not None:
+            return defer.succeed(record)
+
+        def _verified(result):
+            record = SessionRecord.fromProfile(json.loads(result),
+                                               accessToken)
+            self._profiles.set(key, record)
+            return record
+
+        d = self._twitter.call(self._verifyCredentials, conf, consumer,
+                               accessToken)
+        _VERIFY_CREDENTIALS_STEP.timeDeferred(d)
+        d.addCallback(_verified)
+        return d
+
+    def _verifyCredentials(self, conf, consumer, accessToken):
+        """
+        Ask Twitter who the user with an access token is.
+
+        @param conf: The L{lastpage.config.Config} to use.
+        @param consumer: Our C{OAuthConsumer}.
+        @param accessToken: The user's C{OAuthToken} access token.
+        @return: A C{Deferred} that fires with the C{str} JSON response.
+        """
         oaRequest = OAuthRequest.from_consumer_and_token(
             consumer, token=accessToken,
             http_url=conf.verify_credentials_url)
-        oaRequest.sign_request(
-            OAuthSignatureMethod_HMAC_SHA1(), consumer, accessToken)
-        log.msg('Verifying credentials.')
-        d = client.getPage(oaRequest.to_url())
-        d.addCallback(self._storeUser, accessToken, request)
-        d.addErrback(log.err)
+        logger.debug('verify-credentials')
+        d = signRequest(oaRequest, consumer, accessToken,
+                        conf.oauth_sign_in_thread)
+        d.addCallback(
+            lambda oaRequest: self._httpClient.getPage(oaRequest.to_url()))
         return d
 
-    def _storeUser(self, result, accessToken, request):
-        user = json.loads(result)
+    def _startSession(self, record, conf, request):
+        """
+        Start a session for a user who has logged in, and send them on to
+        the logged-in page.
+
+        @param record: The user's L{SessionRecord}.
+        @param conf: The L{lastpage.config.Config} to use.
+        @param request: A twisted.web HTTP C{Request}.
+        """
         key = str(uuid.uuid4())
-        conf = self._conf
-        self._cookieDict[key] = (user, accessToken)
-        log.msg('Setting cookie %s' % key)
+        self._sessions.set(key, record)
+        logger.info('login', user=record.screenName)
+        _logins.labels('success').inc()
         request.addCookie(conf.cookie_name, key, path='/',
-                          domain=conf.cookie_domain)
+                          domain=conf.cookie_domain,
+                          max_age=str(conf.session_ttl))
         request.redirect(conf.logged_in_redirect_url)
-        log.msg('Redirecting to %s' % conf.logged_in_redirect_url)
+        request.finish()
+
+    def _failed(self, fail, request, gone):
+        """
+        Tell the user their login failed, and why, as best we can.
+
+        @param fail: The C{Failure} of the login.
+        @param request: A twisted.web HTTP C{Request}.
+        @param gone: A C{list} that is not empty if the client has gone
+            away.
+        """
+        if gone:
+            logger.info('callback-abandoned')
+            _logins.labels('abandoned').inc()
+            return
+        if fail.check(defer.CancelledError):
+            logger.warning('callback-timed-out')
+            _logins.labels('timeout').inc()
+            self._finishError(request, http.GATEWAY_TIMEOUT,
+                              'Logging in with Twitter took too long. '
+                              'Please try again.')
+        elif fail.check(Error) and not isBackendFailure(fail):
+            logger.warning('callback-refused', status=fail.value.status)
+            _logins.labels('refused').inc()
+            self._finishError(request, http.FORBIDDEN,
+                              'Twitter did not accept the login. '
+                              'Please try again.')
+        elif fail.check(sqlite3.OperationalError):
+            logger.warning('session-set-failed',
+                           error=fail.getErrorMessage())
+            sessionStoreErrors.labels('set').inc()
+            _logins.labels('unavailable').inc()
+            self._finishError(request, http.SERVICE_UNAVAILABLE,
+                              'We could not log you in just now. '
+                              'Please try again.')
+        elif fail.check(Error, *UNAVAILABLE):
+            logger.warning('callback-unavailable',
+                           error=fail.getErrorMessage())
+            _logins.labels('unavailable').inc()
+            self._finishError(request, http.SERVICE_UNAVAILABLE,
+                              'Twitter is not answering at the moment. '
+                              'Please try again later.')
+        else:
+            _id = requestId()
+            logger.failure(fail, 'callback-failed', id=_id)
+            _logins.labels('error').inc()
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            request.write(self._templates.errorPage(_id))
+            request.finish()
+
+    def _errorResponse(self, request, code, message):
+        """
+        Prepare a short error response.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @param code: The C{int} HTTP status code.
+        @param message: The C{str} explanation.
+        @return: The C{str} response body.
+        """
+        request.setResponseCode(code)
+        request.setHeader('content-type', 'text/plain')
+        return message + '\n'
+
+    def _finishError(self, request, code, message):
+        """
+        Send a short error response.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @param code: The C{int} HTTP status code.
+        @param message: The C{str} explanation.
+        """
+        request.write(self._errorResponse(request, code, message))
         request.finish()
@@ -1,29 +1,229 @@
-from ConfigParser import ConfigParser
+from ConfigParser import ConfigParser, Error
+
+from lastpage.eventlog import LEVELS, parseSampleRates
+
+
+class ConfigError(Exception):
+    """
+    A config file could not be read, or has a bad setting in it.
+    """
 
 
 class Config(object):
     """
     Read a lastpage.me config file and provide easy access to its contents.
+    A L{Config} is an immutable snapshot of the file, so code holding one
+    never sees a mix of old and new settings.
 
     @param file: The config file to read.
+    @raise ConfigError: If the file cannot be read, or a setting is bad.
     """
 
     _SECTION = 'lastpage'
+    _DEFAULTS = {
+        'admin_port': '0',
+        'admin_secret': '',
+        'api_max_keys': '100',
+        'backend_max_concurrent': '50',
+        'backend_retries': '2',
+        'backend_timeout': '5',
+        'breaker_reset_timeout': '30',
+        'breaker_threshold': '5',
+        'cache_size': '10000',
+        'cache_snapshot_file': '',
+        'cache_snapshot_interval': '300',
+        'cache_ttl': '300',
+        'cache_stale_ttl': '3600',
+        'config_check_interval': '5',
+        'filesystem_root_dir': 'static',
+        'http_idle_timeout': '240',
+        'http_max_per_host': '50',
+        'known_users_capacity': '1000000',
+        'log_buffer_size': '10000',
+        'log_file': '',
+        'log_flush_interval': '1',
+        'log_level': 'info',
+        'log_sample_rates': 'redirect:0.1',
+        'login_deadline': '15',
+        'multiple_pages_page_size': '100',
+        'negative_cache_size': '10000',
+        'negative_cache_ttl': '60',
+        'oauth_sign_in_thread': 'False',
+        'oauth_token_expire_interval': '60',
+        'oauth_token_max': '10000',
+        'oauth_token_ttl': '900',
+        'profile_cache_size': '10000',
+        'profile_cache_ttl': '3600',
+        'rate_limit_callback_burst': '10',
+        'rate_limit_callback_rate': '0',
+        'rate_limit_cleanup_interval': '60',
+        'rate_limit_login_burst': '10',
+        'rate_limit_login_rate': '0',
+        'rate_limit_lookup_burst': '100',
+        'rate_limit_lookup_rate': '0',
+        'rendered_page_cache_size': '1000',
+        'resolve_whole_user': 'False',
+        'retry_budget_ratio': '0.1',
+        'session_expire_batch': '1000',
+        'session_expire_interval': '600',
+        'session_max': '100000',
+        'session_store': 'memory',
+        'session_ttl': '2592000',
+        'shutdown_drain_timeout': '30',
+        'static_max_age': '86400',
+        'store_path': 'lastpage.db',
+        'stream_chunk_size': '8192',
+        'trusted_proxies': '127.0.0.1 ::1',
+        'warmup_concurrency': '10',
+        'warmup_file': '',
+        'warmup_max': '1000',
+    }
     _NON_STRING_VARS = {
+        'admin_port': int,
+        'api_max_keys': int,
+        'backend_max_concurrent': int,
+        'backend_retries': int,
+        'backend_timeout': float,
+        'breaker_reset_timeout': int,
+        'breaker_threshold': int,
+        'cache_size': int,
+        'cache_snapshot_interval': int,
+        'cache_stale_ttl': int,
+        'cache_ttl': int,
+        'config_check_interval': int,
+        'http_idle_timeout': int,
+        'http_max_per_host': int,
+        'known_users_capacity': int,
+        'local_fluidinfo_port': int,
         'local_oauth_port': int,
+        'log_buffer_size': int,
+        'log_flush_interval': float,
+        'login_deadline': float,
+        'multiple_pages_page_size': int,
+        'negative_cache_size': int,
+        'negative_cache_ttl': int,
         'noisy_logging': bool,
+        'oauth_sign_in_thread': bool,
+        'oauth_token_expire_interval': int,
+        'oauth_token_max': int,
+        'oauth_token_ttl': int,
         'port': int,
+        'profile_cache_size': int,
+        'profile_cache_ttl': int,
         'promiscuous': bool,
+        'rate_limit_callback_burst': int,
+        'rate_limit_callback_rate': float,
+        'rate_limit_cleanup_interval': int,
+        'rate_limit_login_burst': int,
+        'rate_limit_login_rate': float,
+        'rate_limit_lookup_burst': int,
+        'rate_limit_lookup_rate': float,
+        'rendered_page_cache_size': int,
+        'resolve_whole_user': bool,
+        'retry_budget_ratio': float,
         'serve_static_files': bool,
+        'session_expire_batch': int,
+        'session_expire_interval': int,
+        'session_max': int,
+        'session_ttl': int,
+        'shutdown_drain_timeout': float,
+        'static_max_age': int,
+        'stream_chunk_size': int,
+        'warmup_concurrency': int,
+        'warmup_max': int,
     }
 
+    # Settings that are only used when the service starts, so changing
+    # them needs a restart. All others take effect when the file is
+    # reloaded.
+    RESTART_REQUIRED = frozenset([
+        'admin_port', 'admin_secret', 'api_max_keys', 'backend_max_concurrent',
+        'backend_retries', 'backend_timeout', 'breaker_reset_timeout',
+        'breaker_threshold', 'cache_size', 'cache_snapshot_file',
+        'cache_snapshot_interval', 'cache_stale_ttl', 'cache_ttl',
+        'config_check_interval', 'filesystem_root_dir', 'http_idle_timeout',
+        'http_max_per_host', 'known_users_capacity', 'local_fluidinfo_port',
+        'local_oauth_port', 'log_file', 'log_flush_interval',
+        'negative_cache_size', 'negative_cache_ttl',
+        'oauth_token_expire_interval', 'oauth_token_max', 'oauth_token_ttl',
+        'port', 'profile_cache_size', 'profile_cache_ttl',
+        'rate_limit_callback_burst', 'rate_limit_callback_rate',
+        'rate_limit_cleanup_interval', 'rate_limit_login_burst',
+        'rate_limit_login_rate', 'rate_limit_lookup_burst',
+        'rate_limit_lookup_rate', 'rendered_page_cache_size',
+        'resolve_whole_user', 'retry_budget_ratio', 'serve_static_files',
+        'session_expire_batch', 'session_expire_interval', 'session_max',
+        'session_store', 'session_ttl', 'shutdown_drain_timeout',
+        'static_max_age', 'store_path', 'warmup_concurrency', 'warmup_file',
+        'warmup_max'])
+
     def __init__(self, file):
-        config = ConfigParser()
-        config.read([file])
-        for var, value in config.items(self._SECTION):
+        config = ConfigParser(self._DEFAULTS)
+        if not config.read([file]):
+            raise ConfigError('Could not read %s.' % file)
+        try:
+            items = config.items(self._SECTION)
+        except Error, e:
+            raise ConfigError('%s: %s' % (file, e))
+        for var, value in items:
             varType = self._NON_STRING_VARS.get(var, str)
-            if varType is int:
-                value = config.getint(self._SECTION, var)
-            elif varType is bool:
-                value = config.getboolean(self._SECTION, var)
-            setattr(self, var, value)
+            try:
+                if varType is int:
+                    value = config.getint(self._SECTION, var)
+                elif varType is float:
+                    value = config.getfloat(self._SECTION, var)
+                elif varType is bool:
+                    value = config.getboolean(self._SECTION, var)
+            except (Error, ValueError), e:
+                raise ConfigError('%s: bad %s: %s' % (file, var, e))
+            object.__setattr__(self, var, value)
+        self._validate(file)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Config settings cannot be changed.')
+
+    def _validate(self, file):
+        """
+        Check that settings are usable.
+
+        @param file: The config file that was read.
+        @raise ConfigError: If a setting is bad.
+        """
+        if self.log_level not in LEVELS:
+            raise ConfigError('%s: unknown log_level %r.' %
+                              (file, self.log_level))
+        try:
+            parseSampleRates(self.log_sample_rates)
+        except ValueError:
+            raise ConfigError('%s: bad log_sample_rates %r.' %
+                              (file, self.log_sample_rates))
+        if self.session_store not in ('memory', 'sqlite'):
+            raise ConfigError('%s: unknown session_store %r.' %
+                              (file, self.session_store))
+        if self.stream_chunk_size < 1:
+            raise ConfigError('%s: stream_chunk_size must be positive.' %
+                              file)
+        if self.http_max_per_host < self.backend_max_concurrent:
+            # Otherwise backend calls would wait for a connection slot
+            # inside their deadline, and time out while the backend is
+            # healthy.
+            raise ConfigError('%s: http_max_per_host must be at least '
+                              'backend_max_concurrent.' % file)
+        if self.login_deadline <= 0:
+            raise ConfigError('%s: login_deadline must be positive.' % file)
+        for var in ('multiple_pages_page_size', 'rate_limit_callback_rate',
+                    'rate_limit_login_rate', 'rate_limit_lookup_rate'):
+            if getattr(self, var) < 0:
+                raise ConfigError('%s: %s cannot be negative.' % (file, var))
+
+    def changes(self, other):
+        """
+        Find the settings that differ from those of another snapshot.
+
+        @param other: Another L{Config}.
+        @return: A sorted C{list} of the C{str} names of the settings.
+        """
+        names = set(vars(self)) | set(vars(other))
+        return sorted(name for name in names
+                      if getattr(self, name, None) !=
+                      getattr(other, name, None))
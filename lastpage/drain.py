@@ -0,0 +1,229 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+from twisted.application import service
+from twisted.internet import defer
+from twisted.web import http, server
+
+from lastpage.eventlog import logger
+
+
+class _TrackedChannel(http.HTTPChannel):
+    """
+    An HTTP connection that tells its L{DrainingSite} when it opens and
+    closes.
+    """
+
+    def connectionMade(self):
+        http.HTTPChannel.connectionMade(self)
+        self.site.connectionOpened(self)
+
+    def connectionLost(self, reason):
+        http.HTTPChannel.connectionLost(self, reason)
+        self.site.connectionClosed(self)
+
+
+class _TrackedRequest(server.Request):
+    """
+    A request that tells its L{DrainingSite} when it starts and finishes.
+    """
+
+    def process(self):
+        site = self.channel.site
+        site.requestStarted(self)
+        self.notifyFinish().addBoth(lambda _: site.requestFinished(self))
+        server.Request.process(self)
+
+
+class DrainingSite(server.Site):
+    """
+    A site that keeps track of its connections and the requests it is
+    serving (including those whose resources returned C{NOT_DONE_YET} and
+    are waiting on Fluidinfo or Twitter), so that shutting down can wait
+    for the requests to be answered.
+
+    @param resource: The root resource.
+    @param clock: An C{IReactorTime} provider, used to time out draining.
+        If C{None}, the global reactor is used.
+    """
+    protocol = _TrackedChannel
+    requestFactory = _TrackedRequest
+
+    def __init__(self, resource, clock=None, **kwargs):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        server.Site.__init__(self, resource, **kwargs)
+        self._clock = clock
+        self._connections = set()
+        self._inFlight = set()
+        self._drained = []
+        self.draining = False
+
+    def inFlight(self):
+        """
+        Count the requests being served.
+
+        @return: The C{int} number of requests.
+        """
+        return len(self._inFlight)
+
+    def connectionOpened(self, channel):
+        """
+        Note that a connection has been made.
+
+        @param channel: The L{_TrackedChannel}.
+        """
+        self._connections.add(channel)
+
+    def connectionClosed(self, channel):
+        """
+        Note that a connection has closed. Once all connections have closed
+        while draining, draining is finished.
+
+        @param channel: The L{_TrackedChannel}.
+        """
+        self._connections.discard(channel)
+        if not self._connections:
+            drained, self._drained = self._drained, []
+            for d in drained:
+                d.callback(0)
+
+    def requestStarted(self, request):
+        """
+        Note that a request is being served.
+
+        @param request: A twisted.web HTTP C{Request}.
+        """
+        self._inFlight.add(request)
+        if self.draining:
+            # Have the client make its next request on a new connection,
+            # to a process that is not shutting down.
+            request.channel.persistent = False
+
+    def requestFinished(self, request):
+        """
+        Note that a request has been answered, or its client has gone.
+
+        @param request: A twisted.web HTTP C{Request}.
+        """
+        self._inFlight.discard(request)
+
+    def drain(self, timeout):
+        """
+        Close idle connections, and have the others close once their
+        requests have been answered, then wait for all of them to close.
+        Waiting for the connections rather than just the requests makes
+        sure the responses have been sent.
+
+        @param timeout: The C{float} largest number of seconds to wait.
+        @return: A C{Deferred} that fires with the C{int} number of
+            requests still unfinished, which is C{0} unless the timeout
+            was reached.
+        """
+        self.draining = True
+        busy = set(request.channel for request in self._inFlight)
+        for channel in list(self._connections):
+            if channel in busy:
+                channel.persistent = False
+            else:
+                channel.transport.loseConnection()
+        if not self._connections:
+            return defer.succeed(0)
+        d = defer.Deferred()
+        self._drained.append(d)
+
+        def _timedOut():
+            self._drained.remove(d)
+            d.callback(len(self._inFlight))
+
+        call = self._clock.callLater(timeout, _timedOut)
+
+        def _finished(unfinished):
+            if call.active():
+                call.cancel()
+            return unfinished
+
+        d.addCallback(_finished)
+        return d
+
+
+class DrainingServer(service.MultiService):
+    """
+    Run a server for a L{DrainingSite} so that when it is stopped it stops
+    accepting connections at once, but waits (up to a deadline) for the
+    requests it is serving to finish.
+
+    @param server: The service that listens for connections, e.g. a
+        C{TCPServer}.
+    @param site: The L{DrainingSite} it serves.
+    @param timeout: The C{float} largest number of seconds to wait.
+    """
+
+    def __init__(self, server, site, timeout):
+        service.MultiService.__init__(self)
+        server.setServiceParent(self)
+        self._site = site
+        self._timeout = timeout
+
+    def stopService(self):
+        d = defer.maybeDeferred(service.MultiService.stopService, self)
+        d.addCallback(self._drain)
+        return d
+
+    def _drain(self, _):
+        """
+        Wait for the requests being served to finish.
+
+        @return: A C{Deferred} that fires when they have, or the deadline
+            has passed.
+        """
+        logger.info('drain-started', requests=self._site.inFlight())
+
+        def _drained(unfinished):
+            if unfinished:
+                logger.warning('drain-timed-out', unfinished=unfinished)
+            else:
+                logger.info('drain-finished')
+
+        d = self._site.drain(self._timeout)
+        d.addCallback(_drained)
+        return d
+
+
+class OrderedMultiService(service.MultiService):
+    """
+    A C{MultiService} that stops its services one at a time, in the
+    reverse of the order they were added, waiting for each to stop before
+    stopping the next. Services added first (such as the event log
+    writer) so outlast the draining of requests. A service that fails to
+    stop is logged, and the rest are still stopped.
+    """
+
+    def stopService(self):
+        service.Service.stopService(self)
+        d = defer.succeed(None)
+        for child in reversed(list(self)):
+            d.addCallback(self._stopChild, child)
+        return d
+
+    def _stopChild(self, _, child):
+        """
+        Stop a child service, logging rather than passing on any failure.
+
+        @param child: The C{IService} to stop.
+        @return: A C{Deferred} that fires when it has stopped.
+        """
+        d = defer.maybeDeferred(child.stopService)
+        d.addErrback(logger.failure, 'shutdown-failed', service=child.name)
+        return d
@@ -0,0 +1,275 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import json
+from random import random, randrange
+from time import time
+
+from twisted.application import internet
+from twisted.internet import defer, threads
+from twisted.python import failure, log
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+}
+_LEVEL_NAMES = dict((level, name) for name, level in LEVELS.iteritems())
+
+
+def requestId():
+    """
+    Make a (fairly) unique request id for matching up error pages with
+    errors in our logs.
+
+    @return: a random C{str} identifier.
+    """
+    return ''.join([chr(ord('a') + randrange(0, 26)) for i in range(16)])
+
+
+def parseSampleRates(value):
+    """
+    Parse a sample rate setting, such as C{redirect:0.01 lookup:0.1}.
+
+    @param value: The C{str} setting: space-separated event:rate pairs.
+    @raise ValueError: If the setting cannot be parsed.
+    @return: A C{dict} mapping C{str} event names to C{float} rates.
+    """
+    rates = {}
+    for pair in value.split():
+        event, rate = pair.split(':')
+        rates[event] = float(rate)
+    return rates
+
+
+def _decodeBytes(value):
+    """
+    Make a value safe to encode as JSON, replacing any bytes in it that
+    are not UTF-8 (e.g., from a request path) rather than failing.
+
+    @param value: A value, possibly a C{str}, C{list}, C{tuple} or C{dict}
+        containing C{str}s.
+    @return: The value with every C{str} in it decoded to C{unicode}.
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, (list, tuple)):
+        return [_decodeBytes(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_decodeBytes(key), _decodeBytes(item))
+                    for key, item in value.iteritems())
+    return value
+
+
+class EventLog(object):
+    """
+    Collect structured log records in memory, to be written out in batches
+    by an L{EventLogWriter}. Logging a record does no I/O, so it is cheap
+    enough to do on the request path.
+
+    @param level: The C{int} lowest level of record to keep.
+    @param sampleRates: A C{dict} mapping C{str} event names to the
+        C{float} fraction of those events to keep. Events not in it are
+        all kept.
+    @param maxBuffered: The C{int} largest number of records to hold
+        between writes. Records beyond it are dropped (and counted).
+    """
+
+    def __init__(self, level=INFO, sampleRates=None, maxBuffered=10000):
+        self.configure(level, sampleRates, maxBuffered)
+        self._records = []
+        self.dropped = 0
+
+    def configure(self, level, sampleRates=None, maxBuffered=10000):
+        """
+        Change what is logged.
+
+        @param level: The C{int} lowest level of record to keep.
+        @param sampleRates: A C{dict} mapping C{str} event names to the
+            C{float} fraction of those events to keep.
+        @param maxBuffered: The C{int} largest number of records to hold
+            between writes.
+        """
+        self.level = level
+        self._sampleRates = sampleRates or {}
+        self._maxBuffered = maxBuffered
+
+    def log(self, level, event, **fields):
+        """
+        Record an event.
+
+        @param level: The C{int} level of the event.
+        @param event: The C{str} name of the event, e.g. C{redirect}.
+        @param fields: Further JSON-encodable details of the event. A
+            C{failure} field may be a C{Failure}, whose traceback is
+            recorded.
+        """
+        if level < self.level:
+            return
+        rate = self._sampleRates.get(event)
+        if rate is not None and random() >= rate:
+            return
+        if len(self._records) >= self._maxBuffered:
+            self.dropped += 1
+            return
+        self._records.append((time(), level, event, fields))
+
+    def debug(self, event, **fields):
+        self.log(DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(ERROR, event, **fields)
+
+    def failure(self, fail, event, **fields):
+        """
+        Record a failure at the error level. This can be used as an
+        errback, in place of C{log.err}.
+
+        @param fail: The C{Failure}.
+        @param event: The C{str} name of the event.
+        @param fields: Further JSON-encodable details of the event.
+        """
+        self.log(ERROR, event, failure=fail, **fields)
+
+    def takeLines(self):
+        """
+        Take the records collected so far, encoded as JSON. Each record is
+        encoded on its own, so one that cannot be encoded costs only
+        itself.
+
+        @return: A C{list} of C{str} lines, each with a trailing newline.
+        """
+        records, self._records = self._records, []
+        lines = []
+        for when, level, event, fields in records:
+            fields['time'] = when
+            fields['level'] = _LEVEL_NAMES.get(level, level)
+            fields['event'] = event
+            fail = fields.get('failure')
+            if isinstance(fail, failure.Failure):
+                fields['failure'] = fail.getTraceback()
+            try:
+                line = json.dumps(fields, default=repr)
+            except UnicodeDecodeError:
+                line = json.dumps(_decodeBytes(fields), default=repr)
+            except Exception, e:
+                line = json.dumps({
+                    'time': when, 'level': 'error',
+                    'event': 'log-encode-failed', 'logged': event,
+                    'error': repr(e)})
+            lines.append(line + '\n')
+        return lines
+
+
+class EventLogWriter(internet.TimerService):
+    """
+    Periodically write the records collected by an L{EventLog}, in one
+    batch, either appending to a file (in a thread, so the reactor does
+    not wait on the disk) or to the Twisted log.
+
+    @param eventLog: The L{EventLog} to write records from.
+    @param interval: The C{float} number of seconds between writes.
+    @param path: The C{str} path of the file to append to, or C{None} to
+        use the Twisted log.
+    """
+
+    def __init__(self, eventLog, interval, path=None):
+        internet.TimerService.__init__(self, interval, self.write)
+        self._eventLog = eventLog
+        self._path = path
+        self._file = None
+
+    def startService(self):
+        if self._path:
+            self._file = open(self._path, 'a')
+        internet.TimerService.startService(self)
+
+    def write(self):
+        """
+        Write the records collected since the last write. This never
+        raises, since an exception would stop the timer calling it.
+
+        @return: A C{Deferred} that fires when they are written, or
+            C{None} if they were written synchronously.
+        """
+        try:
+            return self._write()
+        except Exception:
+            log.err(None, 'Writing the event log failed.')
+
+    def _write(self):
+        """
+        Write the records collected since the last write.
+
+        @return: A C{Deferred} that fires when they are written, or
+            C{None} if they were written synchronously.
+        """
+        lines = self._eventLog.takeLines()
+        if self._eventLog.dropped:
+            lines.append(json.dumps({
+                'time': time(), 'level': 'warning', 'event': 'log-dropped',
+                'count': self._eventLog.dropped}) + '\n')
+            self._eventLog.dropped = 0
+        if not lines:
+            return
+        if self._file is None:
+            log.msg(''.join(lines).rstrip('\n'))
+            return
+        d = threads.deferToThread(self._writeLines, lines)
+        d.addErrback(log.err)
+        return d
+
+    def _writeLines(self, lines):
+        """
+        Write lines to the file. Called in a thread, except at shutdown.
+
+        @param lines: A C{list} of C{str} lines.
+        """
+        self._file.write(''.join(lines))
+        self._file.flush()
+
+    def stopService(self):
+        d = defer.maybeDeferred(internet.TimerService.stopService, self)
+        d.addCallback(lambda _: self._close())
+        return d
+
+    def _close(self):
+        """
+        Write whatever is left, synchronously, since we are going away, and
+        close the file.
+        """
+        lines = self._eventLog.takeLines()
+        if self._file is None:
+            if lines:
+                log.msg(''.join(lines).rstrip('\n'))
+        else:
+            self._writeLines(lines)
+            self._file.close()
+            self._file = None
+
+
+# The event log the service logs to. It is configured at start-up.
+logger = EventLog()
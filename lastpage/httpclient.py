@@ -0,0 +1,197 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+from StringIO import StringIO
+from urlparse import urlparse
+
+from twisted.internet import defer
+from twisted.web import error
+from twisted.web.client import (
+    Agent, FileBodyProducer, HTTPConnectionPool, readBody)
+from twisted.web.http_headers import Headers
+
+from txfluiddb.client import Endpoint
+from txfluiddb.http import HTTPError
+
+from lastpage.metrics import registry
+from lastpage.resilience import isBackendFailure
+
+_fluidinfoRequests = registry.histogram(
+    'lastpage_fluidinfo_request_seconds',
+    'Time taken by requests to Fluidinfo, including any retries.')
+_fluidinfoErrors = registry.counter(
+    'lastpage_fluidinfo_errors_total',
+    'Requests to Fluidinfo that failed because of trouble with Fluidinfo '
+    '(not, e.g., a 404 for a tag that does not exist), by type of error.',
+    ('error',))
+
+
+class HTTPClient(object):
+    """
+    Make outgoing HTTP requests over a shared pool of persistent
+    connections, so that repeated requests to the same host (Fluidinfo,
+    Twitter) do not each pay for a new TCP connection.
+
+    @param maxPerHost: The C{int} maximum number of simultaneous requests
+        (and of idle persistent connections kept) per host.
+    @param idleTimeout: The C{int} number of seconds an idle persistent
+        connection is kept open.
+    @param reactor: The reactor to use. If C{None}, the global reactor is
+        used.
+    """
+
+    def __init__(self, maxPerHost, idleTimeout, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._maxPerHost = maxPerHost
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = maxPerHost
+        self._pool.cachedConnectionTimeout = idleTimeout
+        self._agent = Agent(reactor, pool=self._pool)
+        # Maps (scheme, host, port) tuples to the DeferredSemaphore that
+        # limits the number of simultaneous requests to that host.
+        self._semaphores = {}
+
+    def request(self, url, method='GET', headers=None, postdata=None):
+        """
+        Make an HTTP request.
+
+        @param url: The C{str} URL to request.
+        @param method: The C{str} HTTP method to use.
+        @param headers: A C{dict} mapping C{str} header names to C{str}
+            values, or C{None}.
+        @param postdata: A C{str} request body, or C{None}.
+        @return: A C{Deferred} that fires with a (status, headers, body)
+            tuple. The status is an C{int}, the headers are a C{dict}
+            mapping lower-cased header names to C{list}s of values (as
+            in C{twisted.web.client.HTTPClientFactory.response_headers}),
+            and the body is a C{str}.
+        """
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        try:
+            semaphore = self._semaphores[key]
+        except KeyError:
+            semaphore = self._semaphores[key] = defer.DeferredSemaphore(
+                self._maxPerHost)
+        return semaphore.run(self._request, url, method, headers, postdata)
+
+    def _request(self, url, method, headers, postdata):
+        """
+        Make an HTTP request and read its whole response body.
+
+        @param url: The C{str} URL to request.
+        @param method: The C{str} HTTP method to use.
+        @param headers: A C{dict} mapping C{str} header names to C{str}
+            values, or C{None}.
+        @param postdata: A C{str} request body, or C{None}.
+        @return: A C{Deferred} that fires with a (status, headers, body)
+            tuple, as described in L{request}.
+        """
+        requestHeaders = Headers()
+        for name, value in (headers or {}).iteritems():
+            requestHeaders.setRawHeaders(name, [value])
+        if postdata is None:
+            bodyProducer = None
+        else:
+            bodyProducer = FileBodyProducer(StringIO(postdata))
+
+        def _readBody(response):
+            responseHeaders = {}
+            for name, values in response.headers.getAllRawHeaders():
+                responseHeaders[name.lower()] = values
+            d = readBody(response)
+            d.addCallback(
+                lambda body: (response.code, responseHeaders, body))
+            return d
+
+        d = self._agent.request(method, url, requestHeaders, bodyProducer)
+        d.addCallback(_readBody)
+        return d
+
+    def getPage(self, url, method='GET', headers=None, postdata=None):
+        """
+        Get a page, in the manner of C{twisted.web.client.getPage}.
+
+        @param url: The C{str} URL to request.
+        @param method: The C{str} HTTP method to use.
+        @param headers: A C{dict} mapping C{str} header names to C{str}
+            values, or C{None}.
+        @param postdata: A C{str} request body, or C{None}.
+        @raise twisted.web.error.Error: if the response status is not 2xx.
+        @return: A C{Deferred} that fires with the C{str} response body.
+        """
+        def _checkStatus((status, responseHeaders, body)):
+            if not 200 <= status < 300:
+                raise error.Error(str(status), None, body)
+            return body
+
+        d = self.request(url, method, headers, postdata)
+        d.addCallback(_checkStatus)
+        return d
+
+    def close(self):
+        """
+        Close all idle persistent connections.
+
+        @return: A C{Deferred} that fires when the connections are closed.
+        """
+        return self._pool.closeCachedConnections()
+
+
+class PooledEndpoint(Endpoint):
+    """
+    A Fluidinfo endpoint whose requests go through a shared L{HTTPClient}.
+
+    @param httpClient: The L{HTTPClient} to make requests with.
+    @param baseURL: The C{str} base URL of the endpoint.
+    @param backend: The L{lastpage.resilience.Backend} that applies
+        deadlines, retries and a circuit breaker to requests.
+    """
+
+    def __init__(self, httpClient, baseURL, backend):
+        Endpoint.__init__(self, baseURL=baseURL)
+        self._httpClient = httpClient
+        self._backend = backend
+
+    def getPage(self, url, method='GET', postdata=None, headers=None,
+                agent=None):
+        """
+        Make a request the way C{txfluiddb.http.getPage} does, firing with a
+        (status, headers, body) tuple, or failing with C{HTTPError} if the
+        response status is not 2xx.
+        """
+        headers = dict(headers or {})
+        if agent is not None:
+            headers['User-Agent'] = agent
+
+        def _checkStatus(result):
+            status, responseHeaders, body = result
+            if not 200 <= status < 300:
+                raise HTTPError(str(status), None, body, responseHeaders)
+            return result
+
+        def _request():
+            d = self._httpClient.request(url, method, headers, postdata)
+            d.addCallback(_checkStatus)
+            return d
+
+        def _countError(fail):
+            if isBackendFailure(fail):
+                _fluidinfoErrors.labels(fail.type.__name__).inc()
+            return fail
+
+        d = _fluidinfoRequests.timeDeferred(self._backend.call(_request))
+        d.addErrback(_countError)
+        return d
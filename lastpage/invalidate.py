@@ -0,0 +1,186 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Tell a running lastpage service to invalidate (or refresh) its cached
+results for some users and tags. For example
+
+    python -m lastpage.invalidate --conf conf/local.conf --user terry \\
+        --tag sally/lastpage-work --file changed.txt --refresh
+
+Each line of a --file is a username, or a tag path if it contains a
+slash. With --workers, every worker's cache is invalidated.
+"""
+
+import json
+import sys
+
+from twisted.internet import defer, protocol
+from twisted.python import usage
+
+from lastpage import config
+from lastpage.httpclient import HTTPClient
+
+
+def readInvalidations(path):
+    """
+    Read a batch of users and tags to invalidate from a file.
+
+    @param path: The C{str} path of the file. Each line is a username, or
+        a tag path if it contains a slash. Blank lines and lines starting
+        with C{#} are skipped.
+    @return: A (users, tags) C{tuple} of C{list}s of C{unicode}.
+    """
+    users = []
+    tags = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip().decode('utf-8')
+            if not line or line.startswith(u'#'):
+                continue
+            if u'/' in line:
+                tags.append(line)
+            else:
+                users.append(line)
+    return users, tags
+
+
+class Options(usage.Options):
+    """
+    Command line options for the invalidation tool.
+    """
+    optParameters = [
+        ['conf', None, None, 'The configuration file of the service.'],
+        ['file', None, None, 'A file of users and tags to invalidate.'],
+        ['workers', None, 1,
+         'The number of worker processes the service runs.', int],
+        ]
+    optFlags = [
+        ['refresh', None,
+         'Query the tags again, rather than just forgetting them.'],
+        ]
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self['users'] = []
+        self['tags'] = []
+
+    def opt_user(self, user):
+        """
+        A user all of whose tags are to be invalidated (may be repeated).
+        """
+        self['users'].append(user.decode('utf-8'))
+
+    def opt_tag(self, tag):
+        """
+        A tag path to invalidate (may be repeated).
+        """
+        tag = tag.decode('utf-8')
+        if u'/' not in tag:
+            raise usage.UsageError('%r is not a tag path.' % tag)
+        self['tags'].append(tag)
+
+    def postOptions(self):
+        if not self['conf']:
+            raise usage.UsageError('You must use --conf config-file')
+        if self['file']:
+            users, tags = readInvalidations(self['file'])
+            self['users'].extend(users)
+            self['tags'].extend(tags)
+        if not (self['users'] or self['tags']):
+            raise usage.UsageError('Nothing to invalidate.')
+
+
+def invalidate(client, conf, workers, users, tags, refresh):
+    """
+    Ask each worker of a lastpage service to invalidate cached results.
+
+    @param client: The L{HTTPClient} to make requests with.
+    @param conf: The service's L{config.Config}.
+    @param workers: The C{int} number of worker processes it runs.
+    @param users: A C{list} of C{unicode} usernames.
+    @param tags: A C{list} of C{unicode} tag paths.
+    @param refresh: If C{True}, have the tags queried again.
+    @return: A C{Deferred} that fires with a C{list} of C{(success,
+        result)} pairs, one for each worker, where the result is a
+        (status, headers, body) tuple or a C{Failure}.
+    """
+    body = json.dumps({'users': users, 'tags': tags, 'refresh': refresh})
+    headers = {'Authorization': 'Bearer ' + conf.admin_secret,
+               'Content-Type': 'application/json'}
+    return defer.DeferredList([
+        client.request('http://localhost:%d/invalidate' %
+                       (conf.admin_port + worker),
+                       'POST', headers, body)
+        for worker in range(workers)], consumeErrors=True)
+
+
+def main(args=None):
+    """
+    Run the invalidation tool, exiting with status 1 if any worker could
+    not be told.
+
+    @param args: The C{list} of C{str} command line arguments, or C{None}
+        to use C{sys.argv}.
+    """
+    options = Options()
+    try:
+        options.parseOptions(args)
+    except usage.UsageError, e:
+        print >>sys.stderr, '%s: %s' % (sys.argv[0], e)
+        sys.exit(2)
+    conf = config.Config(options['conf'])
+    if not (conf.admin_port and conf.admin_secret):
+        print >>sys.stderr, ('%s: admin_port and admin_secret must be set '
+                             'in %s.' % (sys.argv[0], options['conf']))
+        sys.exit(2)
+
+    from twisted.internet import reactor
+    protocol.Factory.noisy = False
+    client = HTTPClient(options['workers'], 1)
+    outcome = {}
+
+    @defer.inlineCallbacks
+    def _run():
+        try:
+            outcome['results'] = yield invalidate(
+                client, conf, options['workers'], options['users'],
+                options['tags'], options['refresh'])
+        finally:
+            yield client.close()
+            reactor.stop()
+
+    reactor.callWhenRunning(_run)
+    reactor.run()
+
+    failed = False
+    for worker, (success, result) in enumerate(outcome.get('results', [])):
+        if not success:
+            print >>sys.stderr, 'worker %d: %s' % (
+                worker, result.getErrorMessage())
+            failed = True
+            continue
+        status, headers, body = result
+        if status != 200:
+            print >>sys.stderr, 'worker %d: %d %s' % (worker, status, body)
+            failed = True
+            continue
+        print 'worker %d: %d tags %s.' % (
+            worker, len(json.loads(body)['tags']),
+            'refreshing' if options['refresh'] else 'invalidated')
+    sys.exit(1 if failed or 'results' not in outcome else 0)
+
+
+if __name__ == '__main__':
+    main()
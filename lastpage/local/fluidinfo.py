@@ -0,0 +1,185 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+from hashlib import md5
+import json
+from random import random, uniform
+import re
+import uuid
+
+from twisted.web import http, resource, server
+
+# The lastpage tags every stub user has, and what is tagged with each. A
+# None value means the tag is on no objects.
+_TAGS = {
+    u'lastpage': [u'http://example.com/%(who)s'],
+    u'lastpage-multi': [u'http://example.com/%(who)s/1',
+                        u'http://example.com/%(who)s/2',
+                        u'http://example.com/%(who)s/3'],
+    u'lastpage-text': [u'Not a URL, %(who)s'],
+    u'lastpage-empty': None,
+}
+
+_USER = re.compile(r'^user(\d+)$')
+
+
+def _objectId(about):
+    """
+    Make a stable object id for a fluiddb/about value.
+
+    @param about: The C{unicode} fluiddb/about value.
+    @return: The C{str} object id.
+    """
+    return str(uuid.UUID(bytes=md5(about.encode('utf-8')).digest()))
+
+
+class StubFluidinfo(resource.Resource):
+    """
+    A stand-in for Fluidinfo that answers the requests lastpage makes, for
+    benchmarking without a real Fluidinfo. Users named C{user0} to
+    C{user<users - 1>} exist, each with the tags in C{_TAGS}. No other
+    users exist.
+
+    @param users: The C{int} number of users that exist.
+    @param latency: The C{float} number of seconds to wait before
+        answering each request.
+    @param jitter: The C{float} largest number of seconds to wait on top
+        of C{latency}. Each request waits a random part of it.
+    @param errorRate: The C{float} fraction of requests to answer with a
+        500 error.
+    @param clock: An C{IReactorTime} provider, used to delay responses. If
+        C{None}, the global reactor is used.
+    """
+    isLeaf = True
+
+    def __init__(self, users, latency, jitter, errorRate, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        resource.Resource.__init__(self)
+        self._users = users
+        self._latency = latency
+        self._jitter = jitter
+        self._errorRate = errorRate
+        self._clock = clock
+
+    def render_GET(self, request):
+        """
+        Handle a GET request, after a delay.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @return: C{server.NOT_DONE_YET}.
+        """
+        delay = self._latency + uniform(0, self._jitter)
+        call = self._clock.callLater(delay, self._respond, request)
+        request.notifyFinish().addErrback(
+            lambda _: call.active() and call.cancel())
+        return server.NOT_DONE_YET
+
+    def _respond(self, request):
+        """
+        Answer a request.
+
+        @param request: A twisted.web HTTP C{Request}.
+        """
+        if random() < self._errorRate:
+            self._error(request, http.INTERNAL_SERVER_ERROR,
+                        'TInternalServerError')
+            return
+        path = [part.decode('utf-8') for part in request.postpath if part]
+        if path[:1] == [u'values']:
+            self._values(request)
+        elif path[:1] == [u'namespaces'] and len(path) == 2:
+            self._namespace(path[1], request)
+        else:
+            self._error(request, http.NOT_FOUND, 'TNotFound')
+
+    def _exists(self, who):
+        """
+        Decide whether a user exists.
+
+        @param who: The C{unicode} username.
+        @return: C{True} if the user exists.
+        """
+        match = _USER.match(who)
+        return match is not None and int(match.group(1)) < self._users
+
+    def _values(self, request):
+        """
+        Answer a /values query of the form C{has user/tag}, or of several
+        of those joined with C{or}.
+
+        @param request: A twisted.web HTTP C{Request}.
+        """
+        query = request.args.get('query', [''])[0].decode('utf-8')
+        wanted = [tag.decode('utf-8') for tag in request.args.get('tag', [])]
+        results = {}
+        for clause in query.split(u' or '):
+            if not clause.startswith(u'has ') or u'/' not in clause:
+                self._error(request, http.BAD_REQUEST, 'TParseError')
+                return
+            path = clause[len(u'has '):]
+            who, name = path.split(u'/', 1)
+            if not self._exists(who) or name not in _TAGS:
+                self._error(request, http.NOT_FOUND, 'TNonexistentTag')
+                return
+            for about in _TAGS[name] or []:
+                about = about % {'who': who}
+                obj = results.setdefault(_objectId(about), {})
+                if u'fluiddb/about' in wanted:
+                    obj[u'fluiddb/about'] = {u'value': about}
+                if path in wanted:
+                    obj[path] = {u'value': None}
+        self._json(request, {u'results': {u'id': results}})
+
+    def _namespace(self, who, request):
+        """
+        Answer a request for a user's top-level namespace.
+
+        @param who: The C{unicode} username.
+        @param request: A twisted.web HTTP C{Request}.
+        """
+        if not self._exists(who):
+            self._error(request, http.NOT_FOUND, 'TNonexistentNamespace')
+            return
+        result = {u'id': _objectId(who)}
+        if request.args.get('returnDescription') == ['true']:
+            result[u'description'] = u'Namespace of %s.' % who
+        if request.args.get('returnNamespaces') == ['true']:
+            result[u'namespaceNames'] = []
+        if request.args.get('returnTags') == ['true']:
+            result[u'tagNames'] = sorted(_TAGS)
+        self._json(request, result)
+
+    def _json(self, request, result):
+        """
+        Send a successful JSON response.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @param result: The JSON-encodable result.
+        """
+        request.setHeader('content-type', 'application/json')
+        request.write(json.dumps(result))
+        request.finish()
+
+    def _error(self, request, code, errorClass):
+        """
+        Send an error response the way Fluidinfo does.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @param code: The C{int} HTTP status code.
+        @param errorClass: The C{str} Fluidinfo error class.
+        """
+        request.setResponseCode(code)
+        request.setHeader('x-fluiddb-error-class', errorClass)
+        request.finish()
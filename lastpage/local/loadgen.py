@@ -0,0 +1,385 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Drive load at a running lastpage service and report throughput and
+latency percentiles. Run it with
+
+    python -m lastpage.local.loadgen --url http://localhost:8000
+
+against a lastpage service whose Fluidinfo is the local-fluidinfo stand-in
+and whose Twitter is the local-oauth stand-in (see conf/benchmark.conf).
+"""
+
+import json
+from random import random, randrange
+import sys
+from time import time
+from urllib import urlencode
+from urlparse import parse_qs, urlparse
+
+from twisted.internet import defer, protocol
+from twisted.python import log, usage
+
+from lastpage.httpclient import HTTPClient
+
+_STATIC_PATHS = ['/static/style.css', '/static/logo.png', '/robots.txt',
+                 '/favicon.ico']
+
+
+def percentile(ordered, fraction):
+    """
+    Find a percentile of some values, by the nearest-rank method.
+
+    @param ordered: A non-empty sorted C{list} of values.
+    @param fraction: The C{float} percentile, as a fraction (e.g. 0.99).
+    @return: The value at that percentile.
+    """
+    rank = int(fraction * len(ordered) + 0.5)
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def parseMix(value):
+    """
+    Parse a scenario mix, such as C{redirect:70,missing:30}.
+
+    @param value: The C{str} mix: comma-separated scenario:weight pairs.
+    @raise usage.UsageError: If the mix cannot be parsed or names an
+        unknown scenario.
+    @return: A C{list} of (C{str} scenario, C{float} weight) pairs.
+    """
+    mix = []
+    for pair in value.split(','):
+        try:
+            name, weight = pair.split(':')
+            weight = float(weight)
+        except ValueError:
+            raise usage.UsageError('Bad scenario weight %r.' % pair)
+        if not hasattr(LoadGenerator, '_scenario_' + name):
+            raise usage.UsageError('Unknown scenario %r.' % name)
+        mix.append((name, weight))
+    return mix
+
+
+class UnexpectedResponse(Exception):
+    """
+    The service answered a request with an unexpected status.
+    """
+
+
+class LoadGenerator(object):
+    """
+    Make requests to a lastpage service from a number of simulated
+    clients, each of which makes its next request as soon as its last one
+    is answered, and time them.
+
+    @param client: The L{HTTPClient} to make requests with.
+    @param baseURL: The C{str} URL of the service, without a trailing
+        slash.
+    @param mix: A C{list} of (C{str} scenario, C{float} weight) pairs.
+    @param users: The C{int} number of users the Fluidinfo stand-in has.
+    """
+
+    def __init__(self, client, baseURL, mix, users):
+        self._client = client
+        self._baseURL = baseURL
+        self._users = users
+        total = sum(weight for name, weight in mix)
+        self._mix = []
+        cumulative = 0.0
+        for name, weight in mix:
+            cumulative += weight / total
+            self._mix.append((cumulative, getattr(self, '_scenario_' + name)))
+        # Maps request names to lists of latencies, in seconds.
+        self.latencies = {}
+        # Maps request names to counts of errors.
+        self.errors = {}
+
+    def run(self, concurrency, duration):
+        """
+        Generate load.
+
+        @param concurrency: The C{int} number of simulated clients.
+        @param duration: The C{float} number of seconds to run for.
+        @return: A C{Deferred} that fires with the C{float} number of
+            seconds actually taken, once every client has finished.
+        """
+        start = time()
+        deadline = start + duration
+        d = defer.gatherResults([self._simulateClient(deadline)
+                                 for i in range(concurrency)])
+        d.addCallback(lambda _: time() - start)
+        return d
+
+    def _simulateClient(self, deadline):
+        """
+        Run scenarios, one after another, until a deadline.
+
+        @param deadline: The C{float} time to stop at.
+        @return: A C{Deferred} that fires when the client stops.
+        """
+        done = defer.Deferred()
+
+        def _next(_=None):
+            if time() >= deadline:
+                done.callback(None)
+                return
+            d = self._pickScenario()()
+            # Errors have already been counted.
+            d.addErrback(lambda _: None)
+            d.addCallback(_next)
+
+        _next()
+        return done
+
+    def _pickScenario(self):
+        """
+        Choose a scenario at random, according to the mix.
+
+        @return: The scenario method.
+        """
+        choice = random()
+        for cumulative, scenario in self._mix:
+            if choice < cumulative:
+                return scenario
+        return self._mix[-1][1]
+
+    def _user(self):
+        """
+        Choose an existing user, favouring low-numbered ones so that, as
+        in real traffic, a few users get most of the lookups.
+
+        @return: The C{str} username.
+        """
+        return 'user%d' % (int(self._users ** random()) - 1)
+
+    def _get(self, name, path, expected):
+        """
+        Make a timed GET request.
+
+        @param name: The C{str} name to report the request's timing under.
+        @param path: The C{str} path to request.
+        @param expected: A C{tuple} of the C{int} statuses the response may
+            have.
+        @return: A C{Deferred} that fires with the response's
+            (status, headers, body) tuple, or fails if the request failed
+            or got an unexpected status.
+        """
+        start = time()
+
+        def _check(result):
+            status = result[0]
+            if status not in expected:
+                raise UnexpectedResponse('%s: %s gave %d.' %
+                                         (name, path, status))
+            self.latencies.setdefault(name, []).append(time() - start)
+            return result
+
+        def _countError(fail):
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return fail
+
+        d = self._client.request(self._baseURL + path)
+        d.addCallback(_check)
+        d.addErrback(_countError)
+        return d
+
+    def _scenario_redirect(self):
+        # twisted.web's request.redirect turns our 307s into 302s.
+        return self._get('redirect', '/' + self._user(), (302, 307))
+
+    def _scenario_multiple(self):
+        return self._get('multiple', '/%s/multi' % self._user(), (200,))
+
+    def _scenario_text(self):
+        return self._get('text', '/%s/text' % self._user(), (200,))
+
+    def _scenario_empty(self):
+        return self._get('empty', '/%s/empty' % self._user(), (200,))
+
+    def _scenario_missing(self):
+        return self._get('missing', '/nobody%d' % randrange(self._users),
+                         (200,))
+
+    def _scenario_page(self):
+        return self._get('page', '/', (200,))
+
+    def _scenario_static(self):
+        path = _STATIC_PATHS[randrange(len(_STATIC_PATHS))]
+        return self._get('static', path, (200,))
+
+    def _scenario_login(self):
+        """
+        Log in: ask to log in, then make the callback Twitter would send
+        the browser back with once the user has authorized us.
+        """
+        def _callback((status, headers, body)):
+            location = urlparse(headers['location'][0])
+            token = parse_qs(location.query)['oauth_token'][0]
+            query = urlencode([('oauth_token', token),
+                               ('oauth_verifier', 'fake-verifier')])
+            return self._get('callback', '/_callback_?' + query, (302,))
+
+        d = self._get('login', '/_login_', (302,))
+        d.addCallback(_callback)
+        return d
+
+    def report(self, elapsed):
+        """
+        Summarize the timings.
+
+        @param elapsed: The C{float} number of seconds the run took.
+        @return: A C{dict} with the overall throughput, and a C{dict} of
+            counts and latency percentiles (in milliseconds) for each kind
+            of request and for all requests together.
+        """
+        def _summary(latencies, errors):
+            summary = {'requests': len(latencies), 'errors': errors}
+            if latencies:
+                ordered = sorted(latencies)
+                for label, fraction in (('p50', 0.5), ('p99', 0.99),
+                                        ('p999', 0.999)):
+                    summary[label] = percentile(ordered, fraction) * 1000
+            return summary
+
+        names = set(self.latencies) | set(self.errors)
+        requests = dict(
+            (name, _summary(self.latencies.get(name, []),
+                            self.errors.get(name, 0)))
+            for name in names)
+        everything = sum(self.latencies.values(), [])
+        requests['all'] = _summary(everything, sum(self.errors.values()))
+        return {'elapsed': elapsed,
+                'throughput': len(everything) / elapsed,
+                'requests': requests}
+
+
+def formatReport(report):
+    """
+    Format a report for people to read.
+
+    @param report: A C{dict} as returned by L{LoadGenerator.report}.
+    @return: The C{str} report.
+    """
+    lines = ['%-10s %9s %7s %9s %9s %9s' % (
+        'request', 'count', 'errors', 'p50 ms', 'p99 ms', 'p999 ms')]
+    requests = report['requests']
+    for name in sorted(requests, key=lambda name: (name == 'all', name)):
+        summary = requests[name]
+        lines.append('%-10s %9d %7d %9.2f %9.2f %9.2f' % (
+            name, summary['requests'], summary['errors'],
+            summary.get('p50', 0), summary.get('p99', 0),
+            summary.get('p999', 0)))
+    lines.append('%.1f requests/second over %.1f seconds.' % (
+        report['throughput'], report['elapsed']))
+    return '\n'.join(lines)
+
+
+class Options(usage.Options):
+    """
+    Command line options for the load generator.
+    """
+    optParameters = [
+        ['url', None, 'http://localhost:8000',
+         'The URL of the lastpage service.'],
+        ['mix', None,
+         'redirect:60,multiple:8,text:4,empty:4,missing:10,page:4,'
+         'static:8,login:2',
+         'Comma-separated scenario:weight pairs.'],
+        ['users', None, 10000,
+         'The number of users the Fluidinfo stand-in has.', int],
+        ['concurrency', 'c', 50, 'The number of simulated clients.', int],
+        ['duration', 'd', 30.0, 'Seconds to generate load for.', float],
+        ['warmup', None, 5.0,
+         'Seconds to generate load for before measuring.', float],
+        ['max-p99', None, None,
+         'Fail if the overall p99 latency exceeds this many ms.', float],
+        ['min-throughput', None, None,
+         'Fail if fewer requests per second than this are served.', float],
+        ]
+    optFlags = [
+        ['json', None, 'Report in JSON.'],
+        ]
+
+    def postOptions(self):
+        self['mix'] = parseMix(self['mix'])
+        self['url'] = self['url'].rstrip('/')
+
+
+def main(args=None):
+    """
+    Run the load generator, and exit with status 1 if the service missed
+    any of the --max-p99 or --min-throughput targets.
+
+    @param args: The C{list} of C{str} command line arguments, or C{None}
+        to use C{sys.argv}.
+    """
+    options = Options()
+    try:
+        options.parseOptions(args)
+    except usage.UsageError, e:
+        print >>sys.stderr, '%s: %s' % (sys.argv[0], e)
+        sys.exit(2)
+
+    from twisted.internet import reactor
+    protocol.Factory.noisy = False
+    client = HTTPClient(options['concurrency'], 60)
+    result = {}
+
+    def _makeGenerator():
+        return LoadGenerator(client, options['url'], options['mix'],
+                             options['users'])
+
+    @defer.inlineCallbacks
+    def _run():
+        try:
+            if options['warmup']:
+                yield _makeGenerator().run(options['concurrency'],
+                                           options['warmup'])
+            generator = _makeGenerator()
+            elapsed = yield generator.run(options['concurrency'],
+                                          options['duration'])
+            result['report'] = generator.report(elapsed)
+        finally:
+            yield client.close()
+            reactor.stop()
+
+    reactor.callWhenRunning(lambda: _run().addErrback(log.err))
+    log.startLogging(sys.stderr, setStdout=False)
+    reactor.run()
+
+    if 'report' not in result:
+        sys.exit(1)
+    report = result['report']
+    if options['json']:
+        print json.dumps(report, sort_keys=True, indent=2)
+    else:
+        print formatReport(report)
+    overall = report['requests']['all']
+    failed = False
+    if (options['max-p99'] is not None and
+            overall.get('p99', 0) > options['max-p99']):
+        print >>sys.stderr, 'p99 latency %.2fms exceeds %.2fms.' % (
+            overall['p99'], options['max-p99'])
+        failed = True
+    if (options['min-throughput'] is not None and
+            report['throughput'] < options['min-throughput']):
+        print >>sys.stderr, 'Throughput %.1f/s is below %.1f/s.' % (
+            report['throughput'], options['min-throughput'])
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import json
 import os
+import uuid
 
 from twisted.python import log
 from twisted.web import resource, http
@@ -60,8 +61,10 @@ class RequestToken(resource.Resource):
         """
         request.setResponseCode(http.OK)
         request.setHeader('content-type', 'text/plain')
+        # Each request gets its own token, as with Twitter, so that
+        # simultaneous logins (e.g., when benchmarking) do not collide.
         return ('oauth_token=%s&oauth_token_secret=fake-secret' %
-                _fakeRequestToken)
+                uuid.uuid4().hex)
 
 
 class Authorization(resource.Resource):
@@ -96,7 +99,8 @@ authorize???
 <a href=%s?oauth_token=%s&oauth_verifier=fake-verifier>yes</a>
 </p>
 </body>
-</html>""" % (self.conf.callback_url, _fakeRequestToken)
+</html>""" % (self.conf.callback_url,
+              request.args.get('oauth_token', [_fakeRequestToken])[0])
 
 
 class AuthorizationFail(resource.Resource):
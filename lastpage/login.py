@@ -12,26 +12,35 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
+from lastpage.eventlog import logger
+from lastpage.resilience import UNAVAILABLE
 from lastpage.twitter import getTwitterOAuthURL
 
-from twisted.python import log
-from twisted.web import resource, server
+from twisted.web import http, resource, server
 
 
 class Login(resource.Resource):
     """
     Handles login requests that will redirect to an OAuth endpoint.
 
-    @param oauthTokenDict: A C{dict} mapping OAuth keys to tokens.
-    @param conf: A L{config.Config} instance holding configuration
-        settings.
+    @param sessions: The L{lastpage.store.ISessionStore} holding logged-in
+        user sessions.
+    @param tokens: The L{lastpage.store.ITokenStore} holding pending OAuth
+        request tokens.
+    @param config: The L{lastpage.reload.LiveConfig} holding the current
+        configuration settings.
+    @param httpClient: The L{lastpage.httpclient.HTTPClient} to make
+        requests to Twitter with.
+    @param twitter: The L{lastpage.resilience.Backend} for Twitter.
     """
     isLeaf = True
 
-    def __init__(self, cookieDict, oauthTokenDict, conf):
-        self.cookieDict = cookieDict
-        self.oauthTokenDict = oauthTokenDict
-        self.conf = conf
+    def __init__(self, sessions, tokens, config, httpClient, twitter):
+        self.sessions = sessions
+        self.tokens = tokens
+        self.config = config
+        self.httpClient = httpClient
+        self.twitter = twitter
 
     def render_GET(self, request):
         """
@@ -39,19 +48,48 @@ class Login(resource.Resource):
 
         @param request: A twisted.web HTTP C{Request}.
         """
-        log.err('Login request received: %s' % request)
-        d = getTwitterOAuthURL(self.conf, self.oauthTokenDict)
-        d.addCallback(self._redirect, request)
-        d.addErrback(log.err)
+        logger.debug('login-request')
+        gone = []
+        request.notifyFinish().addErrback(lambda _: gone.append(True))
+        d = getTwitterOAuthURL(self.config.current, self.tokens,
+                               self.httpClient, self.twitter)
+        d.addCallback(self._redirect, request, gone)
+        d.addErrback(self._failed, request, gone)
+        d.addErrback(logger.failure, 'login-failed')
         return server.NOT_DONE_YET
 
-    def _redirect(self, URL, request):
+    def _redirect(self, URL, request, gone):
         """
         Redirect the user to the OAuth endpoint for authorization.
 
         @param URL: The C{str} URL to redirect this request to.
         @param request: A twisted.web HTTP C{Request}.
+        @param gone: A C{list} that is not empty if the client has gone
+            away.
         """
-        log.msg('Got OAuth URL: %r. Redirecting' % URL)
+        logger.debug('login-redirect', url=URL)
+        if gone:
+            return
         request.redirect(URL)
         request.finish()
+
+    def _failed(self, fail, request, gone):
+        """
+        Tell the user we could not start logging them in with Twitter.
+
+        @param fail: The C{Failure} of getting a request token.
+        @param request: A twisted.web HTTP C{Request}.
+        @param gone: A C{list} that is not empty if the client has gone
+            away.
+        """
+        if fail.check(*UNAVAILABLE):
+            logger.warning('login-unavailable', error=fail.getErrorMessage())
+        else:
+            logger.failure(fail, 'request-token-failed')
+        if gone:
+            return
+        request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        request.setHeader('content-type', 'text/plain')
+        request.write('Twitter is not answering at the moment. '
+                      'Please try again later.\n')
+        request.finish()
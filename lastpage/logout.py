@@ -12,31 +12,44 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
+import sqlite3
+
 from twisted.web import resource
 
+from lastpage.eventlog import logger
+from lastpage.store import sessionStoreErrors
+
 
 class Logout(resource.Resource):
     """
     Log the user out.
 
-    @param cookieDict: A C{dict} mapping cookie values to Twitter usernames.
+    @param sessions: The L{lastpage.store.ISessionStore} holding logged-in
+        user sessions.
+    @param config: The L{lastpage.reload.LiveConfig} holding the current
+        configuration settings.
     """
     allowedMethods = ('GET',)
 
-    def __init__(self, cookieDict, conf):
+    def __init__(self, sessions, config):
         resource.Resource.__init__(self)
-        self._cookieDict = cookieDict
-        self._conf = conf
+        self._sessions = sessions
+        self._config = config
 
     def render_GET(self, request):
         """
         Forget about the user's cookie and redirect them to our home page.
+        They are redirected even if their session cannot be deleted (it
+        will expire in time).
 
         @param request: A twisted.web HTTP C{Request}.
         """
-        try:
-            del self._cookieDict[request.getCookie(self._conf.cookie_name)]
-        except KeyError:
-            pass
+        cookie = request.getCookie(self._config.current.cookie_name)
+        if cookie is not None:
+            try:
+                self._sessions.delete(cookie)
+            except sqlite3.OperationalError, e:
+                logger.warning('session-delete-failed', error=str(e))
+                sessionStoreErrors.labels('delete').inc()
         request.redirect('/')
         return ''
@@ -0,0 +1,321 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+from bisect import bisect_left
+from time import time
+
+
+def _latencyBounds(smallest=-14, largest=6):
+    """
+    Make histogram bucket upper bounds in the manner of an HDR histogram:
+    each power of two from C{2 ** smallest} to C{2 ** largest} seconds is
+    split into two, so any observation is placed to within 50%.
+
+    @param smallest: The C{int} power of two of the smallest bound.
+    @param largest: The C{int} power of two of the largest bound.
+    @return: A C{list} of C{float} bounds, in increasing order.
+    """
+    bounds = []
+    for power in range(smallest, largest):
+        bounds.append(2.0 ** power)
+        bounds.append(1.5 * 2.0 ** power)
+    bounds.append(2.0 ** largest)
+    return bounds
+
+# About 61 microseconds to 64 seconds.
+LATENCY_BOUNDS = _latencyBounds()
+
+
+def _formatLabels(names, values, extra=()):
+    """
+    Format labels for a sample in the Prometheus text format.
+
+    @param names: A C{tuple} of C{str} label names.
+    @param values: A C{tuple} of label values, one for each name.
+    @param extra: A C{tuple} of further (name, value) pairs.
+    @return: The C{str} labels, in braces, or C{''} if there are none.
+    """
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    formatted = []
+    for name, value in pairs:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        value = str(value).replace('\\', r'\\').replace(
+            '"', r'\"').replace('\n', r'\n')
+        formatted.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(formatted)
+
+
+def _formatNumber(number):
+    """
+    Format a sample value or bucket bound in the Prometheus text format.
+
+    @param number: An C{int} or C{float}.
+    @return: The C{str} number.
+    """
+    if isinstance(number, float):
+        return repr(number)
+    return str(number)
+
+
+class _CounterValue(object):
+    """
+    The value of a counter, for one set of label values.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        """
+        Increase the counter.
+
+        @param amount: The C{int} amount to increase it by.
+        """
+        self.value += amount
+
+
+class _HistogramValue(object):
+    """
+    The observations in a histogram, for one set of label values.
+
+    @param bounds: The C{list} of C{float} bucket upper bounds, in
+        increasing order.
+    """
+    __slots__ = ('_bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        # One more than there are bounds, for observations above them all.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Record an observation.
+
+        @param value: The C{float} value, e.g. a number of seconds.
+        """
+        self.counts[bisect_left(self._bounds, value)] += 1
+        self.sum += value
+
+    def timeDeferred(self, d):
+        """
+        Record how long a C{Deferred} takes to fire, starting now.
+
+        @param d: The C{Deferred}.
+        @return: C{d}, whose result is passed through unchanged.
+        """
+        start = time()
+
+        def _observe(result):
+            self.observe(time() - start)
+            return result
+
+        return d.addBoth(_observe)
+
+
+class _Metric(object):
+    """
+    A named metric, holding a value for each combination of label values
+    it is used with.
+
+    @param name: The C{str} metric name.
+    @param help: The C{str} description of the metric.
+    @param labelNames: A C{tuple} of C{str} label names.
+    """
+    type = None
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self._labelNames = tuple(labelNames)
+        self._values = {}
+
+    def labels(self, *values):
+        """
+        Get the value for a combination of label values. Callers that always
+        use the same labels should keep the result, to save the lookup.
+
+        @param values: The label values, one for each label name.
+        @return: The value object.
+        """
+        try:
+            return self._values[values]
+        except KeyError:
+            if len(values) != len(self._labelNames):
+                raise ValueError('Metric %s needs labels %r.' %
+                                 (self.name, self._labelNames))
+            value = self._values[values] = self._newValue()
+            return value
+
+    def _newValue(self):
+        raise NotImplementedError()
+
+    def exposition(self):
+        """
+        Describe the metric in the Prometheus text format.
+
+        @return: A C{list} of C{str} lines.
+        """
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for labelValues in sorted(self._values):
+            lines.extend(self._samples(labelValues,
+                                       self._values[labelValues]))
+        return lines
+
+    def _samples(self, labelValues, value):
+        raise NotImplementedError()
+
+
+class Counter(_Metric):
+    """
+    A count of things that have happened.
+    """
+    type = 'counter'
+
+    def _newValue(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        """
+        Increase an unlabelled counter.
+
+        @param amount: The C{int} amount to increase it by.
+        """
+        self.labels().inc(amount)
+
+    def _samples(self, labelValues, value):
+        return ['%s%s %s' % (
+            self.name, _formatLabels(self._labelNames, labelValues),
+            _formatNumber(value.value))]
+
+
+class Histogram(_Metric):
+    """
+    A distribution of observed values, typically latencies in seconds.
+
+    @param bounds: A C{list} of C{float} bucket upper bounds, in
+        increasing order.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labelNames=(), bounds=LATENCY_BOUNDS):
+        _Metric.__init__(self, name, help, labelNames)
+        self._bounds = bounds
+
+    def _newValue(self):
+        return _HistogramValue(self._bounds)
+
+    def observe(self, value):
+        """
+        Record an observation in an unlabelled histogram.
+
+        @param value: The C{float} value, e.g. a number of seconds.
+        """
+        self.labels().observe(value)
+
+    def timeDeferred(self, d):
+        """
+        Record how long a C{Deferred} takes to fire, in an unlabelled
+        histogram.
+
+        @param d: The C{Deferred}.
+        @return: C{d}, whose result is passed through unchanged.
+        """
+        return self.labels().timeDeferred(d)
+
+    def _samples(self, labelValues, value):
+        samples = []
+        cumulative = 0
+        bounds = [_formatNumber(bound) for bound in self._bounds]
+        for bound, count in zip(bounds + ['+Inf'], value.counts):
+            cumulative += count
+            samples.append('%s_bucket%s %d' % (
+                self.name,
+                _formatLabels(self._labelNames, labelValues,
+                              (('le', bound),)),
+                cumulative))
+        labels = _formatLabels(self._labelNames, labelValues)
+        samples.append('%s_sum%s %s' % (self.name, labels,
+                                        _formatNumber(value.sum)))
+        samples.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return samples
+
+
+class Registry(object):
+    """
+    A collection of metrics, which can be described all at once in the
+    Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _add(self, metric):
+        """
+        Add a metric.
+
+        @param metric: The L{Counter} or L{Histogram} to add.
+        @raise ValueError: If there is already a metric with its name.
+        @return: C{metric}.
+        """
+        if metric.name in self._metrics:
+            raise ValueError('Metric %s already exists.' % metric.name)
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelNames=()):
+        """
+        Create a counter.
+
+        @param name: The C{str} metric name.
+        @param help: The C{str} description of the metric.
+        @param labelNames: A C{tuple} of C{str} label names.
+        @return: A L{Counter}.
+        """
+        return self._add(Counter(name, help, labelNames))
+
+    def histogram(self, name, help, labelNames=(), bounds=LATENCY_BOUNDS):
+        """
+        Create a histogram.
+
+        @param name: The C{str} metric name.
+        @param help: The C{str} description of the metric.
+        @param labelNames: A C{tuple} of C{str} label names.
+        @param bounds: A C{list} of C{float} bucket upper bounds, in
+            increasing order.
+        @return: A L{Histogram}.
+        """
+        return self._add(Histogram(name, help, labelNames, bounds))
+
+    def exposition(self):
+        """
+        Describe all the metrics in the Prometheus text format.
+
+        @return: The C{str} description.
+        """
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].exposition())
+        return '\n'.join(lines) + '\n'
+
+
+# The registry the service's own metrics are kept in. Metrics are created
+# when the modules that use them are imported.
+registry = Registry()
@@ -0,0 +1,126 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import math
+
+from twisted.web import resource
+
+from lastpage.metrics import registry
+
+# Not in twisted.web.http.
+TOO_MANY_REQUESTS = 429
+
+_limited = registry.counter(
+    'lastpage_rate_limited_total', 'Requests refused for exceeding a rate '
+    'limit, by budget.', ('budget',))
+
+
+def clientAddress(request, trustedProxies):
+    """
+    Find the address of the client that made a request. Behind nginx, the
+    peer is the proxy, and the client is the last address the proxy added
+    to X-Forwarded-For (earlier ones are whatever the client claims).
+
+    @param request: A twisted.web HTTP C{Request}.
+    @param trustedProxies: A C{frozenset} of the C{str} addresses of
+        proxies whose X-Forwarded-For headers are believed.
+    @return: The C{str} client address.
+    """
+    peer = request.getClientIP()
+    if peer in trustedProxies:
+        forwarded = request.getHeader('x-forwarded-for')
+        if forwarded:
+            client = forwarded.split(',')[-1].strip()
+            if client:
+                return client
+    return peer
+
+
+class RateLimiter(object):
+    """
+    Token buckets, one for each key, that fill at a steady rate. Rather
+    than a token count and a time, only the time at which each bucket will
+    be full again is kept (as in the generic cell rate algorithm), so each
+    key costs a single C{float}, and a full bucket needs no entry at all.
+
+    @param name: The C{str} name of the budget, used in metrics.
+    @param rate: The C{float} number of tokens added to a bucket each
+        second.
+    @param burst: The C{int} number of tokens a bucket holds.
+    @param clock: An C{IReactorTime} provider, used to find out the
+        current time. If C{None}, the global reactor is used.
+    """
+
+    def __init__(self, name, rate, burst, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._limited = _limited.labels(name)
+        self._interval = 1.0 / rate
+        self._capacity = max(burst, 1) * self._interval
+        self._clock = clock
+        # Maps keys to the times their buckets will be full.
+        self._full = {}
+
+    def __len__(self):
+        return len(self._full)
+
+    def take(self, key, count=1):
+        """
+        Take tokens from a key's bucket, if there are enough.
+
+        @param key: The C{str} key, e.g. a client address.
+        @param count: The C{int} number of tokens to take.
+        @return: C{0} if the tokens were taken, else the C{float} number of
+            seconds until there will be enough.
+        """
+        now = self._clock.seconds()
+        full = max(self._full.get(key, now), now) + self._interval * count
+        if full - now > self._capacity:
+            self._limited.inc()
+            return full - now - self._capacity
+        self._full[key] = full
+        return 0
+
+    def cleanup(self):
+        """
+        Forget the buckets that have filled up again.
+
+        @return: The C{int} number of buckets forgotten.
+        """
+        now = self._clock.seconds()
+        full = [key for key, when in self._full.iteritems() if when <= now]
+        for key in full:
+            del self._full[key]
+        return len(full)
+
+
+class TooManyRequests(resource.Resource):
+    """
+    Refuse a request from a client that has used up its budget.
+
+    @param retryAfter: The C{float} number of seconds until the client may
+        try again.
+    """
+    isLeaf = True
+
+    def __init__(self, retryAfter):
+        resource.Resource.__init__(self)
+        self._retryAfter = retryAfter
+
+    def render(self, request):
+        request.setResponseCode(TOO_MANY_REQUESTS, 'Too Many Requests')
+        request.setHeader('retry-after',
+                          str(int(math.ceil(self._retryAfter))))
+        request.setHeader('content-type', 'text/plain')
+        return 'Too many requests.\n'
@@ -0,0 +1,150 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import os
+import signal
+
+from twisted.application import internet, service
+from twisted.python import failure
+
+from lastpage.config import Config, ConfigError
+from lastpage.eventlog import logger
+
+
+class LiveConfig(object):
+    """
+    The current configuration of the service, which can be reloaded from
+    its file while the service runs. Readers take the C{current} snapshot
+    once and use it throughout, so a reload never hands them a mix of old
+    and new settings.
+
+    @param path: The C{str} path of the config file.
+    @param current: The L{Config} read from it at startup. If C{None}, the
+        file is read now.
+    """
+
+    def __init__(self, path, current=None):
+        self.path = path
+        if current is None:
+            current = Config(path)
+        self.current = current
+        self._listeners = []
+
+    def onChange(self, listener):
+        """
+        Arrange for a function to be called whenever a reload changes the
+        configuration.
+
+        @param listener: A callable taking the old and the new L{Config}.
+        """
+        self._listeners.append(listener)
+
+    def reload(self):
+        """
+        Read the config file again, and swap it in if it is valid. A bad
+        file is logged and otherwise ignored.
+
+        @return: The C{list} of the names of the settings that changed.
+        """
+        try:
+            new = Config(self.path)
+        except ConfigError, e:
+            logger.error('config-reload-failed', path=self.path,
+                         error=str(e))
+            return []
+        old = self.current
+        changes = new.changes(old)
+        if not changes:
+            return changes
+        self.current = new
+        logger.warning('config-reloaded', path=self.path, changes=changes)
+        needRestart = sorted(Config.RESTART_REQUIRED.intersection(changes))
+        if needRestart:
+            logger.warning('config-restart-needed', changes=needRestart)
+        for listener in self._listeners:
+            try:
+                listener(old, new)
+            except Exception:
+                logger.failure(failure.Failure(), 'config-listener-failed')
+        return changes
+
+
+class ReloadSignal(service.Service):
+    """
+    Call a function, in the reactor thread, whenever the process gets a
+    signal.
+
+    @param callback: The callable to call, with no arguments.
+    @param signum: The C{int} number of the signal.
+    @param reactor: The reactor to use. If C{None}, the global reactor is
+        used.
+    """
+
+    def __init__(self, callback, signum=signal.SIGHUP, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._callback = callback
+        self._signum = signum
+        self._reactor = reactor
+        self._previous = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self._previous = signal.signal(self._signum, self._received)
+
+    def _received(self, signum, frame):
+        self._reactor.callFromThread(self._callback)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        signal.signal(self._signum, self._previous or signal.SIG_DFL)
+
+
+class ConfigWatcher(internet.TimerService):
+    """
+    Reload the configuration whenever its file changes.
+
+    @param config: The L{LiveConfig} to reload.
+    @param interval: The C{int} number of seconds between checks of the
+        file.
+    """
+
+    def __init__(self, config, interval):
+        internet.TimerService.__init__(self, interval, self._check)
+        self._config = config
+        self._stat = self._statFile()
+
+    def _statFile(self):
+        """
+        Find out when the config file last changed.
+
+        @return: A (modification time, size) C{tuple}, or C{None} if the
+            file cannot be found.
+        """
+        try:
+            stat = os.stat(self._config.path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def _check(self):
+        """
+        Reload the configuration if the file has changed since the last
+        check.
+        """
+        stat = self._statFile()
+        if stat != self._stat:
+            self._stat = stat
+            if stat is not None:
+                self._config.reload()
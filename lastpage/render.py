@@ -0,0 +1,143 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+from collections import OrderedDict
+from hashlib import md5
+from time import time
+
+from twisted.web import http
+
+from lastpage.metrics import registry
+
+# A marker rendered into the cached 500 page in place of the request id.
+_ID_MARKER = '@@LASTPAGE-REQUEST-ID@@'
+
+_rendering = registry.histogram(
+    'lastpage_template_render_seconds',
+    'Time taken to render a template, by template.', ('template',))
+
+
+class RenderedPage(object):
+    """
+    The fully rendered bytes of a page, with the ETag needed to answer
+    conditional GET requests for it. There is no Last-Modified: every
+    variant of a page (one for each logged-in user) would share it, so a
+    browser revalidating after logging in or out would be told its copy
+    of the other variant is still good.
+
+    @param body: The C{str} rendered page.
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self.etag = '"%s"' % md5(body).hexdigest()
+
+    def render(self, request):
+        """
+        Write this page as the response to a request, or tell the client
+        its copy is still good.
+
+        @param request: A twisted.web HTTP C{Request}.
+        @return: The C{str} response body.
+        """
+        if request.setETag(self.etag) == http.CACHED:
+            return ''
+        return self.body
+
+
+class Templates(object):
+    """
+    The lastpage.me templates, all loaded and compiled up front, along with
+    a cache of rendered pages whose output depends only on who (if anyone)
+    is logged in.
+
+    @param env: The Jinja2 C{Environment} to load templates from.
+    @param maxPages: The C{int} maximum number of rendered pages to cache.
+    """
+
+    def __init__(self, env, maxPages):
+        self._templates = dict((name, env.get_template(name))
+                               for name in env.list_templates())
+        self._maxPages = maxPages
+        self._pages = OrderedDict()
+        self._errorPage = self.render('500.html', id=_ID_MARKER)
+
+    def __contains__(self, name):
+        return name in self._templates
+
+    def __iter__(self):
+        return iter(self._templates)
+
+    def render(self, name, **kwargs):
+        """
+        Render a template.
+
+        @param name: The C{str} name of the template.
+        @param kwargs: The variables to render the template with.
+        @return: The rendered C{str}.
+        """
+        start = time()
+        result = str(self._templates[name].render(**kwargs))
+        _rendering.labels(name).observe(time() - start)
+        return result
+
+    def generate(self, name, chunkSize, **kwargs):
+        """
+        Render a template incrementally.
+
+        @param name: The C{str} name of the template.
+        @param chunkSize: The C{int} number of bytes to collect before
+            producing a chunk.
+        @param kwargs: The variables to render the template with.
+        @return: A generator of C{str} chunks of the rendered template.
+        """
+        buffered = []
+        size = 0
+        for piece in self._templates[name].generate(**kwargs):
+            piece = piece.encode('utf-8')
+            buffered.append(piece)
+            size += len(piece)
+            if size >= chunkSize:
+                yield ''.join(buffered)
+                buffered = []
+                size = 0
+        if buffered:
+            yield ''.join(buffered)
+
+    def page(self, name, user):
+        """
+        Get a rendered top-level page, such as index.html.
+
+        @param name: The C{str} name of the template.
+        @param user: The C{unicode} name of the logged-in user, or C{None}.
+        @return: A L{RenderedPage}.
+        """
+        key = (name, user)
+        try:
+            page = self._pages.pop(key)
+        except KeyError:
+            page = RenderedPage(self.render(name, user=user))
+            while self._pages and len(self._pages) >= self._maxPages:
+                self._pages.popitem(last=False)
+        self._pages[key] = page
+        return page
+
+    def errorPage(self, _id):
+        """
+        Get the internal server error page.
+
+        @param _id: The C{str} request id to show on the page.
+        @return: The rendered C{str}.
+        """
+        return self._errorPage.replace(_ID_MARKER, _id)
@@ -0,0 +1,366 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+from random import uniform
+
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.web.client import ResponseFailed, ResponseNeverReceived
+from twisted.web.error import Error
+
+from lastpage.eventlog import logger
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    """
+    A call was not made because the backend's circuit breaker is open.
+    """
+
+
+# Failures that mean a backend could not be reached, or would not answer.
+UNAVAILABLE = (CircuitOpenError, error.TimeoutError, error.ConnectError,
+               error.ConnectionLost, ResponseFailed, ResponseNeverReceived)
+
+
+def isBackendFailure(fail):
+    """
+    Decide whether a failed call means the backend is in trouble. HTTP
+    errors below 500 are the backend answering normally (e.g., Fluidinfo
+    saying a tag does not exist), so they do not count.
+
+    @param fail: The C{Failure} of the call.
+    @return: C{True} if the failure should count against the backend.
+    """
+    if fail.check(Error):
+        try:
+            return int(fail.value.status) >= 500
+        except (TypeError, ValueError):
+            return True
+    return True
+
+
+def isCancellation(fail):
+    """
+    Decide whether a failed call was cancelled. Twisted's HTTP client
+    reports a cancelled request as a C{ResponseNeverReceived} or
+    C{ResponseFailed} wrapping the C{CancelledError}.
+
+    @param fail: The C{Failure} of the call.
+    @return: C{True} if the call was cancelled.
+    """
+    if fail.check(defer.CancelledError):
+        return True
+    return any(reason.check(defer.CancelledError)
+               for reason in getattr(fail.value, 'reasons', ()))
+
+
+def jitteredBackoff(retries, initialDelay, maxDelay):
+    """
+    Produce the delays before each attempt at a call. Each retry waits a
+    random time up to an exponentially growing limit, so that clients that
+    failed together do not all retry together.
+
+    @param retries: The C{int} number of retries to allow.
+    @param initialDelay: The C{float} limit on the first retry delay.
+    @param maxDelay: The C{float} largest limit on a retry delay.
+    @return: A generator of C{float} delays, starting with zero for the
+        first attempt.
+    """
+    yield 0.0
+    limit = initialDelay
+    for i in range(retries):
+        yield uniform(0, min(limit, maxDelay))
+        limit *= 2
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling a backend that keeps failing. After C{threshold}
+    consecutive failures the breaker opens and calls fail fast. After
+    C{resetTimeout} seconds one trial call is let through (half-open); if
+    it succeeds the breaker closes again, otherwise it re-opens.
+
+    @param name: The C{str} name of the backend, for log messages.
+    @param threshold: The C{int} number of consecutive failures that opens
+        the breaker.
+    @param resetTimeout: The C{int} number of seconds to stay open before
+        trying the backend again.
+    @param clock: An C{IReactorTime} provider, used to find out the
+        current time. If C{None}, the global reactor is used.
+    """
+
+    def __init__(self, name, threshold, resetTimeout, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._name = name
+        self._threshold = threshold
+        self._resetTimeout = resetTimeout
+        self._clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self._openedAt = None
+        self._trialUnderway = False
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        """
+        Decide whether a call may be made now.
+
+        @return: C{True} if the call may go ahead.
+        """
+        if self.state == OPEN:
+            if self._clock.seconds() - self._openedAt < self._resetTimeout:
+                self.rejected += 1
+                return False
+            self._setState(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._trialUnderway:
+                self.rejected += 1
+                return False
+            self._trialUnderway = True
+        return True
+
+    def succeeded(self):
+        """
+        Record a successful call.
+        """
+        self.failures = 0
+        self._trialUnderway = False
+        if self.state != CLOSED:
+            self._setState(CLOSED)
+
+    def failed(self):
+        """
+        Record a failed call.
+        """
+        self.failures += 1
+        self._trialUnderway = False
+        if (self.state == HALF_OPEN or
+                (self.state == CLOSED and self.failures >= self._threshold)):
+            self._openedAt = self._clock.seconds()
+            self.opened += 1
+            self._setState(OPEN)
+
+    def cancelled(self):
+        """
+        Record a call that was cancelled by its caller, which says nothing
+        about the backend. If it was the half-open trial, another call may
+        now be the trial.
+        """
+        self._trialUnderway = False
+
+    def _setState(self, state):
+        """
+        Change state, logging the transition.
+
+        @param state: The new C{str} state.
+        """
+        logger.warning('breaker-state', backend=self._name,
+                       old=self.state, new=state)
+        self.state = state
+
+
+class RetryBudget(object):
+    """
+    Limit retries to a fraction of the calls made, so that retrying cannot
+    multiply the load on a backend that is already struggling.
+
+    @param ratio: The C{float} number of retries each call earns.
+    @param maxTokens: The C{float} largest number of retries that can be
+        saved up.
+    """
+
+    def __init__(self, ratio, maxTokens):
+        self._ratio = ratio
+        self._maxTokens = maxTokens
+        self._tokens = maxTokens
+
+    def deposit(self):
+        """
+        Record that a call is being made.
+        """
+        self._tokens = min(self._maxTokens, self._tokens + self._ratio)
+
+    def withdraw(self):
+        """
+        Ask to make a retry.
+
+        @return: C{True} if the retry is within budget.
+        """
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+
+class Backend(object):
+    """
+    Make calls to a remote backend with a deadline on each attempt, a limit
+    on the number of calls underway, retries with jitter (within a retry
+    budget) and a circuit breaker.
+
+    @param breaker: The L{CircuitBreaker} for the backend.
+    @param budget: The L{RetryBudget} for the backend.
+    @param maxConcurrent: The C{int} largest number of calls underway at
+        once. Further calls wait their turn.
+    @param deadline: The C{float} number of seconds an attempt may take
+        before it is cancelled.
+    @param retries: The C{int} largest number of retries of a call.
+    @param clock: An C{IReactorTime} provider, used to schedule timeouts
+        and retries. If C{None}, the global reactor is used.
+    """
+
+    # The limits on the delays before retries, in seconds.
+    _INITIAL_DELAY = 0.05
+    _MAX_DELAY = 1.0
+
+    def __init__(self, breaker, budget, maxConcurrent, deadline, retries,
+                 clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.breaker = breaker
+        self._budget = budget
+        self._semaphore = defer.DeferredSemaphore(maxConcurrent)
+        self._deadline = deadline
+        self._retries = retries
+        self._clock = clock
+        self.timeouts = 0
+        self.retried = 0
+
+    def call(self, f, *args, **kwargs):
+        """
+        Call a function that talks to the backend.
+
+        @param f: A function returning a C{Deferred}.
+        @param args: Positional arguments for C{f}.
+        @param kwargs: Keyword arguments for C{f}.
+        @return: A C{Deferred} that fires with the result of C{f}, or
+            fails with L{CircuitOpenError} if the breaker is open.
+        """
+        if not self.breaker.allow():
+            return defer.fail(CircuitOpenError())
+        self._budget.deposit()
+        delays = jitteredBackoff(self._retries, self._INITIAL_DELAY,
+                                 self._MAX_DELAY)
+        d = self._semaphore.run(self._attempt, next(delays), delays, f,
+                                args, kwargs)
+        d.addCallbacks(self._succeeded, self._failed)
+        return d
+
+    def _attempt(self, delay, delays, f, args, kwargs):
+        """
+        Make an attempt at a call, after a delay.
+
+        @param delay: The C{float} number of seconds to wait first.
+        @param delays: An iterator of C{float} delays before any retries.
+        @param f: A function returning a C{Deferred}.
+        @param args: Positional arguments for C{f}.
+        @param kwargs: Keyword arguments for C{f}.
+        @return: A C{Deferred} that fires with the result of C{f}.
+        """
+        d = task.deferLater(self._clock, delay, self._withDeadline,
+                            f, args, kwargs)
+        d.addErrback(self._retry, delays, f, args, kwargs)
+        return d
+
+    def _withDeadline(self, f, args, kwargs):
+        """
+        Call a function, cancelling its C{Deferred} if it takes too long.
+
+        @param f: A function returning a C{Deferred}.
+        @param args: Positional arguments for C{f}.
+        @param kwargs: Keyword arguments for C{f}.
+        @return: A C{Deferred} that fires with the result of C{f}, or
+            fails with C{twisted.internet.error.TimeoutError}.
+        """
+        d = defer.maybeDeferred(f, *args, **kwargs)
+        timedOut = []
+
+        def _timeout():
+            timedOut.append(True)
+            self.timeouts += 1
+            d.cancel()
+
+        def _cancelTimeout(result):
+            if delayedCall.active():
+                delayedCall.cancel()
+            return result
+
+        def _convertCancel(fail):
+            if timedOut and isCancellation(fail):
+                raise error.TimeoutError(
+                    'Backend call took more than %s seconds.' %
+                    self._deadline)
+            return fail
+
+        delayedCall = self._clock.callLater(self._deadline, _timeout)
+        d.addBoth(_cancelTimeout)
+        d.addErrback(_convertCancel)
+        return d
+
+    def _retry(self, fail, delays, f, args, kwargs):
+        """
+        Retry a failed attempt, if it failed in a way worth retrying and
+        there are retries and budget left.
+
+        @param fail: The C{Failure} of the attempt.
+        @param delays: An iterator of C{float} delays before any retries.
+        @param f: A function returning a C{Deferred}.
+        @param args: Positional arguments for C{f}.
+        @param kwargs: Keyword arguments for C{f}.
+        @return: C{fail}, or a C{Deferred} for the next attempt.
+        """
+        if isCancellation(fail):
+            # Cancelled by the caller, who no longer wants the result.
+            return failure.Failure(defer.CancelledError())
+        if not isBackendFailure(fail):
+            return fail
+        delay = next(delays, None)
+        if delay is None or not self._budget.withdraw():
+            return fail
+        self.retried += 1
+        return self._attempt(delay, delays, f, args, kwargs)
+
+    def stats(self):
+        """
+        Get the backend's state and counters.
+
+        @return: A C{dict} describing the backend.
+        """
+        return {
+            'breaker': self.breaker.state,
+            'consecutiveFailures': self.breaker.failures,
+            'opened': self.breaker.opened,
+            'rejected': self.breaker.rejected,
+            'retried': self.retried,
+            'timeouts': self.timeouts,
+        }
+
+    def _succeeded(self, result):
+        self.breaker.succeeded()
+        return result
+
+    def _failed(self, fail):
+        if isCancellation(fail):
+            self.breaker.cancelled()
+        elif isBackendFailure(fail):
+            self.breaker.failed()
+        else:
+            self.breaker.succeeded()
+        return fail
@@ -0,0 +1,510 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from twisted.internet.error import TimeoutError
+
+from txfluiddb.client import Namespace, Values
+from txfluiddb.http import HTTPError
+
+from lastpage.eventlog import logger
+from lastpage.resilience import CircuitOpenError, isBackendFailure
+
+# The possible outcomes of resolving a lastpage tag. A resolved result is a
+# (kind, value) tuple, where the value depends on the kind:
+#
+#   REDIRECT: the C{str} URL to redirect to.
+#   MULTIPLE_PAGES: a C{list} of C{str} fluiddb/about values.
+#   NO_PAGES: C{None}, the tag is not on any object.
+#   NO_USER: C{None}, there is no such user.
+#   NOT_A_URL: the C{str} fluiddb/about value that does not look like a URL.
+REDIRECT = 'redirect'
+MULTIPLE_PAGES = 'multiple-pages'
+NO_PAGES = 'no-pages'
+NO_USER = 'no-user'
+NOT_A_URL = 'not-a-url'
+
+# The largest number of tags to ask for in one /values query, to keep the
+# URL to a reasonable length.
+_TAGS_PER_QUERY = 50
+
+
+def _aboutToStr(about):
+    """
+    Convert a fluiddb/about value to a C{str}.
+
+    @param about: The C{unicode} fluiddb/about value of an object.
+    @return: A 2-tuple of the C{str} value and a C{bool} that is C{True} if
+        the conversion was clean. If the value cannot be encoded as ASCII,
+        its C{repr} is returned instead so it can still be displayed.
+    """
+    try:
+        return str(about), True
+    except UnicodeEncodeError:
+        logger.warning('about-not-str', about=about)
+        return '%r' % (about,), False
+
+
+def _resultFromAbouts(abouts):
+    """
+    Turn the fluiddb/about values of the objects a tag is on into a
+    (kind, value) tuple.
+
+    @param abouts: A C{list} of C{unicode} fluiddb/about values.
+    @return: A (kind, value) result tuple.
+    """
+    if not abouts:
+        return (NO_PAGES, None)
+    elif len(abouts) == 1:
+        url, clean = _aboutToStr(abouts[0])
+        if clean and url.startswith('http'):
+            return (REDIRECT, url)
+        else:
+            return (NOT_A_URL, url)
+    else:
+        return (MULTIPLE_PAGES, [_aboutToStr(about)[0] for about in abouts])
+
+
+def _isLastpageTag(tag):
+    """
+    Decide whether a tag is a lastpage tag.
+
+    @param tag: A C{txfluiddb.client.Tag}.
+    @return: C{True} if the tag is called C{lastpage} or C{lastpage-*}.
+    """
+    name = tag.components[-1]
+    return name == u'lastpage' or name.startswith(u'lastpage-')
+
+
+def tagPath(who, rest):
+    """
+    Make the path of the lastpage tag a lookup is for.
+
+    @param who: The C{unicode} username.
+    @param rest: The C{unicode} variant, e.g. C{u'work'}, or C{u''} for the
+        user's main lastpage tag.
+    @return: The C{unicode} tag path, e.g. C{u'terry/lastpage-work'}.
+    """
+    if rest:
+        return u'%s/lastpage-%s' % (who, rest)
+    return u'%s/lastpage' % who
+
+
+class Resolver(object):
+    """
+    Resolve lastpage tags to results, using Fluidinfo and a cache of
+    earlier results.
+
+    Concurrent requests for the same tag share a single Fluidinfo query.
+    Once a cached result has expired, it continues to be served (if the
+    cache still considers it fresh enough) while one query runs in the
+    background to refresh it.
+
+    Results saying there is no such user or no tagged page are cached for
+    a shorter time than others. Users found not to exist are remembered,
+    so lookups of any of their tags need no query, and users found to
+    exist are added to a Bloom filter, so that a missing tag for a known
+    user needs no second query to check whether the user exists. (A false
+    positive from the filter means the no-pages page is shown instead of
+    the no-user page.)
+
+    In whole-user mode, looking up any tag of a user fetches all their
+    lastpage tags, with a namespace listing and a single /values query,
+    and caches the results for all of them. Lookups of the user's other
+    tags then need no query.
+
+    @param endpoint: The C{txfluiddb.client.Endpoint} to query.
+    @param cache: A L{lastpage.cache.ResultCache} holding resolved
+        results, keyed by tag path.
+    @param negativeTTL: The C{int} number of seconds to cache L{NO_USER}
+        and L{NO_PAGES} results for.
+    @param missingUsers: A L{lastpage.cache.ResultCache} of usernames that
+        do not exist.
+    @param knownUsers: A L{lastpage.bloom.BloomFilter} of usernames that
+        exist.
+    @param wholeUser: If C{True}, resolve all of a user's lastpage tags
+        whenever one of them is looked up.
+    """
+
+    def __init__(self, endpoint, cache, negativeTTL, missingUsers,
+                 knownUsers, wholeUser=False):
+        self._endpoint = endpoint
+        self._cache = cache
+        self._negativeTTL = negativeTTL
+        self._missingUsers = missingUsers
+        self._knownUsers = knownUsers
+        self._wholeUser = wholeUser
+        # Maps tag paths that have a query underway to the list of
+        # Deferreds waiting for the result of that query.
+        self._inFlight = {}
+        # Maps usernames that have a whole-user query underway to the list
+        # of Deferreds waiting for the result of that query.
+        self._usersInFlight = {}
+        self.queries = 0
+        self.coalesced = 0
+
+    def resolve(self, who, tag):
+        """
+        Find out what a user's tag resolves to.
+
+        @param who: The C{unicode} username the tag belongs to.
+        @param tag: The C{unicode} path name of the tag to query for.
+        @return: A C{Deferred} that fires with a (kind, value) result
+            tuple, as described at the top of this module.
+        """
+        result = self._cache.get(tag)
+        if result is not None:
+            return defer.succeed(result)
+        stale = self._cache.getStale(tag)
+        if stale is None:
+            d = defer.Deferred()
+            waiting = [d]
+        else:
+            d = defer.succeed(stale)
+            waiting = []
+        if tag in self._inFlight:
+            self.coalesced += 1
+            self._inFlight[tag].extend(waiting)
+        else:
+            # Register the waiting list before querying, in case the query
+            # finishes synchronously.
+            self._inFlight[tag] = waiting
+            self.queries += 1
+            query = self._query(who, tag)
+            query.addBoth(self._finishQuery, tag)
+        return d
+
+    def refresh(self, who, tag):
+        """
+        Query a tag again, even if it has a fresh cached result, and cache
+        the new result. Lookups meanwhile get the cached result.
+
+        @param who: The C{unicode} username the tag belongs to.
+        @param tag: The C{unicode} path name of the tag to query for.
+        """
+        if tag in self._inFlight:
+            return
+        self._inFlight[tag] = []
+        self.queries += 1
+        query = self._query(who, tag)
+        query.addBoth(self._finishQuery, tag)
+
+    def invalidate(self, users=(), tags=(), refresh=False):
+        """
+        Forget (or refresh) what is known about some users and tags, e.g.
+        because they have been changed in Fluidinfo.
+
+        @param users: A sequence of C{unicode} usernames, all of whose
+            cached tags are to be invalidated.
+        @param tags: A sequence of C{unicode} tag paths to invalidate.
+        @param refresh: If C{True}, query the tags again, serving their
+            cached results until the new ones arrive, rather than just
+            removing them from the cache.
+        @return: A sorted C{list} of the C{unicode} tag paths affected.
+        """
+        users = set(users)
+        for who in users:
+            self._missingUsers.delete(who)
+        affected = set(tags)
+        if users:
+            affected.update(tag for tag in self._cache.keys()
+                            if tag.split(u'/', 1)[0] in users)
+        for tag in affected:
+            if refresh:
+                self.refresh(tag.split(u'/', 1)[0], tag)
+            else:
+                self._cache.delete(tag)
+        return sorted(affected)
+
+    def restore(self, tag, result, expires):
+        """
+        Put back a result saved earlier (e.g. in a snapshot written before
+        a restart). Once it expires, it is served while being refreshed,
+        as usual.
+
+        @param tag: The C{unicode} tag path.
+        @param result: The (kind, value) result tuple.
+        @param expires: The C{float} time the result stops being fresh.
+        @return: C{True} if the result was restored.
+        """
+        if not self._cache.restore(tag, result, expires):
+            return False
+        if result[0] != NO_USER:
+            self._knownUsers.add(tag.split(u'/', 1)[0])
+        return True
+
+    def _finishQuery(self, result, tag):
+        """
+        Cache the result of a finished query and pass it to everyone
+        waiting for it.
+
+        @param result: The (kind, value) result tuple, or a C{Failure}.
+        @param tag: The C{unicode} tag path the result is for.
+        """
+        waiting = self._inFlight.pop(tag)
+        if isinstance(result, Failure):
+            if result.check(CircuitOpenError, TimeoutError):
+                # Fluidinfo is unavailable. An old answer is better than
+                # none.
+                last = self._cache.getLast(tag)
+                if last is not None:
+                    for d in waiting:
+                        d.callback(last)
+                    return
+            if not waiting:
+                # This was a background refresh, so nobody else will
+                # report the error.
+                logger.failure(result, 'refresh-failed', tag=tag)
+        else:
+            self._cacheResult(tag, result)
+        for d in waiting:
+            d.callback(result)
+
+    def _query(self, who, tag):
+        """
+        Ask Fluidinfo for the fluiddb/about values of the objects that have
+        C{tag} on them.
+
+        @param who: The C{unicode} username the tag belongs to.
+        @param tag: The C{unicode} path name of the tag to query for.
+        @return: A C{Deferred} that fires with a (kind, value) result tuple.
+        """
+        if self._missingUsers.get(who) is not None:
+            return defer.succeed((NO_USER, None))
+        if self._wholeUser:
+            d = self._queryUser(who)
+            d.addCallback(self._pickTag, tag)
+            d.addErrback(self._queryTagInstead, who, tag)
+        else:
+            d = self._queryTag(who, tag)
+        d.addCallback(self._noteUser, who)
+        return d
+
+    def _queryTag(self, who, tag):
+        """
+        Ask Fluidinfo for the fluiddb/about values of the objects that have
+        C{tag} on them, and nothing else.
+
+        @param who: The C{unicode} username the tag belongs to.
+        @param tag: The C{unicode} path name of the tag to query for.
+        @return: A C{Deferred} that fires with a (kind, value) result tuple.
+        """
+        query = u'has %s' % tag
+        d = Values().get(self._endpoint, query, tags=[u'fluiddb/about'])
+        d.addCallback(self._parseValues)
+        d.addErrback(self._checkNonexistentTag, who)
+        return d
+
+    def _cacheResult(self, tag, result):
+        """
+        Cache the result for a tag.
+
+        @param tag: The C{unicode} tag path.
+        @param result: The (kind, value) result tuple.
+        """
+        if result[0] in (NO_USER, NO_PAGES):
+            self._cache.set(tag, result, self._negativeTTL)
+        else:
+            self._cache.set(tag, result)
+
+    def _queryUser(self, who):
+        """
+        Resolve all of a user's lastpage tags, and cache their results.
+        Concurrent calls for the same user share one set of queries.
+
+        @param who: The C{unicode} username.
+        @return: A C{Deferred} that fires with a C{dict} mapping the
+            C{unicode} paths of the user's lastpage tags to (kind, value)
+            result tuples, or with C{None} if the user does not exist.
+        """
+        d = defer.Deferred()
+        if who in self._usersInFlight:
+            self.coalesced += 1
+            self._usersInFlight[who].append(d)
+            return d
+        self._usersInFlight[who] = [d]
+        query = Namespace(who).getTags(self._endpoint)
+        query.addCallback(self._queryUserTags)
+        query.addErrback(self._checkNonexistentNamespace)
+        query.addBoth(self._finishUserQuery, who)
+        return d
+
+    def _queryUserTags(self, tags):
+        """
+        Resolve the lastpage tags in a user's namespace, with one /values
+        query (unless the user has a great many of them).
+
+        @param tags: A C{list} of the C{txfluiddb.client.Tag}s in the
+            user's namespace.
+        @return: A C{Deferred} that fires with a C{dict} mapping tag paths
+            to (kind, value) result tuples.
+        """
+        paths = [u'/'.join(tag.components) for tag in tags
+                 if _isLastpageTag(tag)]
+        queries = [self._queryTags(paths[i:i + _TAGS_PER_QUERY])
+                   for i in range(0, len(paths), _TAGS_PER_QUERY)]
+        d = defer.gatherResults(queries, consumeErrors=True)
+
+        def _merge(resultDicts):
+            results = {}
+            for resultDict in resultDicts:
+                results.update(resultDict)
+            return results
+
+        d.addCallbacks(_merge, lambda fail: fail.value.subFailure)
+        return d
+
+    def _queryTags(self, paths):
+        """
+        Ask Fluidinfo which objects have any of several tags on them.
+
+        @param paths: A C{list} of C{unicode} tag paths.
+        @return: A C{Deferred} that fires with a C{dict} mapping each tag
+            path to its (kind, value) result tuple.
+        """
+        def _parse(result):
+            abouts = dict((path, []) for path in paths)
+            for obj in result['results']['id'].itervalues():
+                for path in paths:
+                    if path in obj:
+                        abouts[path].append(obj['fluiddb/about']['value'])
+            return dict((path, _resultFromAbouts(pathAbouts))
+                        for path, pathAbouts in abouts.iteritems())
+
+        query = u' or '.join([u'has %s' % path for path in paths])
+        d = Values().get(self._endpoint, query,
+                         tags=[u'fluiddb/about'] + paths)
+        d.addCallback(_parse)
+        return d
+
+    def _checkNonexistentNamespace(self, fail):
+        """
+        Handle an error in listing a user's tags.
+
+        @param fail: The Twisted failure.
+        @return: C{None} if the user's namespace does not exist, else
+            C{fail}.
+        """
+        fail.trap(HTTPError)
+        if str(fail.value.status) == '404':
+            return None
+        return fail
+
+    def _finishUserQuery(self, result, who):
+        """
+        Cache the results of a finished whole-user query and pass them to
+        everyone waiting for them.
+
+        @param result: A C{dict} mapping tag paths to (kind, value) result
+            tuples, C{None} if the user does not exist, or a C{Failure}.
+        @param who: The C{unicode} username.
+        """
+        waiting = self._usersInFlight.pop(who)
+        if isinstance(result, Failure):
+            for d in waiting:
+                d.errback(result)
+            return
+        if result is not None:
+            for tag, tagResult in result.iteritems():
+                self._cacheResult(tag, tagResult)
+        for d in waiting:
+            d.callback(result)
+
+    def _pickTag(self, results, tag):
+        """
+        Pick the result for one tag out of the results of a whole-user
+        query.
+
+        @param results: A C{dict} mapping tag paths to (kind, value) result
+            tuples, or C{None} if the user does not exist.
+        @param tag: The C{unicode} path name of the tag wanted.
+        @return: A (kind, value) result tuple.
+        """
+        if results is None:
+            return (NO_USER, None)
+        # The user exists, but does not have this tag.
+        return results.get(tag, (NO_PAGES, None))
+
+    def _queryTagInstead(self, fail, who, tag):
+        """
+        Fall back to querying a single tag if a whole-user query failed
+        with a client error, e.g. because one of the user's other tags
+        cannot be read.
+
+        @param fail: The Twisted failure of the whole-user query.
+        @param who: The C{unicode} username the tag belongs to.
+        @param tag: The C{unicode} path name of the tag wanted.
+        @return: C{fail} if the error was not a client error, else a
+            C{Deferred} that fires with a (kind, value) result tuple.
+        """
+        fail.trap(HTTPError)
+        if isBackendFailure(fail):
+            return fail
+        return self._queryTag(who, tag)
+
+    def _noteUser(self, result, who):
+        """
+        Remember whether a user exists, given the result of a query for one
+        of their tags.
+
+        @param result: The (kind, value) result tuple.
+        @param who: The C{unicode} username the tag belongs to.
+        @return: C{result}, so callbacks further down the chain get it.
+        """
+        if result[0] == NO_USER:
+            self._missingUsers.set(who, True)
+        else:
+            self._knownUsers.add(who)
+        return result
+
+    def _parseValues(self, result):
+        """
+        Turn the result of a /values query into a (kind, value) tuple.
+
+        @param result: The C{dict} result of the /values query.
+        @return: A (kind, value) result tuple.
+        """
+        return _resultFromAbouts(
+            [obj['fluiddb/about']['value']
+             for obj in result['results']['id'].itervalues()])
+
+    def _checkNonexistentTag(self, fail, who):
+        """
+        Handle an error in the /values query. A non-existent tag could be
+        due to the user not existing or the tag not existing, so find out
+        which so we can be as helpful as possible in the error message.
+
+        @param fail: The Twisted failure.
+        @param who: The C{unicode} username the tag belongs to.
+        @return: C{fail} if the error is not due to a non-existent tag,
+            else a C{Deferred} that fires with a (kind, value) result tuple.
+        """
+        fail.trap(HTTPError)
+        errorClass = fail.value.response_headers.get('x-fluiddb-error-class')
+        if errorClass:
+            if errorClass[0] == 'TNonexistentTag':
+                if who in self._knownUsers:
+                    return (NO_PAGES, None)
+                d = Namespace(who).exists(self._endpoint)
+                d.addCallback(
+                    lambda exists: (NO_PAGES, None) if exists else
+                    (NO_USER, None))
+                return d
+            logger.warning('fluidinfo-error', errorClass=errorClass[0])
+        else:
+            logger.warning('fluidinfo-error',
+                           headers=fail.value.response_headers)
+        return fail
@@ -12,63 +12,151 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
-from jinja2.exceptions import TemplateNotFound
+from itertools import islice
+import sqlite3
+from time import time
 
-from random import randrange
-
-from twisted.python import log
+from twisted.internet import task
 from twisted.web import resource, http, server
 from twisted.web.resource import ErrorPage
-from twisted.web.static import File
-
-from txfluiddb.client import Endpoint, Namespace, Values
-from txfluiddb.http import HTTPError
 
+from lastpage.api import Api
+from lastpage.assets import loadStaticFiles
 from lastpage.callback import Callback
+from lastpage.eventlog import logger, requestId
 from lastpage.login import Login
 from lastpage.logout import Logout
+from lastpage.metrics import registry
+from lastpage.ratelimit import TooManyRequests, clientAddress
+from lastpage.resolver import (
+    REDIRECT, MULTIPLE_PAGES, NOT_A_URL, NO_USER, tagPath)
+from lastpage.store import sessionStoreErrors
 
-# Content we serve statically, if static files are not being served by some
-# other means (e.g., nginx).
-_staticFiles = {
-    '/static/favicon.ico': 'static/favicon.ico',
-    '/robots.txt': 'static/robots.txt',
-    '/static/bullet.png': 'static/bullet.png',
-    '/static/icon.png': 'static/icon.png',
-    '/static/login.png': 'static/login.png',
-    '/static/logo.png': 'static/logo.png',
-    '/static/style.css': 'static/style.css',
-}
 
-
-def _requestId():
+def _pageLink(about):
     """
-    Make a (fairly) unique request id for matching up error pages with
-    errors in our logs.
+    Make the HTML to show a tagged object with on the multiple pages page.
 
-    @return: a random C{str} identifier.
+    @param about: The C{str} fluiddb/about value of the object.
+    @return: A link to C{about} if it looks like a URL, else C{about}.
     """
-    return ''.join([chr(ord('a') + randrange(0, 26)) for i in range(16)])
+    if about.startswith('http'):
+        return '<a href="%s">%s</a>' % (about, about)
+    return about
+
+_routing = registry.histogram(
+    'lastpage_routing_seconds',
+    'Time taken to find the resource for a request, by kind of resource.',
+    ('route',))
+_STATIC_ROUTE = _routing.labels('static')
+_PAGE_ROUTE = _routing.labels('page')
+_USER_ROUTE = _routing.labels('user')
+_lookups = registry.counter(
+    'lastpage_lookups_total', 'User tag lookups, by outcome.', ('outcome',))
+_sessionLookups = registry.histogram(
+    'lastpage_session_lookup_seconds',
+    'Time taken to look up the session of a logged-in user.')
 
 
 class LastPage(resource.Resource):
     """
     Top-level resource for the lastpage.me service.
 
-    @param conf: A L{config.Config} instance holding configuration
-        settings.
-    @param env: The Jinja2 C{Environment} to use for rendering.
-    @param cookieDict: a C{dict} that maps cookies to OAuth token keys.
-    @param oauthTokenDict: a C{dict} that maps OAuth token keys to tokens.
+    @param config: The L{lastpage.reload.LiveConfig} holding the current
+        configuration settings. Those that are only used here when the
+        service starts need a restart to change.
+    @param templates: The L{lastpage.render.Templates} to render pages
+        with.
+    @param sessions: The L{lastpage.store.ISessionStore} holding logged-in
+        user sessions.
+    @param tokens: The L{lastpage.store.ITokenStore} holding pending OAuth
+        request tokens.
+    @param resolver: The L{lastpage.resolver.Resolver} used to resolve user
+        tags.
+    @param httpClient: The L{lastpage.httpclient.HTTPClient} used for
+        outgoing requests.
+    @param twitter: The L{lastpage.resilience.Backend} for Twitter.
+    @param profiles: The L{lastpage.cache.ResultCache} of verified Twitter
+        user profiles.
+    @param limiters: A C{dict} mapping the budgets C{'lookup'}, C{'login'}
+        and C{'callback'} to the L{lastpage.ratelimit.RateLimiter}s that
+        limit how often each client may spend them. A budget that is not
+        in the C{dict} is unlimited.
     """
     allowedMethods = ('GET',)
 
-    def __init__(self, conf, env, cookieDict, oauthTokenDict):
+    def __init__(self, config, templates, sessions, tokens, resolver,
+                 httpClient, twitter, profiles, limiters=None):
         resource.Resource.__init__(self)
-        self._conf = conf
-        self._env = env
-        self._cookieDict = cookieDict
-        self._oauthTokenDict = oauthTokenDict
+        conf = config.current
+        self._config = config
+        self._templates = templates
+        self._resolver = resolver
+        self._limiters = limiters or {}
+        self._trustedProxies = frozenset(conf.trusted_proxies.split())
+        config.onChange(self._configChanged)
+
+        # Build the resources for everything other than user lookups once,
+        # up front, so that routing a request to one is a dict lookup.
+        # Content we serve statically, if static files are not being served
+        # by some other means (e.g., nginx).
+        if conf.serve_static_files:
+            self._static = loadStaticFiles(conf.filesystem_root_dir,
+                                           conf.static_max_age)
+        else:
+            self._static = {}
+
+        self._routes = {
+            '_api_': Api(resolver, conf.api_max_keys,
+                         lambda request, count: self._limit(
+                             'lookup', request, count)),
+            '_login_': Login(sessions, tokens, config, httpClient, twitter),
+            '_logout_': Logout(sessions, config),
+            '_callback_': Callback(sessions, tokens, config, httpClient,
+                                   twitter, templates, profiles),
+        }
+        # There could in theory be a user whose name ends in .html, but
+        # only if it is not the name of one of our templates.
+        for name in templates:
+            if name.endswith('.html'):
+                self._routes[name] = Page(config, templates, sessions, name)
+        self._routes[''] = self._routes['index.html']
+        # The budgets that requests to our special endpoints spend. Each
+        # of them makes remote calls. The API spends lookups itself, one
+        # for each key it is asked for.
+        self._routeBudgets = {
+            '_login_': 'login',
+            '_callback_': 'callback',
+        }
+
+    def _configChanged(self, old, new):
+        """
+        Pick up a reloaded configuration.
+
+        @param old: The previous L{config.Config}.
+        @param new: The new L{config.Config}.
+        """
+        self._trustedProxies = frozenset(new.trusted_proxies.split())
+
+    def _limit(self, budget, request, count=1):
+        """
+        Spend some of the budget of the client that made a request.
+
+        @param budget: The C{str} name of the budget.
+        @param request: A twisted.web HTTP C{Request}.
+        @param count: The C{int} amount of the budget to spend.
+        @return: C{None} if the client may go ahead, else a resource to
+            refuse the request with.
+        """
+        limiter = self._limiters.get(budget)
+        if limiter is None:
+            return None
+        address = clientAddress(request, self._trustedProxies)
+        retryAfter = limiter.take(address, count)
+        if retryAfter:
+            logger.info('rate-limited', budget=budget, client=address)
+            return TooManyRequests(retryAfter)
+        return None
 
     def getChild(self, what, request):
         """
@@ -77,38 +165,29 @@ class LastPage(resource.Resource):
         @param what: The thing (either a user name or an html page) wanted.
         @param request: A twisted.web HTTP C{Request}.
         """
+        start = time()
         # Serve static files.
-        if self._conf.serve_static_files:
-            path = request.path
-            if path in _staticFiles:
-                filename = _staticFiles[path]
-                log.msg('Serving static path %s -> %s.' % (path, filename))
-                request.setResponseCode(http.OK)
-                fileResource = File(filename)
-                fileResource.isLeaf = True
-                return fileResource
-
-        # Serve .html requests.
-        if what == '' or what.endswith('.html'):
-            try:
-                template = self._env.get_template(what or 'index.html')
-            except TemplateNotFound:
-                # There could in theory be a user whose name ends in .html,
-                # so we'll just let this go through.
-                pass
-            else:
-                self._template = template
-                return self
-
-        if what == '_login_':
-            return Login(self._cookieDict, self._oauthTokenDict, self._conf)
-        if what == '_logout_':
-            return Logout(self._cookieDict, self._conf)
-        if what == '_callback_':
-            return Callback(self._cookieDict, self._oauthTokenDict, self._conf)
-
-        log.msg('Request for path %s assumed to be a user URL lookup.' %
-                request.path)
+        if self._static:
+            static = self._static.get(request.path)
+            if static is not None:
+                _STATIC_ROUTE.observe(time() - start)
+                return static
+
+        # Serve .html pages and our special endpoints.
+        route = self._routes.get(what)
+        if route is not None:
+            budget = self._routeBudgets.get(what)
+            if budget is not None:
+                route = self._limit(budget, request) or route
+            _PAGE_ROUTE.observe(time() - start)
+            return route
+
+        logger.debug('user-lookup', path=request.path)
+        # Refuse abusive clients before they cost us any Fluidinfo calls.
+        refusal = self._limit('lookup', request)
+        if refusal is not None:
+            _USER_ROUTE.observe(time() - start)
+            return refusal
 
         # Serve normal user redirects.
         try:
@@ -118,31 +197,62 @@ class LastPage(resource.Resource):
         except UnicodeDecodeError:
             return ErrorPage(http.BAD_REQUEST, 'Bad URI UTF-8', 'Bad UTF-8')
 
-        if rest:
-            tag = u'%s/lastpage-%s' % (who, rest)
-        else:
-            tag = u'%s/lastpage' % who
-        return LastPageOf(self._conf, self._env, who, tag)
+        child = LastPageOf(self._config.current, self._templates,
+                           self._resolver, who, tagPath(who, rest))
+        _USER_ROUTE.observe(time() - start)
+        return child
+
+
+class Page(resource.Resource):
+    """
+    A top-level HTML page, like http://lastpage.me/tools.html
+
+    @param config: The L{lastpage.reload.LiveConfig} holding the current
+        configuration settings.
+    @param templates: The L{lastpage.render.Templates} to render pages
+        with.
+    @param sessions: The L{lastpage.store.ISessionStore} holding logged-in
+        user sessions.
+    @param name: The C{str} name of the page's template.
+    """
+    allowedMethods = ('GET',)
+    isLeaf = True
+
+    def __init__(self, config, templates, sessions, name):
+        resource.Resource.__init__(self)
+        self._config = config
+        self._templates = templates
+        self._sessions = sessions
+        self._name = name
 
     def render_GET(self, request):
         """
-        Handle a GET request. This is a request for a top-level HTML page
-        like http://lastpage.me/tools.html
+        Handle a GET request. If the user's session cannot be looked up,
+        they are shown the page as if they were not logged in.
 
         @param request: A twisted.web HTTP C{Request}.
         """
-        cookie = request.getCookie(self._conf.cookie_name)
-        print 'got cookie %r' % (cookie,)
-        try:
-            data = self._cookieDict[cookie]
-        except:
-            print 'missed on looking up cookie'
+        cookie = request.getCookie(self._config.current.cookie_name)
+        if cookie is None:
+            data = None
+        else:
+            start = time()
+            try:
+                data = self._sessions.get(cookie)
+            except sqlite3.OperationalError, e:
+                logger.warning('session-get-failed', error=str(e))
+                sessionStoreErrors.labels('get').inc()
+                data = None
+            _sessionLookups.observe(time() - start)
+        if data is None:
             username = None
         else:
-            print 'found cookie'
-            username = data[0]['screen_name']
-            # token = data[1]
-        return str(self._template.render(user=username))
+            username = data.screenName
+        # The page differs for each logged-in user, so don't let shared
+        # caches mix them up.
+        request.setHeader('vary', 'Cookie')
+        page = self._templates.page(self._name, username)
+        return page.render(request)
 
 
 class LastPageOf(resource.Resource):
@@ -152,17 +262,22 @@ class LastPageOf(resource.Resource):
 
     @param conf: A L{config.Config} instance holding configuration
         settings.
-    @param env: The Jinja2 C{Environment} to use for rendering.
+    @param templates: The L{lastpage.render.Templates} to render pages
+        with.
+    @param resolver: The L{lastpage.resolver.Resolver} to use to find out
+        what the tag resolves to.
     @param who: A C{unicode} username to redirect to, if possible.
     @param tag: The C{unicode} path name of the tag to query for.
     """
     allowedMethods = ('GET',)
     isLeaf = True
 
-    def __init__(self, conf, env, who, tag):
+    def __init__(self, conf, templates, resolver, who, tag):
         resource.Resource.__init__(self)
-        self._endpoint = Endpoint(baseURL=conf.fluidinfo_endpoint)
-        self._env = env
+        self._pageSize = conf.multiple_pages_page_size
+        self._chunkSize = conf.stream_chunk_size
+        self._templates = templates
+        self._resolver = resolver
         self._who = who
         self._tag = tag
 
@@ -174,155 +289,137 @@ class LastPageOf(resource.Resource):
         @return: the twisted.web constant C{server.NOT_DONE_YET} to indicate
             that the request processing is still underway.
         """
-        query = u'has %s' % self._tag
-        d = Values().get(self._endpoint, query, tags=[u'fluiddb/about'])
-        d.addCallback(self._finishHas, request)
-        d.addErrback(self._hasErr, request)
-        d.addErrback(log.err)
+        d = self._resolver.resolve(self._who, self._tag)
+        d.addCallback(self._finishResolve, request)
+        d.addErrback(self._oops, request)
+        d.addErrback(logger.failure, 'render-failed')
         return server.NOT_DONE_YET
 
-    def _hasErr(self, fail, request):
+    def _finishResolve(self, result, request):
         """
-        Handle an error in the GET on the user's tag.
+        Handle the result of resolving the user's tag. We route the result
+        and the request to a more specific method.
 
-        @param fail: the Twisted failure.
+        @param result: the (kind, value) tuple the tag resolved to.
         @param request: A twisted.web HTTP C{Request}.
         """
-        fail.trap(HTTPError)
-        errorClass = fail.value.response_headers.get('x-fluiddb-error-class')
-        if errorClass:
-            if errorClass[0] == 'TNonexistentTag':
-                # A non-existent tag could be due to the user not existing
-                # or the tag not existing. Find out which so we can be as
-                # helpful as possible in the error message.
-                d = Namespace(self._who).exists(self._endpoint)
-                d.addCallback(self._testUserExists, request)
-                d.addErrback(self._oops, request)
-                d.addErrback(log.err)
-                return d
-            error = 'Fluidinfo error class %s.' % errorClass[0]
+        kind, value = result
+        _lookups.labels(kind).inc()
+        if kind == REDIRECT:
+            self._redirect(value, request)
+        elif kind == MULTIPLE_PAGES:
+            return self._multipleObjectsTagged(value, request)
+        elif kind == NOT_A_URL:
+            self._notAURL(value, request)
+        elif kind == NO_USER:
+            self._noUser(request)
         else:
-            error = ('No x-fluiddb-error-class in response headers! %r' %
-                     fail.value.response_headers)
-
-        _id = _requestId()
-        log.msg('Error: request %s: %s' % (_id, error))
-        log.err(fail)
-        template = self._env.get_template('500.html')
-        request.write(str(template.render(id=_id)))
-        request.finish()
+            self._noObjectsTagged(request)
 
-    def _finishHas(self, result, request):
+    def _noObjectsTagged(self, request):
         """
-        Handle the result of the 'has username/lastpage' /values query. We
-        just figure out how many objects are tagged and route the results
-        (if any) and the request to a more specific method.
+        The user's tag is not on any object, so we cannot redirect them.
+        Instead, show an informative page to let them know what's up.
 
-        @param result: the result of the query.
         @param request: A twisted.web HTTP C{Request}.
         """
-        results = result['results']['id']
-        nResults = len(results)
-        if nResults == 0:
-            self._noObjectsTagged(request)
-        elif nResults == 1:
-            self._oneObjectTagged(results, request)
-        else:
-            self._multipleObjectsTagged(results, request)
+        request.write(self._templates.render(
+            'no-pages-tagged.html', user=self._who, tag=self._tag))
+        request.setResponseCode(http.OK)
+        request.finish()
 
-    def _noObjectsTagged(self, request):
+    def _noUser(self, request):
         """
-        The user's tag is not on any object, so we cannot redirect them.
-        Instead, show an informative page to let them know what's up.
+        The user does not exist, so we cannot redirect them. Show an
+        informative page to let them know what's up.
 
         @param request: A twisted.web HTTP C{Request}.
         """
-        template = self._env.get_template('no-pages-tagged.html')
-        request.write(str(template.render(user=self._who, tag=self._tag)))
+        request.write(self._templates.render(
+            'no-user.html', user=self._who, tag=self._tag))
         request.setResponseCode(http.OK)
         request.finish()
 
-    def _oneObjectTagged(self, results, request):
+    def _redirect(self, url, request):
         """
-        The user's tag is only on one object, so we can redirect them,
-        assuming the tag value looks like a URL.
+        The user's tag is only on one object, and its fluiddb/about value
+        looks like a URL, so redirect to it.
 
-        @param results: The C{dict} result from the /values call to
-            get the fluiddb/about value of the user's tagged object.
+        @param url: The C{str} URL to redirect to.
         @param request: A twisted.web HTTP C{Request}.
         """
-        url = results.values()[0]['fluiddb/about']['value']
-        try:
-            url = str(url)
-        except UnicodeEncodeError:
-            log.msg('Could not convert url %r to str.' % (url,))
-            # Display the offending URL in an ASCII representation of
-            # the unicode value.
-            url = '%r' % (url,)
-            request.setResponseCode(http.OK)
-            template = self._env.get_template('tag-not-a-url.html')
-            request.write(str(template.render(
-                user=self._who, tag=self._tag, about=url)))
-        else:
-            if url.startswith('http'):
-                log.msg('Redirect: %s -> %s' % (
-                    self._tag.encode('utf-8'), url))
-                request.setResponseCode(http.TEMPORARY_REDIRECT)
-                request.redirect(url)
-            else:
-                request.setResponseCode(http.OK)
-                template = self._env.get_template('tag-not-a-url.html')
-                request.write(str(template.render(
-                    user=self._who, tag=self._tag, about=url)))
+        logger.info('redirect', tag=self._tag, url=url)
+        request.setResponseCode(http.TEMPORARY_REDIRECT)
+        request.redirect(url)
         request.finish()
 
-    def _multipleObjectsTagged(self, results, request):
+    def _notAURL(self, about, request):
         """
-        The user's tag is on multiple objects, so we cannot redirect them,
-        to just one URL. Instead we display the fluiddb/about values of the
-        objects that are tagged.
+        The user's tag is only on one object, but its fluiddb/about value
+        does not look like a URL, so we cannot redirect them.
 
-        @param results: The C{dict} result from the /values call to
-            get the fluiddb/about value of the user's tagged object.
+        @param about: The C{str} fluiddb/about value of the tagged object.
         @param request: A twisted.web HTTP C{Request}.
         """
-        pages = []
-        for obj in results.values():
-            url = obj['fluiddb/about']['value']
-            try:
-                url = str(url)
-            except UnicodeEncodeError:
-                log.msg('Tag URL %r could not be converted to str' % url)
-                # Convert it to a string of some form, even though it's
-                # not going to be a valid URL.  We could UTF-8 and
-                # %-encode here but I'm not sure it's worth the
-                # trouble. So for now let's just display the Unicode.
-                url = '%r' % (url,)
-            else:
-                if url.startswith('http'):
-                    url = '<a href="%s">%s</a>' % (url, url)
-            pages.append(url)
-        request.setResponseCode(http.OK)
-        template = self._env.get_template('multiple-pages-tagged.html')
-        request.write(str(template.render(
-            user=self._who, tag=self._tag, pages=pages)))
         request.setResponseCode(http.OK)
+        request.write(self._templates.render(
+            'tag-not-a-url.html', user=self._who, tag=self._tag, about=about))
         request.finish()
 
-    def _testUserExists(self, exists, request):
+    def _multipleObjectsTagged(self, abouts, request):
         """
-        Produce an informative page to indicate that we can't help because
-        either the user doesn't exist or the tag isn't present.
+        The user's tag is on multiple objects, so we cannot redirect them,
+        to just one URL. Instead we display the fluiddb/about values of the
+        objects that are tagged.
 
-        @param exists: C{True} if the user exists, else C{False}.
+        A user may have tagged thousands of objects, so they are shown a
+        page at a time (chosen by the C{page} argument), and the page is
+        written in chunks as the template produces them, rather than being
+        rendered whole first.
+
+        @param abouts: A C{list} of the C{str} fluiddb/about values of the
+            tagged objects.
         @param request: A twisted.web HTTP C{Request}.
+        @return: A C{Deferred} that fires when the page has been written.
         """
-        if exists:
-            template = self._env.get_template('no-pages-tagged.html')
+        count = len(abouts)
+        if self._pageSize:
+            pageCount = max((count + self._pageSize - 1) // self._pageSize, 1)
         else:
-            template = self._env.get_template('no-user.html')
-        request.write(str(template.render(user=self._who, tag=self._tag)))
+            pageCount = 1
+        try:
+            page = int(request.args.get('page', ['1'])[0])
+        except ValueError:
+            page = 1
+        page = min(max(page, 1), pageCount)
+        if self._pageSize:
+            start = (page - 1) * self._pageSize
+            abouts = islice(abouts, start, start + self._pageSize)
         request.setResponseCode(http.OK)
+        chunks = self._templates.generate(
+            'multiple-pages-tagged.html', self._chunkSize, user=self._who,
+            tag=self._tag, pages=(_pageLink(about) for about in abouts),
+            count=count, page=page, pageCount=pageCount)
+        # Write a chunk at a time, letting other requests in between.
+        writer = task.cooperate(request.write(chunk) for chunk in chunks)
+        request.notifyFinish().addErrback(lambda _: writer.stop())
+        d = writer.whenDone()
+        d.addCallbacks(lambda _: request.finish(), self._streamFailed,
+                       errbackArgs=(request,))
+        return d
+
+    def _streamFailed(self, fail, request):
+        """
+        Give up on writing a page part way through. It is too late to send
+        an error page, so the response is just cut short.
+
+        @param fail: the Twisted failure.
+        @param request: A twisted.web HTTP C{Request}.
+        """
+        if fail.check(task.TaskStopped):
+            # The client went away.
+            return
+        logger.failure(fail, 'stream-failed', tag=self._tag)
         request.finish()
 
     def _oops(self, fail, request):
@@ -333,10 +430,8 @@ class LastPageOf(resource.Resource):
         @param fail: the Twisted failure.
         @param request: A twisted.web HTTP C{Request}.
         """
-        _id = _requestId()
-        log.msg('Error: returning a 500 error. Request id = %s' % _id)
-        log.err(fail)
+        _id = requestId()
+        logger.failure(fail, 'internal-error', id=_id)
         request.setResponseCode(http.INTERNAL_SERVER_ERROR)
-        template = self._env.get_template('500.html')
-        request.write(str(template.render(id=_id)))
+        request.write(self._templates.errorPage(_id))
         request.finish()
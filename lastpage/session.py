@@ -0,0 +1,115 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import struct
+
+from oauth.oauth import OAuthToken
+
+VERSION = 1
+
+# A version byte, then the screen name, access token key and access token
+# secret, each as a length byte followed by its bytes, padded with zeros.
+# Twitter screen names are at most 15 characters.
+_RECORD = struct.Struct('>B16p64p64p')
+_MAX_SCREEN_NAME = 15
+_MAX_TOKEN = 63
+
+
+class SessionRecord(object):
+    """
+    What we keep about a logged-in user: their Twitter screen name and
+    their access token, and nothing else from their profile. A record
+    packs into L{SIZE} bytes, so that it can be kept in a store shared by
+    several processes.
+
+    @param screenName: The user's C{unicode} Twitter screen name.
+    @param tokenKey: The C{str} key of the user's access token.
+    @param tokenSecret: The C{str} secret of the user's access token.
+    @raise ValueError: If a field is too long to pack.
+    """
+    __slots__ = ('screenName', 'tokenKey', 'tokenSecret')
+
+    def __init__(self, screenName, tokenKey, tokenSecret):
+        if len(screenName.encode('utf-8')) > _MAX_SCREEN_NAME:
+            raise ValueError('Screen name %r is too long.' % screenName)
+        if len(tokenKey) > _MAX_TOKEN or len(tokenSecret) > _MAX_TOKEN:
+            raise ValueError('Access token is too long.')
+        self.screenName = screenName
+        self.tokenKey = tokenKey
+        self.tokenSecret = tokenSecret
+
+    def __eq__(self, other):
+        if not isinstance(other, SessionRecord):
+            return NotImplemented
+        return (self.screenName == other.screenName and
+                self.tokenKey == other.tokenKey and
+                self.tokenSecret == other.tokenSecret)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return '<SessionRecord %s>' % self.screenName.encode('utf-8')
+
+    @classmethod
+    def fromProfile(cls, profile, accessToken):
+        """
+        Make a record for a user from their verify-credentials profile.
+
+        @param profile: The user's profile C{dict}.
+        @param accessToken: The user's C{OAuthToken} access token.
+        @return: A L{SessionRecord}.
+        """
+        return cls(profile['screen_name'], accessToken.key,
+                   accessToken.secret)
+
+    @property
+    def accessToken(self):
+        """
+        The user's C{OAuthToken} access token.
+        """
+        return OAuthToken(self.tokenKey, self.tokenSecret)
+
+    def pack(self):
+        """
+        Pack the record into bytes.
+
+        @return: A C{str} of L{SIZE} bytes.
+        """
+        return _RECORD.pack(VERSION, self.screenName.encode('utf-8'),
+                            self.tokenKey, self.tokenSecret)
+
+    @classmethod
+    def unpack(cls, data):
+        """
+        Unpack a record packed by L{pack}.
+
+        @param data: The C{str} bytes.
+        @raise ValueError: If C{data} is not a packed record.
+        @return: A L{SessionRecord}.
+        """
+        if len(data) != _RECORD.size:
+            raise ValueError('A session record is %d bytes, not %d.' %
+                             (_RECORD.size, len(data)))
+        version, screenName, tokenKey, tokenSecret = _RECORD.unpack(data)
+        if version != VERSION:
+            raise ValueError('Unknown session record version %d.' %
+                             version)
+        return cls(screenName.decode('utf-8'), tokenKey, tokenSecret)
+
+
+SIZE = _RECORD.size
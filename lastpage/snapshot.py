@@ -0,0 +1,326 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""
+Save resolved tag results to disk, so a restarted service can serve them
+at once instead of querying Fluidinfo for every tag again.
+
+A snapshot file is a header (the magic string C{LPCACHE} and a version
+byte), then one record per result, then an end record. A record is a
+kind byte, the C{double} expiry time and the length-prefixed UTF-8 tag
+path, followed by the value: a length-prefixed string for L{REDIRECT} and
+L{NOT_A_URL}, a count and that many length-prefixed strings for
+L{MULTIPLE_PAGES}, and nothing for L{NO_PAGES} and L{NO_USER}. The end
+record is a zero kind byte. All numbers are big-endian.
+"""
+
+import os
+import struct
+
+from twisted.application import service
+from twisted.internet import defer, task, threads
+
+from lastpage.eventlog import logger
+from lastpage.resolver import (
+    REDIRECT, MULTIPLE_PAGES, NO_PAGES, NO_USER, NOT_A_URL)
+
+MAGIC = 'LPCACHE'
+VERSION = 1
+
+_HEADER = struct.Struct('>7sB')
+_RECORD = struct.Struct('>BdH')
+_LENGTH = struct.Struct('>I')
+_END = 0
+
+_KIND_CODES = {
+    REDIRECT: 1,
+    MULTIPLE_PAGES: 2,
+    NO_PAGES: 3,
+    NO_USER: 4,
+    NOT_A_URL: 5,
+}
+_KINDS = dict((code, kind) for kind, code in _KIND_CODES.iteritems())
+
+
+class SnapshotError(Exception):
+    """
+    A snapshot file is not one we can read, or is damaged.
+    """
+
+
+def writeSnapshot(path, entries):
+    """
+    Write a snapshot file. It is written under a temporary name and then
+    renamed, so a reader never sees a partly written snapshot. The
+    temporary name includes the process id, as a replacement worker may
+    write while the worker it replaces is writing its last snapshot.
+
+    @param path: The C{str} path of the file.
+    @param entries: A C{list} of (tag path, expiry time, result)
+        C{tuple}s, as from L{lastpage.cache.ResultCache.entries}.
+    @return: The C{int} number of results written.
+    """
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION))
+        for tag, expires, (kind, value) in entries:
+            tag = tag.encode('utf-8')
+            f.write(_RECORD.pack(_KIND_CODES[kind], expires, len(tag)))
+            f.write(tag)
+            if kind in (REDIRECT, NOT_A_URL):
+                f.write(_LENGTH.pack(len(value)))
+                f.write(value)
+            elif kind == MULTIPLE_PAGES:
+                f.write(_LENGTH.pack(len(value)))
+                for about in value:
+                    f.write(_LENGTH.pack(len(about)))
+                    f.write(about)
+        f.write(chr(_END))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temporary, path)
+    return len(entries)
+
+
+class SnapshotReader(object):
+    """
+    Read the results in a snapshot file a batch at a time, so that a large
+    snapshot need not be held in memory all at once.
+
+    @param path: The C{str} path of the file.
+    @raise SnapshotError: If the file is not a snapshot of a version we
+        can read.
+    @raise IOError: If the file cannot be opened.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        header = self._file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            self.close()
+            raise SnapshotError('%s is not a snapshot.' % path)
+        magic, version = _HEADER.unpack(header)
+        if magic != MAGIC:
+            self.close()
+            raise SnapshotError('%s is not a snapshot.' % path)
+        if version != VERSION:
+            self.close()
+            raise SnapshotError('%s is a version %d snapshot.' %
+                                (path, version))
+
+    def _readExactly(self, size):
+        """
+        Read bytes from the file.
+
+        @param size: The C{int} number of bytes to read.
+        @raise SnapshotError: If the file ends first.
+        @return: The C{str} bytes.
+        """
+        data = self._file.read(size)
+        if len(data) < size:
+            raise SnapshotError('The snapshot is truncated.')
+        return data
+
+    def _readString(self):
+        """
+        Read a length-prefixed string from the file.
+
+        @return: The C{str} string.
+        """
+        length, = _LENGTH.unpack(self._readExactly(_LENGTH.size))
+        return self._readExactly(length)
+
+    def read(self, count):
+        """
+        Read the next batch of results. The file is closed once the end is
+        reached.
+
+        @param count: The C{int} largest number of results to read.
+        @raise SnapshotError: If the file is damaged.
+        @return: A C{list} of (tag path, expiry time, result) C{tuple}s,
+            which is empty once there are no more.
+        """
+        entries = []
+        while self._file is not None and len(entries) < count:
+            code = ord(self._readExactly(1))
+            if code == _END:
+                self.close()
+                break
+            try:
+                kind = _KINDS[code]
+            except KeyError:
+                raise SnapshotError('Unknown result kind %d.' % code)
+            rest = self._readExactly(_RECORD.size - 1)
+            expires, length = _RECORD.unpack(chr(code) + rest)[1:]
+            tag = self._readExactly(length).decode('utf-8')
+            if kind in (REDIRECT, NOT_A_URL):
+                value = self._readString()
+            elif kind == MULTIPLE_PAGES:
+                number, = _LENGTH.unpack(self._readExactly(_LENGTH.size))
+                value = [self._readString() for i in xrange(number)]
+            else:
+                value = None
+            entries.append((tag, expires, (kind, value)))
+        return entries
+
+    def close(self):
+        """
+        Close the file, if it is still open.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class CacheSnapshot(service.Service):
+    """
+    Restore the resolver's cached results from a snapshot file when the
+    service starts, and save them to it every so often and when the
+    service stops. The file is read and written in a thread, and the
+    results are restored a batch at a time while lookups are served, so
+    neither a large snapshot nor a large cache holds up the reactor.
+
+    Restored results keep their expiry times. Those that are still fresh
+    are served as they are; those that have expired are served while they
+    are refreshed, as usual.
+
+    @param resolver: The L{lastpage.resolver.Resolver} to restore results
+        to.
+    @param cache: The L{lastpage.cache.ResultCache} the resolver keeps its
+        results in.
+    @param path: The C{str} path of the snapshot file.
+    @param interval: The C{int} number of seconds between snapshots, or
+        C{0} to only write one when the service stops.
+    @param batchSize: The C{int} number of results to read and restore at
+        a time.
+    @param clock: An C{IReactorTime} provider, used to schedule work. If
+        C{None}, the global reactor is used.
+    @param waitToLoad: If C{True}, the snapshot is only restored (and
+        snapshots only written) once L{load} is called, rather than when
+        the service starts. A worker replacing another uses this to wait
+        for the last snapshot the old worker writes as it exits.
+    """
+
+    def __init__(self, resolver, cache, path, interval, batchSize=1000,
+                 clock=None, waitToLoad=False):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._resolver = resolver
+        self._cache = cache
+        self._path = path
+        self._interval = interval
+        self._batchSize = batchSize
+        self._clock = clock
+        self._waitToLoad = waitToLoad
+        self._loading = False
+        self._loaded = False
+        self._writing = None
+        self._writer = None
+
+    def startService(self):
+        service.Service.startService(self)
+        if self._waitToLoad:
+            logger.info('snapshot-load-waiting', path=self._path)
+        else:
+            self.load()
+
+    def load(self):
+        """
+        Restore the results in the snapshot file, and then start writing
+        snapshots. This does nothing if the service is not running, or has
+        already started restoring them.
+        """
+        if not self.running or self._loading:
+            return
+        self._loading = True
+        d = self._load()
+        d.addErrback(logger.failure, 'snapshot-load-failed', path=self._path)
+        d.addCallback(self._loadFinished)
+
+    @defer.inlineCallbacks
+    def _load(self):
+        """
+        Restore the results in the snapshot file, if there is one.
+
+        @return: A C{Deferred} that fires when they have been restored.
+        """
+        if not os.path.exists(self._path):
+            logger.info('snapshot-missing', path=self._path)
+            return
+        reader = yield threads.deferToThread(SnapshotReader, self._path)
+        read = restored = 0
+        try:
+            while self.running:
+                entries = yield threads.deferToThread(
+                    reader.read, self._batchSize)
+                if not entries:
+                    break
+                read += len(entries)
+                for tag, expires, result in entries:
+                    if self._resolver.restore(tag, result, expires):
+                        restored += 1
+                # Let lookups be served between batches.
+                yield task.deferLater(self._clock, 0, lambda: None)
+        finally:
+            reader.close()
+        logger.info('snapshot-loaded', path=self._path, read=read,
+                    restored=restored)
+
+    def _loadFinished(self, _):
+        """
+        Start writing snapshots, now that writing one cannot overwrite
+        results that have yet to be restored.
+        """
+        self._loaded = True
+        if self.running and self._interval:
+            self._writer = task.LoopingCall(self.write)
+            self._writer.clock = self._clock
+            self._writer.start(self._interval, now=False)
+
+    def write(self):
+        """
+        Write a snapshot of the cached results, unless one is already
+        being written.
+
+        @return: A C{Deferred} that fires when the snapshot is written.
+        """
+        if self._writing is not None:
+            return self._writing
+        # Copying the entries is quick, and the cache must only be read
+        # from the reactor thread.
+        entries = self._cache.entries()
+        d = threads.deferToThread(writeSnapshot, self._path, entries)
+
+        def _written(count):
+            logger.info('snapshot-written', path=self._path, results=count)
+
+        def _finished(result):
+            self._writing = None
+            return result
+
+        d.addCallbacks(_written, logger.failure,
+                       errbackArgs=('snapshot-write-failed',),
+                       errbackKeywords={'path': self._path})
+        d.addBoth(_finished)
+        self._writing = d
+        return d
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._writer is not None and self._writer.running:
+            self._writer.stop()
+        if not self._loaded:
+            # Writing now would lose the results not yet restored.
+            return None
+        return self.write()
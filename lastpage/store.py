@@ -0,0 +1,468 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+from collections import OrderedDict
+import cPickle as pickle
+import heapq
+import sqlite3
+
+from twisted.internet import defer, task
+
+from zope.interface import Interface, implements
+
+from lastpage.metrics import registry
+from lastpage.session import SessionRecord
+
+
+# The longest time, in seconds, a statement waits for another process to
+# release the write lock. Statements run on the reactor thread, so waiting
+# holds up every request the process is serving. In WAL mode readers never
+# wait, and writes are short, so the lock is rarely held for long.
+_BUSY_TIMEOUT = 0.25
+
+# Session store operations that failed, most likely because another
+# process held the write lock for longer than _BUSY_TIMEOUT.
+sessionStoreErrors = registry.counter(
+    'lastpage_session_store_errors_total',
+    'Session store operations that failed, by operation.', ('operation',))
+
+
+def _connect(path):
+    """
+    Open an SQLite database that several processes can share.
+
+    @param path: The C{str} path of the SQLite database file.
+    @return: An C{sqlite3.Connection}.
+    """
+    # Autocommit mode, so that every statement is visible to the other
+    # processes as soon as it completes.
+    db = sqlite3.connect(path, timeout=_BUSY_TIMEOUT, isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    # With WAL, committing need not wait for the disk, which keeps the
+    # write lock held only briefly. A crash can lose the last commits
+    # (of sessions and tokens, which are only an inconvenience to lose),
+    # but cannot corrupt the database.
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+
+class ISessionStore(Interface):
+    """
+    A store of logged-in user sessions, keyed by cookie value. Sessions
+    expire a fixed time after they are created.
+    """
+
+    def get(key):
+        """
+        Look up a session.
+
+        @param key: The C{str} cookie value of the session.
+        @return: The L{SessionRecord} of the session, or C{None} if there
+            is no such session or it has expired.
+        """
+
+    def set(key, value):
+        """
+        Store a new session.
+
+        @param key: The C{str} cookie value of the session.
+        @param value: The L{SessionRecord} of the session.
+        """
+
+    def delete(key):
+        """
+        Forget a session, if it exists.
+
+        @param key: The C{str} cookie value of the session.
+        """
+
+    def expire():
+        """
+        Remove expired sessions.
+
+        @return: A C{Deferred} that fires with the C{int} number of sessions
+            removed.
+        """
+
+
+class MemorySessionStore(object):
+    """
+    An L{ISessionStore} that keeps sessions in memory. When the store is
+    full, the oldest session is dropped to make room for a new one.
+
+    @param ttl: The C{int} number of seconds a session lasts.
+    @param maxSize: The C{int} maximum number of sessions to keep.
+    @param clock: An C{IReactorTime} provider, used to find out the
+        current time. If C{None}, the global reactor is used.
+    """
+    implements(ISessionStore)
+
+    def __init__(self, ttl, maxSize, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._ttl = ttl
+        self._maxSize = maxSize
+        self._clock = clock
+        # Every session has the same lifetime, so insertion order is also
+        # expiry order.
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, key):
+        try:
+            expires, value = self._sessions[key]
+        except KeyError:
+            return None
+        if expires <= self._clock.seconds():
+            del self._sessions[key]
+            return None
+        return value
+
+    def set(self, key, value):
+        self._sessions.pop(key, None)
+        while self._sessions and len(self._sessions) >= self._maxSize:
+            self._sessions.popitem(last=False)
+        self._sessions[key] = (self._clock.seconds() + self._ttl, value)
+
+    def delete(self, key):
+        self._sessions.pop(key, None)
+
+    def expire(self):
+        now = self._clock.seconds()
+        count = 0
+        while self._sessions:
+            key, (expires, value) = next(self._sessions.iteritems())
+            if expires > now:
+                break
+            del self._sessions[key]
+            count += 1
+        return defer.succeed(count)
+
+
+class SQLiteSessionStore(object):
+    """
+    An L{ISessionStore} that keeps sessions in an SQLite database, so they
+    survive restarts and can be shared by several processes. Each session
+    is stored as a packed L{SessionRecord}.
+
+    @param path: The C{str} path of the SQLite database file.
+    @param ttl: The C{int} number of seconds a session lasts.
+    @param batchSize: The C{int} maximum number of expired sessions to
+        delete in one statement when expiring sessions.
+    @param clock: An C{IReactorTime} provider, used to find out the
+        current time. If C{None}, the global reactor is used.
+    """
+    implements(ISessionStore)
+
+    _TABLE = 'sessions'
+
+    def __init__(self, path, ttl, batchSize, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._ttl = ttl
+        self._batchSize = batchSize
+        self._clock = clock
+        self._db = _connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, '
+            'value BLOB NOT NULL, expires REAL NOT NULL)' % self._TABLE)
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS %s_expires ON %s (expires)' %
+            (self._TABLE, self._TABLE))
+
+    def __len__(self):
+        return self._db.execute(
+            'SELECT COUNT(*) FROM %s' % self._TABLE).fetchone()[0]
+
+    def get(self, key):
+        row = self._db.execute(
+            'SELECT value FROM %s WHERE key = ? AND expires > ?' %
+            self._TABLE, (key, self._clock.seconds())).fetchone()
+        if row is None:
+            return None
+        try:
+            return SessionRecord.unpack(str(row[0]))
+        except ValueError:
+            # Stored by an older version, in a form we no longer read.
+            return None
+
+    def set(self, key, value):
+        self._db.execute(
+            'INSERT OR REPLACE INTO %s (key, value, expires) '
+            'VALUES (?, ?, ?)' % self._TABLE,
+            (key, sqlite3.Binary(value.pack()),
+             self._clock.seconds() + self._ttl))
+
+    def delete(self, key):
+        self._db.execute(
+            'DELETE FROM %s WHERE key = ?' % self._TABLE, (key,))
+
+    def expire(self):
+        """
+        Remove expired sessions, C{batchSize} at a time, giving the reactor
+        a chance to run between batches.
+
+        @return: A C{Deferred} that fires with the C{int} number of sessions
+            removed.
+        """
+        now = self._clock.seconds()
+        removed = [0]
+
+        def _batches():
+            while True:
+                cursor = self._db.execute(
+                    'DELETE FROM %s WHERE key IN (SELECT key FROM %s '
+                    'WHERE expires <= ? LIMIT ?)' %
+                    (self._TABLE, self._TABLE), (now, self._batchSize))
+                removed[0] += cursor.rowcount
+                if cursor.rowcount < self._batchSize:
+                    break
+                yield None
+
+        d = task.coiterate(_batches())
+        d.addCallback(lambda _: removed[0])
+        return d
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        self._db.close()
+
+
+class ITokenStore(Interface):
+    """
+    A store of the OAuth request tokens of logins that are waiting for
+    their callback from Twitter. Tokens expire a fixed time after they are
+    added.
+
+    @ivar expired: The C{int} number of tokens that expired unused (or
+        were dropped to make room for new ones).
+    @ivar consumed: The C{int} number of tokens that were used.
+    """
+
+    def __len__():
+        """
+        @return: The C{int} number of live tokens.
+        """
+
+    def stats():
+        """
+        Get the store's counters.
+
+        @return: A C{dict} with C{size}, C{expired} and C{consumed} keys.
+        """
+
+    def add(token):
+        """
+        Store a new token.
+
+        @param token: The C{oauth.oauth.OAuthToken} to store.
+        """
+
+    def consume(key):
+        """
+        Remove and return a token.
+
+        @param key: The C{str} key of the token.
+        @raise KeyError: if there is no such token, or it has expired.
+        @return: The C{oauth.oauth.OAuthToken} with key C{key}.
+        """
+
+    def expire():
+        """
+        Remove expired tokens.
+
+        @return: A C{Deferred} that fires with the C{int} number of tokens
+            removed.
+        """
+
+
+class MemoryTokenStore(object):
+    """
+    An L{ITokenStore} that keeps tokens in memory, with a heap ordered by
+    expiry time so that expiring tokens costs nothing unless some are due.
+    When the store is full, the token closest to expiry is dropped to make
+    room for a new one.
+
+    @param ttl: The C{int} number of seconds a token lasts.
+    @param maxSize: The C{int} maximum number of tokens to keep.
+    @param clock: An C{IReactorTime} provider, used to find out the
+        current time. If C{None}, the global reactor is used.
+    """
+    implements(ITokenStore)
+
+    def __init__(self, ttl, maxSize, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._ttl = ttl
+        self._maxSize = maxSize
+        self._clock = clock
+        # Maps token keys to (expires, token) tuples.
+        self._tokens = {}
+        # A heap of (expires, key) tuples. Entries for tokens that have
+        # been consumed are left in place and skipped when they come up.
+        self._heap = []
+        self.expired = 0
+        self.consumed = 0
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def add(self, token):
+        while self._tokens and len(self._tokens) >= self._maxSize:
+            if self._pop():
+                self.expired += 1
+        expires = self._clock.seconds() + self._ttl
+        self._tokens[token.key] = (expires, token)
+        heapq.heappush(self._heap, (expires, token.key))
+
+    def consume(self, key):
+        expires, token = self._tokens.pop(key)
+        if expires <= self._clock.seconds():
+            self.expired += 1
+            raise KeyError(key)
+        self.consumed += 1
+        return token
+
+    def expire(self):
+        now = self._clock.seconds()
+        count = 0
+        while self._heap and self._heap[0][0] <= now:
+            if self._pop():
+                count += 1
+        self.expired += count
+        return defer.succeed(count)
+
+    def stats(self):
+        """
+        Get the store's counters.
+
+        @return: A C{dict} with C{size}, C{expired} and C{consumed} keys.
+        """
+        return {
+            'size': len(self),
+            'expired': self.expired,
+            'consumed': self.consumed,
+        }
+
+    def _pop(self):
+        """
+        Remove the heap entry that expires soonest, and its token if it is
+        still live.
+
+        @return: C{True} if a live token was removed.
+        """
+        expires, key = heapq.heappop(self._heap)
+        entry = self._tokens.get(key)
+        if entry is not None and entry[0] == expires:
+            del self._tokens[key]
+            return True
+        return False
+
+
+class SQLiteTokenStore(object):
+    """
+    An L{ITokenStore} that keeps tokens in an SQLite database, so that
+    several processes can share them. When the store is full, the tokens
+    closest to expiry are dropped to make room for a new one.
+
+    @param path: The C{str} path of the SQLite database file.
+    @param ttl: The C{int} number of seconds a token lasts.
+    @param maxSize: The C{int} maximum number of tokens to keep.
+    @param clock: An C{IReactorTime} provider, used to find out the
+        current time. If C{None}, the global reactor is used.
+    """
+    implements(ITokenStore)
+
+    _TABLE = 'oauth_tokens'
+
+    def __init__(self, path, ttl, maxSize, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._ttl = ttl
+        self._maxSize = maxSize
+        self._clock = clock
+        self._db = _connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, '
+            'value BLOB NOT NULL, expires REAL NOT NULL)' % self._TABLE)
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS %s_expires ON %s (expires)' %
+            (self._TABLE, self._TABLE))
+        self.expired = 0
+        self.consumed = 0
+
+    def __len__(self):
+        return self._db.execute(
+            'SELECT COUNT(*) FROM %s' % self._TABLE).fetchone()[0]
+
+    def add(self, token):
+        excess = len(self) - self._maxSize + 1
+        if excess > 0:
+            cursor = self._db.execute(
+                'DELETE FROM %s WHERE key IN (SELECT key FROM %s '
+                'ORDER BY expires LIMIT ?)' % (self._TABLE, self._TABLE),
+                (excess,))
+            self.expired += cursor.rowcount
+        self._db.execute(
+            'INSERT OR REPLACE INTO %s (key, value, expires) '
+            'VALUES (?, ?, ?)' % self._TABLE,
+            (token.key, sqlite3.Binary(pickle.dumps(token, 2)),
+             self._clock.seconds() + self._ttl))
+
+    def consume(self, key):
+        # Take a write lock first, so that no other process can consume
+        # the same token.
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._db.execute(
+                'SELECT value, expires FROM %s WHERE key = ?' % self._TABLE,
+                (key,)).fetchone()
+            if row is not None:
+                self._db.execute(
+                    'DELETE FROM %s WHERE key = ?' % self._TABLE, (key,))
+        except:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+        if row is None:
+            raise KeyError(key)
+        value, expires = row
+        if expires <= self._clock.seconds():
+            self.expired += 1
+            raise KeyError(key)
+        self.consumed += 1
+        return pickle.loads(str(value))
+
+    def expire(self):
+        cursor = self._db.execute(
+            'DELETE FROM %s WHERE expires <= ?' % self._TABLE,
+            (self._clock.seconds(),))
+        self.expired += cursor.rowcount
+        return defer.succeed(cursor.rowcount)
+
+    def stats(self):
+        """
+        Get the store's counters.
+
+        @return: A C{dict} with C{size}, C{expired} and C{consumed} keys.
+        """
+        return {
+            'size': len(self),
+            'expired': self.expired,
+            'consumed': self.consumed,
+        }
@@ -1,42 +1,84 @@
 from oauth.oauth import (
     OAuthToken, OAuthRequest, OAuthConsumer, OAuthSignatureMethod_HMAC_SHA1)
 
-from twisted.python import log
-from twisted.web import client
+from twisted.internet import defer, threads
 
-from txretry.retry import RetryingCall
+from lastpage.eventlog import logger
+from lastpage.metrics import registry
 
+oauthSteps = registry.histogram(
+    'lastpage_oauth_step_seconds',
+    'Time taken by each step of logging in with Twitter OAuth.', ('step',))
+_REQUEST_TOKEN_STEP = oauthSteps.labels('request_token')
 
-def getTwitterOAuthURL(conf, oauthTokenDict):
+
+def getTwitterOAuthURL(conf, tokens, httpClient, backend):
     """
     Obtain a URL from twitter.com that we can redirect a user to so they
     can authenticate themselves and authorize loveme.do to act on their
     behalf.
 
     @param conf: the lovemedo configuration.
-    @param oauthTokenDict: A C{dict} mapping token keys to tokens.
-    @return: A C{Deferred} that fires with the URL for OAuth verification.
+    @param tokens: The L{lastpage.store.ITokenStore} to keep the request
+        token in until the callback comes.
+    @param httpClient: The L{lastpage.httpclient.HTTPClient} to make the
+        request token request with.
+    @param backend: The L{lastpage.resilience.Backend} for Twitter, which
+        applies a deadline, retries and a circuit breaker to the request.
+    @return: A C{Deferred} that fires with the URL for OAuth verification,
+        or fails if a request token cannot be had.
     """
-    log.msg('Got login URL request.')
-
     def _makeURL(result):
         token = OAuthToken.from_string(result)
         # Store the token by key so we can find it when the callback comes.
-        oauthTokenDict[token.key] = token
+        tokens.add(token)
         request = OAuthRequest.from_token_and_callback(
             token=token, http_url=conf.authorization_url)
         url = request.to_url()
-        log.msg('Browser OAuth redirect URL = %r' % url)
+        logger.debug('oauth-redirect-url', url=url)
         return url
 
+    def _getRequestToken():
+        # Signed afresh for each attempt, so that a retry has its own nonce
+        # and timestamp and is not rejected as a replay.
+        request = OAuthRequest.from_consumer_and_token(
+            consumer, callback=conf.callback_url,
+            http_url=conf.request_token_url)
+        d = signRequest(request, consumer, None, conf.oauth_sign_in_thread)
+        d.addCallback(lambda request: httpClient.getPage(
+            conf.request_token_url, headers=request.to_header()))
+        return d
+
     consumer = OAuthConsumer(conf.consumer_key, conf.consumer_secret)
-    request = OAuthRequest.from_consumer_and_token(
-        consumer, callback=conf.callback_url,
-        http_url=conf.request_token_url)
-    request.sign_request(OAuthSignatureMethod_HMAC_SHA1(), consumer, None)
-    r = RetryingCall(
-        client.getPage, conf.request_token_url, headers=request.to_header())
-    d = r.start()
+    d = _REQUEST_TOKEN_STEP.timeDeferred(backend.call(_getRequestToken))
     d.addCallback(_makeURL)
-    d.addErrback(log.err)
     return d
+
+
+def _sign(oaRequest, consumer, token):
+    """
+    Sign an OAuth request with HMAC-SHA1.
+
+    @param oaRequest: The C{OAuthRequest} to sign.
+    @param consumer: Our C{OAuthConsumer}.
+    @param token: The C{OAuthToken} the request is made with, or C{None}.
+    @return: C{oaRequest}, signed.
+    """
+    oaRequest.sign_request(OAuthSignatureMethod_HMAC_SHA1(), consumer, token)
+    return oaRequest
+
+
+def signRequest(oaRequest, consumer, token, inThread=False):
+    """
+    Sign an OAuth request with HMAC-SHA1, optionally in the reactor's
+    thread pool so that a burst of logins does not hold up the reactor.
+
+    @param oaRequest: The C{OAuthRequest} to sign.
+    @param consumer: Our C{OAuthConsumer}.
+    @param token: The C{OAuthToken} the request is made with, or C{None}.
+    @param inThread: If C{True}, sign the request in a thread.
+    @return: A C{Deferred} that fires with C{oaRequest}, signed.
+    """
+    if inThread:
+        return threads.deferToThread(_sign, oaRequest, consumer, token)
+    return defer.maybeDeferred(_sign, oaRequest, consumer, token)
@@ -0,0 +1,189 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import heapq
+import re
+from urllib import unquote
+
+from twisted.application import service
+from twisted.internet import defer, task, threads
+
+from lastpage.eventlog import logger
+from lastpage.resolver import tagPath
+
+# Matches the request and status of a lookup in an access log line, in
+# the common or combined log format (as written by twisted.web or nginx).
+_ACCESS_LOG_LOOKUP = re.compile(
+    r'"GET (/[^ ?"]*)[^ "]* HTTP/[\d.]+" (\d{3}) ')
+
+# The statuses of successful lookups.
+_LOOKUP_STATUSES = ('200', '302', '307')
+
+# Matches a line that is a bare username: a single word, with none of the
+# spaces, quotes or slashes of an access log line.
+_USERNAME = re.compile(r'^[^\s"/]+$')
+
+# Top-level path components that are never usernames.
+_NOT_USERS = ('static', 'robots.txt', 'favicon.ico')
+
+
+def _lookupFromPath(path):
+    """
+    Find the user and variant a request path looks up, in the way
+    L{lastpage.resource.LastPage.getChild} does.
+
+    @param path: The C{str} request path, e.g. C{/terry/work}.
+    @return: A (who, rest) C{tuple} of C{unicode}, or C{None} if the path
+        is not a user lookup.
+    """
+    parts = [unquote(part) for part in path.split('/')[1:]]
+    if not parts or not parts[0] or parts[0].startswith('_'):
+        return None
+    if parts[0] in _NOT_USERS or parts[0].endswith('.html'):
+        return None
+    try:
+        parts = [part.decode('utf-8') for part in parts]
+    except UnicodeDecodeError:
+        return None
+    return parts[0], u'-'.join(parts[1:])
+
+
+def readLookups(path, limit):
+    """
+    Read the lookups to warm the cache with from a file. Each line is
+    either a username (blank lines and lines starting with C{#} are
+    skipped) or an access log line. Access log lines for anything other
+    than a successful lookup, and any other lines that are not a single
+    word, are skipped. The lookups made most often in the access log come
+    first.
+
+    @param path: The C{str} path of the file.
+    @param limit: The C{int} largest number of lookups to return.
+    @return: A C{list} of (who, tag) C{tuple}s of C{unicode}.
+    """
+    counts = {}
+    order = []
+    with open(path) as f:
+        for line in f:
+            match = _ACCESS_LOG_LOOKUP.search(line)
+            if match is None:
+                line = line.strip()
+                if line.startswith('#') or not _USERNAME.match(line):
+                    continue
+                try:
+                    lookup = (line.decode('utf-8'), u'')
+                except UnicodeDecodeError:
+                    continue
+            elif match.group(2) in _LOOKUP_STATUSES:
+                lookup = _lookupFromPath(match.group(1))
+                if lookup is None:
+                    continue
+            else:
+                continue
+            if lookup not in counts:
+                counts[lookup] = 0
+                order.append(lookup)
+            counts[lookup] += 1
+    # Ties keep their order in the file.
+    position = dict((lookup, i) for i, lookup in enumerate(order))
+    top = heapq.nsmallest(
+        limit, order, key=lambda lookup: (-counts[lookup], position[lookup]))
+    return [(who, tagPath(who, rest)) for who, rest in top]
+
+
+class WarmUp(service.Service):
+    """
+    Once the service has started, resolve the tags that are most likely to
+    be looked up, so that their results are already cached when the
+    lookups come.
+
+    @param resolver: The L{lastpage.resolver.Resolver} to resolve tags
+        with, which caches their results.
+    @param path: The C{str} path of a file of usernames or an access log,
+        as described in L{readLookups}.
+    @param limit: The C{int} largest number of tags to resolve.
+    @param concurrency: The C{int} largest number of tags to resolve at
+        once.
+    """
+
+    def __init__(self, resolver, path, limit, concurrency):
+        self._resolver = resolver
+        self._path = path
+        self._limit = limit
+        self._concurrency = concurrency
+        self._cooperators = []
+        self.resolved = 0
+        self.failed = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        # Reading a large access log would hold up the reactor.
+        d = threads.deferToThread(readLookups, self._path, self._limit)
+        d.addCallback(self._warm)
+        d.addErrback(logger.failure, 'warmup-failed', path=self._path)
+
+    def _warm(self, lookups):
+        """
+        Resolve tags, a limited number at a time.
+
+        @param lookups: A C{list} of (who, tag) C{tuple}s of C{unicode}.
+        @return: A C{Deferred} that fires when all the tags are resolved.
+        """
+        if not self.running:
+            return
+        logger.info('warmup-started', lookups=len(lookups))
+        work = (self._resolve(who, tag) for who, tag in lookups)
+        self._cooperators = [task.cooperate(work)
+                             for i in range(self._concurrency)]
+        d = defer.gatherResults([cooperator.whenDone()
+                                 for cooperator in self._cooperators],
+                                consumeErrors=True)
+
+        def _finished(result):
+            logger.info('warmup-done', resolved=self.resolved,
+                        failed=self.failed)
+
+        def _stopped(fail):
+            # Stopping the service stops the cooperative tasks.
+            if self.running:
+                return fail
+
+        d.addCallbacks(_finished, _stopped)
+        return d
+
+    def _resolve(self, who, tag):
+        """
+        Resolve a tag, counting the outcome.
+
+        @param who: The C{unicode} username the tag belongs to.
+        @param tag: The C{unicode} path name of the tag.
+        @return: A C{Deferred} that fires when the tag is resolved.
+        """
+        def _succeeded(result):
+            self.resolved += 1
+
+        def _failed(fail):
+            self.failed += 1
+
+        d = self._resolver.resolve(who, tag)
+        d.addCallbacks(_succeeded, _failed)
+        return d
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for cooperator in self._cooperators:
+            try:
+                cooperator.stop()
+            except task.TaskDone:
+                pass
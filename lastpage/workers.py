@@ -0,0 +1,387 @@
+# Copyright 2011 Fluidinfo Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import os
+import signal
+import socket
+
+from twisted.application import service
+from twisted.internet import defer, error, protocol
+from twisted.python import log
+
+# How long to wait before replacing a worker that exited unexpectedly.
+_RESPAWN_DELAY = 1.0
+
+# How long a new worker may take to start accepting connections, when
+# replacing an old one.
+_READY_TIMEOUT = 60.0
+
+# The message a worker logs once it is accepting connections.
+READY_MESSAGE = 'lastpage worker ready.'
+
+
+class WorkerNotReady(Exception):
+    """
+    A new worker exited, or took too long, before it was ready to accept
+    connections.
+    """
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+    """
+    Watch over a worker process, logging its output, noticing when it is
+    ready to accept connections and telling the L{WorkerPool} when it
+    exits.
+
+    @param pool: The L{WorkerPool} the worker belongs to.
+    @param number: The C{int} number of the worker, used in log messages.
+    """
+
+    def __init__(self, pool, number):
+        self._pool = pool
+        self._number = number
+        self._partial = {}
+        self.ready = defer.Deferred()
+        self.ended = defer.Deferred()
+
+    def childDataReceived(self, childFD, data):
+        lines = (self._partial.pop(childFD, '') + data).split('\n')
+        if lines[-1]:
+            self._partial[childFD] = lines[-1]
+        for line in lines[:-1]:
+            log.msg('worker %d: %s' % (self._number, line))
+            if READY_MESSAGE in line and not self.ready.called:
+                self.ready.callback(None)
+
+    def processEnded(self, reason):
+        log.msg('worker %d exited: %s' % (self._number, reason.value))
+        self.ended.callback(None)
+        self._pool.workerEnded(self._number, self)
+
+
+class WorkerPool(service.Service):
+    """
+    Listen on a TCP port and run worker processes that accept and serve
+    the connections made to it. The pool process itself never accepts
+    connections. Workers that exit while the pool is running are replaced.
+    Because the pool holds the listening socket, workers can be replaced
+    with ones running new code (see L{restartWorkers}) without refusing
+    any connections.
+
+    @param port: The C{int} port number to listen on.
+    @param interface: The C{str} interface to listen on.
+    @param workers: The C{int} number of worker processes to run.
+    @param args: The C{list} of C{str} arguments to start a worker with.
+        The first is the executable. C{--inherit-fd} and the file
+        descriptor number of the listening socket are appended, as are
+        C{--worker-index} and the worker's number, and, for a worker
+        replacing another, C{--wait-for-snapshot}.
+    @param reactor: The reactor to use. If C{None}, the global reactor is
+        used.
+    """
+
+    def __init__(self, port, interface, workers, args, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._portNumber = port
+        self._interface = interface
+        self._workers = workers
+        self._args = args
+        self._reactor = reactor
+        self._processes = {}
+        # The ended Deferreds of replaced workers that are still draining.
+        self._retiring = []
+        # The (process, protocol) pairs of new workers not yet ready.
+        self._starting = []
+        self._restarting = False
+
+    def startService(self):
+        service.Service.startService(self)
+        self._port = self._reactor.listenTCP(
+            self._portNumber, protocol.Factory(), interface=self._interface)
+        # Leave all accepting to the workers.
+        self._port.stopReading()
+        for number in range(self._workers):
+            self._spawn(number)
+
+    def _start(self, number, replacing=False):
+        """
+        Start a worker process.
+
+        @param number: The C{int} number of the worker.
+        @param replacing: If C{True}, the worker is replacing one that is
+            still running, and must not load its cache snapshot until it
+            is sent C{SIGUSR1}.
+        @return: The (process, L{_WorkerProtocol}) C{tuple} of the worker.
+        """
+        fd = self._port.fileno()
+        args = self._args + ['--inherit-fd', str(fd),
+                             '--worker-index', str(number)]
+        if replacing:
+            args.append('--wait-for-snapshot')
+        workerProtocol = _WorkerProtocol(self, number)
+        process = self._reactor.spawnProcess(
+            workerProtocol, args[0], args, env=os.environ,
+            childFDs={0: 'w', 1: 'r', 2: 'r', fd: fd})
+        log.msg('Started worker %d, pid %d.' % (number, process.pid))
+        return process, workerProtocol
+
+    def _spawn(self, number):
+        """
+        Start a worker process, and make it the pool's worker of its
+        number.
+
+        @param number: The C{int} number of the worker.
+        """
+        self._processes[number] = self._start(number)
+
+    def workerEnded(self, number, workerProtocol):
+        """
+        Replace a worker that has exited, unless the pool is stopping or
+        the worker has already been replaced.
+
+        @param number: The C{int} number of the worker.
+        @param workerProtocol: The L{_WorkerProtocol} of the worker.
+        """
+        if self._processes.get(number, (None, None))[1] is not workerProtocol:
+            # A replaced worker, or a replacement that never got going.
+            if workerProtocol.ended in self._retiring:
+                self._retiring.remove(workerProtocol.ended)
+            return
+        del self._processes[number]
+        if self.running:
+            self._reactor.callLater(_RESPAWN_DELAY, self._respawn, number)
+
+    def _respawn(self, number):
+        """
+        Start a replacement worker, if the pool is still running.
+
+        @param number: The C{int} number of the worker.
+        """
+        if self.running and number not in self._processes:
+            self._spawn(number)
+
+    @defer.inlineCallbacks
+    def restartWorkers(self):
+        """
+        Replace the workers, one at a time, with new processes (which will
+        run whatever code is now installed). Each old worker is only told
+        to stop once its replacement is accepting connections; it then
+        stops accepting them itself, and finishes the requests it is
+        serving. The next worker is only replaced once the last one has
+        exited. If a replacement exits or takes too long to get ready, it
+        is stopped, the old worker carries on, and no more workers are
+        replaced, so that a broken deploy cannot take down every worker.
+
+        A replacement shares its old worker's cache snapshot file, which
+        the old worker writes as it exits. So the replacement only loads
+        the snapshot once the pool tells it (with C{SIGUSR1}) that the old
+        worker has exited.
+
+        @return: A C{Deferred} that fires when every worker has been
+            replaced, or the restart has been abandoned.
+        """
+        if self._restarting:
+            log.msg('Already restarting workers.')
+            return
+        self._restarting = True
+        try:
+            for number in sorted(self._processes):
+                if not self.running:
+                    break
+                entry = self._processes.get(number)
+                if entry is None:
+                    continue
+                process, workerProtocol = entry
+                replacement = self._start(number, replacing=True)
+                self._starting.append(replacement)
+                try:
+                    yield self._whenReady(replacement[1])
+                except WorkerNotReady, e:
+                    log.msg('%s Abandoning the restart.' % e)
+                    try:
+                        replacement[0].signalProcess('TERM')
+                    except OSError:
+                        pass
+                    return
+                finally:
+                    self._starting.remove(replacement)
+                if not self.running:
+                    # Stopping the pool stopped the replacement too.
+                    return
+                self._processes[number] = replacement
+                if not workerProtocol.ended.called:
+                    self._retiring.append(workerProtocol.ended)
+                    try:
+                        process.signalProcess('TERM')
+                    except OSError:
+                        pass
+                    yield workerProtocol.ended
+                    if not self.running:
+                        # The replacement is stopping too.
+                        return
+                # The old worker has written its last snapshot.
+                try:
+                    replacement[0].signalProcess(signal.SIGUSR1)
+                except OSError:
+                    pass
+            log.msg('Restarted workers.')
+        finally:
+            self._restarting = False
+
+    def _whenReady(self, workerProtocol):
+        """
+        Wait for a new worker to be ready to accept connections.
+
+        @param workerProtocol: The L{_WorkerProtocol} of the worker.
+        @return: A C{Deferred} that fires when the worker is ready, or
+            fails with L{WorkerNotReady} if it exits first or is not ready
+            within L{_READY_TIMEOUT} seconds.
+        """
+        d = defer.Deferred()
+
+        def _finish(error=None):
+            if d.called:
+                return
+            if call.active():
+                call.cancel()
+            if error is None:
+                d.callback(None)
+            else:
+                d.errback(error)
+
+        def _ended(result):
+            _finish(WorkerNotReady('A new worker exited before it was '
+                                   'ready.'))
+            return result
+
+        call = self._reactor.callLater(
+            _READY_TIMEOUT, _finish, WorkerNotReady(
+                'A new worker was not ready within %s seconds.' %
+                _READY_TIMEOUT))
+        workerProtocol.ready.addCallback(lambda _: _finish())
+        workerProtocol.ended.addCallback(_ended)
+        return d
+
+    def signalWorkers(self, signal):
+        """
+        Send a signal to every worker process.
+
+        @param signal: The C{str} name of the signal, e.g. C{'HUP'}.
+        """
+        for process, workerProtocol in self._processes.values():
+            try:
+                process.signalProcess(signal)
+            except OSError:
+                pass
+
+    def stopService(self):
+        service.Service.stopService(self)
+        ended = []
+        for process, workerProtocol in self._processes.values() + \
+                self._starting:
+            ended.append(workerProtocol.ended)
+            try:
+                process.signalProcess('TERM')
+            except OSError:
+                pass
+        d = defer.gatherResults(ended + self._retiring)
+        d.addCallback(lambda _: self._port.stopListening())
+        return d
+
+
+class InheritedPortService(service.Service):
+    """
+    Serve connections on a listening TCP socket inherited from a parent
+    L{WorkerPool} process.
+
+    @param fd: The C{int} file descriptor of the listening socket.
+    @param factory: The C{protocol.ServerFactory} to serve connections with.
+    @param reactor: The reactor to use. If C{None}, the global reactor is
+        used.
+    """
+
+    def __init__(self, fd, factory, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._fd = fd
+        self._factory = factory
+        self._reactor = reactor
+
+    def startService(self):
+        service.Service.startService(self)
+        self._port = self._reactor.adoptStreamPort(
+            self._fd, socket.AF_INET, self._factory)
+        # The reactor has its own copy of the descriptor now.
+        os.close(self._fd)
+        # Tell the pool, which may be waiting to stop the worker this one
+        # replaces.
+        self._reactor.callWhenRunning(log.msg, READY_MESSAGE)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        return self._port.stopListening()
+
+
+class ListenWhenFree(service.Service):
+    """
+    Listen on a TCP port of a worker's own, such as its admin port, which
+    the worker it is replacing may still be holding. Listening is retried
+    until the old worker lets go of the port.
+
+    @param port: The C{int} port number to listen on.
+    @param factory: The C{protocol.ServerFactory} to serve connections with.
+    @param interface: The C{str} interface to listen on.
+    @param retryDelay: The C{float} number of seconds between attempts.
+    @param reactor: The reactor to use. If C{None}, the global reactor is
+        used.
+    """
+
+    def __init__(self, port, factory, interface, retryDelay=1.0,
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._portNumber = port
+        self._factory = factory
+        self._interface = interface
+        self._retryDelay = retryDelay
+        self._reactor = reactor
+        self._port = None
+        self._retry = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self._listen()
+
+    def _listen(self):
+        """
+        Try to listen on the port, and try again later if it is in use.
+        """
+        self._retry = None
+        try:
+            self._port = self._reactor.listenTCP(
+                self._portNumber, self._factory, interface=self._interface)
+        except error.CannotListenError, e:
+            log.msg('%s Retrying in %s seconds.' % (e, self._retryDelay))
+            self._retry = self._reactor.callLater(self._retryDelay,
+                                                  self._listen)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+        if self._port is not None:
+            port, self._port = self._port, None
+            return port.stopListening()
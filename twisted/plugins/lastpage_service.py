@@ -1,8 +1,31 @@
+import signal
+import sys
+
 from jinja2 import Environment, PackageLoader
 
 from lastpage import config
+from lastpage.admin import Admin, Invalidate, Metrics, Status
+from lastpage.bloom import BloomFilter
+from lastpage.eventlog import (
+    LEVELS, EventLogWriter, logger, parseSampleRates)
+from lastpage.cache import ResultCache
+from lastpage.drain import DrainingServer, DrainingSite, OrderedMultiService
+from lastpage.httpclient import HTTPClient, PooledEndpoint
+from lastpage.metrics import registry
+from lastpage.ratelimit import RateLimiter
+from lastpage.reload import ConfigWatcher, LiveConfig, ReloadSignal
 from lastpage.options import FluidinfoEndpointOptions
+from lastpage.render import Templates
 from lastpage import resource
+from lastpage.resilience import Backend, CircuitBreaker, RetryBudget
+from lastpage.resolver import Resolver
+from lastpage.snapshot import CacheSnapshot
+from lastpage.store import (
+    MemorySessionStore, MemoryTokenStore, SQLiteSessionStore,
+    SQLiteTokenStore)
+from lastpage.warmup import WarmUp
+from lastpage.workers import (
+    InheritedPortService, ListenWhenFree, WorkerPool)
 
 from twisted.plugin import IPlugin
 from twisted.application import service, internet
@@ -16,7 +39,20 @@ class Options(FluidinfoEndpointOptions):
     """
     Command line options for the loveme.do service.
     """
-    optParameters = [['conf', None, None, 'The configuration file to read.']]
+    optParameters = [
+        ['conf', None, None, 'The configuration file to read.'],
+        ['workers', None, 1, 'The number of worker processes to run.', int],
+        ['inherit-fd', None, None,
+         'Serve on this inherited listening socket (used by --workers).',
+         int],
+        ['worker-index', None, 0,
+         'The number of this worker (used by --workers).', int],
+        ]
+    optFlags = [
+        ['wait-for-snapshot', None,
+         'Load the cache snapshot only once sent SIGUSR1 (used by '
+         '--workers).'],
+        ]
 
     def postOptions(self):
         """
@@ -24,6 +60,8 @@ class Options(FluidinfoEndpointOptions):
         """
         if not self['conf']:
             raise RuntimeError('You must use --conf config-file')
+        if self['workers'] < 1:
+            raise RuntimeError('--workers must be at least 1')
 
 
 class ServiceMaker(object):
@@ -44,17 +82,199 @@ class ServiceMaker(object):
 
         @return: a Twisted C{service.MultiService} instance.
         """
-        conf = config.Config(options['conf'])
+        try:
+            conf = config.Config(options['conf'])
+        except config.ConfigError, e:
+            raise RuntimeError(str(e))
         if not conf.noisy_logging:
             protocol.Factory.noisy = False
-        env = Environment(loader=PackageLoader('lastpage', 'templates'))
-        lastpageService = service.MultiService()
-        cookieDict = {}  # This should be persisted.
-        oauthTokenDict = {}
-        root = resource.LastPage(conf, env, cookieDict, oauthTokenDict)
-        factory = server.Site(root)
-        _server = internet.TCPServer(conf.port, factory, interface='localhost')
-        _server.setServiceParent(lastpageService)
+        # Stop the server (draining its requests) before the services it
+        # uses, and the event log writer last of all.
+        lastpageService = OrderedMultiService()
+        inheritedFD = options['inherit-fd']
+
+        if options['workers'] > 1 and inheritedFD is None:
+            # Run worker processes that share our listening socket and
+            # do all the real work.
+            args = [sys.executable, sys.argv[0], '--nodaemon', '--pidfile=',
+                    self.tapname, '--conf', options['conf']]
+            pool = WorkerPool(conf.port, 'localhost', options['workers'],
+                              args)
+            pool.setServiceParent(lastpageService)
+            # The workers reload their own configuration.
+            reloadSignal = ReloadSignal(lambda: pool.signalWorkers('HUP'))
+            reloadSignal.setServiceParent(lastpageService)
+            # Deploys replace the workers with ones running the new code.
+            restartSignal = ReloadSignal(pool.restartWorkers, signal.SIGUSR2)
+            restartSignal.setServiceParent(lastpageService)
+            return lastpageService
+
+        logger.configure(LEVELS[conf.log_level],
+                         parseSampleRates(conf.log_sample_rates),
+                         conf.log_buffer_size)
+        logWriter = EventLogWriter(logger, conf.log_flush_interval,
+                                   conf.log_file or None)
+        logWriter.setServiceParent(lastpageService)
+
+        # Templates are all compiled up front and never change, so there is
+        # no need for Jinja2 to check whether they are up to date.
+        env = Environment(loader=PackageLoader('lastpage', 'templates'),
+                          auto_reload=False)
+        templates = Templates(env, conf.rendered_page_cache_size)
+        if inheritedFD is None:
+            tokens = MemoryTokenStore(conf.oauth_token_ttl,
+                                      conf.oauth_token_max)
+        else:
+            # We are one of several workers, so OAuth token state must be
+            # visible to all of them.
+            tokens = SQLiteTokenStore(conf.store_path, conf.oauth_token_ttl,
+                                      conf.oauth_token_max)
+        tokenExpirer = internet.TimerService(conf.oauth_token_expire_interval,
+                                             tokens.expire)
+        tokenExpirer.setServiceParent(lastpageService)
+        if conf.session_store == 'sqlite' or inheritedFD is not None:
+            # Workers always use SQLite, so they all see the same sessions.
+            sessions = SQLiteSessionStore(conf.store_path, conf.session_ttl,
+                                          conf.session_expire_batch)
+        elif conf.session_store == 'memory':
+            sessions = MemorySessionStore(conf.session_ttl, conf.session_max)
+        else:
+            raise RuntimeError('Unknown session_store %r.' %
+                               conf.session_store)
+        expirer = internet.TimerService(conf.session_expire_interval,
+                                        sessions.expire)
+        expirer.setServiceParent(lastpageService)
+        httpClient = HTTPClient(conf.http_max_per_host,
+                                conf.http_idle_timeout)
+        fluidinfo = self._makeBackend('fluidinfo', conf)
+        twitter = self._makeBackend('twitter', conf)
+        endpoint = PooledEndpoint(httpClient, conf.fluidinfo_endpoint,
+                                  fluidinfo)
+        cache = ResultCache(conf.cache_size, conf.cache_ttl,
+                            conf.cache_stale_ttl)
+        missingUsers = ResultCache(conf.negative_cache_size,
+                                   conf.negative_cache_ttl)
+        knownUsers = BloomFilter(conf.known_users_capacity)
+        resolver = Resolver(endpoint, cache, conf.negative_cache_ttl,
+                            missingUsers, knownUsers,
+                            conf.resolve_whole_user)
+        profiles = ResultCache(conf.profile_cache_size,
+                               conf.profile_cache_ttl)
+        limiters = {}
+        for budget in ('lookup', 'login', 'callback'):
+            rate = getattr(conf, 'rate_limit_%s_rate' % budget)
+            if rate > 0:
+                limiter = RateLimiter(
+                    budget, rate,
+                    getattr(conf, 'rate_limit_%s_burst' % budget))
+                limiters[budget] = limiter
+                limiterCleaner = internet.TimerService(
+                    conf.rate_limit_cleanup_interval, limiter.cleanup)
+                limiterCleaner.setServiceParent(lastpageService)
+        liveConfig = LiveConfig(options['conf'], conf)
+        liveConfig.onChange(
+            lambda old, new: self._reconfigure(endpoint, new))
+        reloadSignal = ReloadSignal(liveConfig.reload)
+        reloadSignal.setServiceParent(lastpageService)
+        if conf.config_check_interval:
+            watcher = ConfigWatcher(liveConfig, conf.config_check_interval)
+            watcher.setServiceParent(lastpageService)
+        if conf.cache_snapshot_file:
+            snapshotFile = conf.cache_snapshot_file
+            if inheritedFD is not None:
+                # Each worker has its own cache, and so its own snapshot.
+                snapshotFile += '.%d' % options['worker-index']
+            # Added before the server, so that it is stopped (writing a
+            # last snapshot) only once the server has drained.
+            snapshot = CacheSnapshot(resolver, cache, snapshotFile,
+                                     conf.cache_snapshot_interval,
+                                     waitToLoad=options['wait-for-snapshot'])
+            snapshot.setServiceParent(lastpageService)
+            loadSnapshot = snapshot.load
+        else:
+            loadSnapshot = lambda: None
+        if options['wait-for-snapshot']:
+            # We are replacing a worker, which writes its last snapshot as
+            # it exits. The pool sends SIGUSR1 once it has.
+            loadSignal = ReloadSignal(loadSnapshot, signal.SIGUSR1)
+            loadSignal.setServiceParent(lastpageService)
+        root = resource.LastPage(liveConfig, templates, sessions, tokens,
+                                 resolver, httpClient, twitter, profiles,
+                                 limiters)
+        factory = DrainingSite(root)
+        if inheritedFD is None:
+            _server = internet.TCPServer(conf.port, factory,
+                                         interface='localhost')
+        else:
+            _server = InheritedPortService(inheritedFD, factory)
+        drainingServer = DrainingServer(_server, factory,
+                                        conf.shutdown_drain_timeout)
+        drainingServer.setServiceParent(lastpageService)
+
+        if conf.warmup_file:
+            # Started after the server, so lookups are served while the
+            # cache warms up.
+            warmUp = WarmUp(resolver, conf.warmup_file, conf.warmup_max,
+                            conf.warmup_concurrency)
+            warmUp.setServiceParent(lastpageService)
+
+        if conf.admin_port:
+            admin = Admin()
+            admin.putChild('metrics', Metrics(registry))
+            if conf.admin_secret:
+                admin.putChild('invalidate',
+                               Invalidate(resolver, conf.admin_secret))
+            admin.putChild('status', Status({
+                'cache': cache.stats,
+                'fluidinfo': fluidinfo.stats,
+                'profiles': profiles.stats,
+                'tokens': tokens.stats,
+                'twitter': twitter.stats,
+            }))
+            if inheritedFD is None:
+                adminServer = internet.TCPServer(
+                    conf.admin_port, server.Site(admin),
+                    interface='localhost')
+            else:
+                # Each worker has its own admin port, which the worker it
+                # replaces may not have let go of yet.
+                adminServer = ListenWhenFree(
+                    conf.admin_port + options['worker-index'],
+                    server.Site(admin), 'localhost')
+            adminServer.setServiceParent(lastpageService)
         return lastpageService
 
+    def _reconfigure(self, endpoint, conf):
+        """
+        Apply a reloaded configuration to the parts of the service that
+        do not read it for themselves.
+
+        @param endpoint: The L{PooledEndpoint} for Fluidinfo.
+        @param conf: The new L{config.Config}.
+        """
+        logger.configure(LEVELS[conf.log_level],
+                         parseSampleRates(conf.log_sample_rates),
+                         conf.log_buffer_size)
+        protocol.Factory.noisy = conf.noisy_logging
+        baseURL = conf.fluidinfo_endpoint
+        if not baseURL.endswith('/'):
+            baseURL += '/'
+        endpoint.baseURL = baseURL
+
+    def _makeBackend(self, name, conf):
+        """
+        Create a L{Backend} to make calls to a remote service through.
+
+        @param name: The C{str} name of the remote service.
+        @param conf: A L{config.Config} instance holding configuration
+            settings.
+        @return: A L{Backend}.
+        """
+        breaker = CircuitBreaker(name, conf.breaker_threshold,
+                                 conf.breaker_reset_timeout)
+        budget = RetryBudget(conf.retry_budget_ratio,
+                             max(conf.backend_retries, 1) * 10)
+        return Backend(breaker, budget, conf.backend_max_concurrent,
+                       conf.backend_timeout, conf.backend_retries)
+
 serviceMaker = ServiceMaker()
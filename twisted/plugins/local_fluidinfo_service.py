@@ -0,0 +1,66 @@
+from lastpage import config
+from lastpage.local.fluidinfo import StubFluidinfo
+
+from twisted.python import usage
+from twisted.plugin import IPlugin
+from twisted.application import service, internet
+from twisted.web import server
+from twisted.internet import protocol
+
+from zope.interface import implements
+
+
+class Options(usage.Options):
+    """
+    Command line options for the local Fluidinfo stand-in.
+    """
+    optParameters = [
+        ['conf', None, None, 'The configuration file to read.'],
+        ['users', None, 10000, 'The number of users that exist.', int],
+        ['latency', None, 0.02,
+         'Seconds to wait before answering each request.', float],
+        ['jitter', None, 0.01,
+         'Further seconds (at most) to wait, chosen at random.', float],
+        ['error-rate', None, 0.0,
+         'The fraction of requests to answer with a 500 error.', float],
+        ]
+
+    def postOptions(self):
+        """
+        Make sure we got a configuration file.
+        """
+        if not self['conf']:
+            raise RuntimeError('You must use --conf config-file')
+
+
+class ServiceMaker(object):
+    """
+    The local Fluidinfo stand-in service.
+    """
+    implements(service.IServiceMaker, IPlugin)
+    tapname = 'local-fluidinfo'
+    description = 'Fluidinfo stand-in for benchmarking lastpage.me.'
+    options = Options
+
+    def makeService(self, options):
+        """
+        Create a local Twisted Fluidinfo stand-in service for lastpage.me
+
+        @param options: A C{twisted.python.usage.Options} instance
+            containing command line options, as above.
+
+        @return: a Twisted C{service.MultiService} instance.
+        """
+        conf = config.Config(options['conf'])
+        if not conf.noisy_logging:
+            protocol.Factory.noisy = False
+        fluidinfoService = service.MultiService()
+        root = StubFluidinfo(options['users'], options['latency'],
+                             options['jitter'], options['error-rate'])
+        factory = server.Site(root)
+        _server = internet.TCPServer(conf.local_fluidinfo_port, factory,
+                                     interface='localhost')
+        _server.setServiceParent(fluidinfoService)
+        return fluidinfoService
+
+serviceMaker = ServiceMaker()